@@ -1,20 +1,50 @@
+import asyncio
+import time
+from contextlib import contextmanager
 from random import choice
-from typing import Dict, List, Optional
-
-import httpx
+from threading import Event
+from typing import Dict, Iterator, List, Optional, Tuple
 
+from app.cache import metadata_cache
 from app.config import Settings
-from app.proxy_functions import FASTEST_PROXY, UP_PROXIES
-from app.Stream import Stream, download_stream
+from app.dash_clip import is_clip
+from app.governor import ThrottledException
+from app.hedged_requests import async_fetch_video_properties, fetch_video_properties
+from app.helper_classes import DownloadCancelledException
+from app.metrics import PROXY_THROUGHPUT, metrics
+from app.proxy import Proxy
+from app.proxy_functions import (
+    FASTEST_PROXY,
+    UP_PROXIES,
+    get_current_proxy,
+    proxy_slot,
+    record_proxy_failure,
+    release_proxy,
+)
+from app.proxy_registry import proxy_registry
+from app.Stream import Stream, async_download_stream, download_stream
+from app.stream_policy import (
+    StreamPolicy,
+    select_audio_stream,
+    select_streams,
+)
 
 settings = Settings()
 
+# Key of the proxy that resolved a video's stream URLs in its cached metadata. Stream URLs are served by that proxy,
+# so cache hits charge their transfers to it.
+RESOLVING_PROXY_KEY = "vidyodlResolvingProxy"
+
 
 class Piped:
-    def __init__(self, video_id: str):
+    def __init__(self, video_id: str, file_name: Optional[str] = None):
         self.video_id: str = video_id
+        # Name of the downloaded stream files, the video ID unless a stream policy or clip needs them told apart
+        self.file_name: str = file_name or video_id
         self._base_url: Optional[str] = "https://pipedapi.kavin.rocks"
-        self.stream_url: str = f"{settings.default_proxy}/streams/"
+        # The proxy that resolved the stream URLs, set once the metadata is loaded
+        self.proxy: Optional[Proxy] = None
+        self.stream_url: Optional[str] = None
         self._video_properties: Optional[Dict] = None
         self._audio_streams: Optional[List] = None
         self._video_streams: Optional[List] = None
@@ -24,14 +54,33 @@ class Piped:
         if self._video_properties is not None:
             return self._video_properties
 
-        self._video_properties = dict()
+        if settings.metadata_cache_enabled:
+            cached_properties = metadata_cache.get(self.video_id)
+            if cached_properties is not None:
+                self.set_cached_properties(cached_properties)
+                return self._video_properties
 
-        response = httpx.get(f"{self.stream_url}{self.video_id}?instance={FASTEST_PROXY.url}")
+        video_properties, proxy = fetch_video_properties(self.video_id)
+        self.set_resolved_properties(video_properties, proxy)
 
-        self._video_properties.update(response.json())
+        # Only cache responses that actually resolved the streams
+        if settings.metadata_cache_enabled and "audioStreams" in self._video_properties:
+            metadata_cache.set(self.video_id, self._video_properties)
 
         return self._video_properties
 
+    def set_resolved_properties(self, video_properties: dict, proxy: Proxy) -> None:
+        self.proxy = proxy
+        self.stream_url = f"{proxy.url}/streams/"
+        self._video_properties = {**video_properties, RESOLVING_PROXY_KEY: {"name": proxy.name, "url": proxy.url}}
+
+    def set_cached_properties(self, cached_properties: dict) -> None:
+        resolving_proxy = cached_properties.get(RESOLVING_PROXY_KEY)
+        # Entries cached before the resolving proxy was recorded are charged to the current best proxy
+        self.proxy = Proxy(resolving_proxy) if resolving_proxy else get_current_proxy()
+        self.stream_url = f"{self.proxy.url}/streams/"
+        self._video_properties = cached_properties
+
     @property
     def audio_streams(self) -> list:
         if self._audio_streams is not None:
@@ -67,25 +116,169 @@ class Piped:
             self._base_url = settings.default_proxy
         return self._base_url
 
-    def get_best_audio_stream(self) -> Stream:
-        if self._audio_streams is not None:
-            return Stream(self._audio_streams[0])
+    @property
+    def duration(self) -> int:
+        return self.video_properties.get("duration", 0)
 
-        return Stream(self.audio_streams[0])
+    def get_best_audio_stream(self, policy: Optional[StreamPolicy] = None, format_out: Optional[str] = None) -> Stream:
+        """
+        Picks the audio stream of a download. With format_out, it is the audio half of the pair get_streams picks.
+        """
+        if format_out is not None:
+            return self.get_streams(policy, format_out)[0]
+        audio_streams = self._audio_streams if self._audio_streams is not None else self.audio_streams
+        return select_audio_stream([Stream(stream) for stream in audio_streams], policy or StreamPolicy())
 
-    def get_best_video_stream(self) -> Stream:
-        if self._video_streams is not None:
-            return Stream(self._video_streams[0])
-        return Stream(self.video_streams[0])
-
-    # TODO: Add support for start/stop times
-    def download_audio_stream(self, stream) -> str:
-        # starting = None
-        # ending = None
-        return download_stream(stream=stream, title=self.title, file_type="audio")
-
-    # TODO: Add support for start/stop times
-    def download_video_stream(self, stream) -> str:
-        # starting = None
-        # ending = None
-        return download_stream(stream=stream, title=self.title, file_type="video")
+    def get_best_video_stream(self, policy: Optional[StreamPolicy] = None, format_out: str = "mp4") -> Stream:
+        return self.get_streams(policy, format_out)[1]
+
+    def get_streams(self, policy: Optional[StreamPolicy] = None, format_out: str = "mp4") -> Tuple[Stream, Stream]:
+        """
+        Picks the audio and video streams of a download according to the policy, compatible with format_out.
+        """
+        audio_streams = self._audio_streams if self._audio_streams is not None else self.audio_streams
+        video_streams = self._video_streams if self._video_streams is not None else self.video_streams
+        return select_streams(
+            [Stream(stream) for stream in audio_streams],
+            [Stream(stream) for stream in video_streams],
+            policy or StreamPolicy(),
+            format_out,
+            self.duration,
+        )
+
+    def download_audio_stream(
+        self,
+        stream,
+        cancel_event: Optional[Event] = None,
+        starting: Optional[float] = None,
+        ending: Optional[float] = None,
+    ) -> str:
+        start = time.perf_counter()
+        with self.stream_transfer():
+            file_path = download_stream(
+                stream=stream,
+                file_name=self.file_name,
+                file_type="audio",
+                cancel_event=cancel_event,
+                start=starting,
+                end=ending,
+            )
+        # Clips transfer an unknown share of the stream, so only whole stream downloads count towards throughput
+        if not is_clip(starting, ending):
+            self.record_throughput(stream, time.perf_counter() - start)
+        return file_path
+
+    def download_video_stream(
+        self,
+        stream,
+        cancel_event: Optional[Event] = None,
+        starting: Optional[float] = None,
+        ending: Optional[float] = None,
+    ) -> str:
+        start = time.perf_counter()
+        with self.stream_transfer():
+            file_path = download_stream(
+                stream=stream,
+                file_name=self.file_name,
+                file_type="video",
+                cancel_event=cancel_event,
+                start=starting,
+                end=ending,
+            )
+        if not is_clip(starting, ending):
+            self.record_throughput(stream, time.perf_counter() - start)
+        return file_path
+
+    @contextmanager
+    def stream_transfer(self) -> Iterator[None]:
+        """
+        Counts a stream transfer towards the resolving proxy's load and its circuit breaker. Being throttled isn't a
+        failure of the proxy.
+        """
+        with proxy_slot(self.proxy):
+            try:
+                yield
+            except (DownloadCancelledException, ThrottledException):
+                raise
+            except Exception:
+                record_proxy_failure(self.proxy)
+                raise
+
+    def record_throughput(self, stream: Stream, elapsed: float) -> None:
+        # Stream URLs are served by the resolving instance's own proxy, so the throughput is credited to it
+        if stream.content_length and stream.content_length > 0 and elapsed > 0:
+            proxy_registry.record_throughput(self.proxy.url, stream.content_length / elapsed)
+            metrics.observe(PROXY_THROUGHPUT, stream.content_length / elapsed, {"proxy": self.proxy.url})
+
+
+class AsyncPiped(Piped):
+    """
+    Piped client for use inside an event loop.
+
+    Call `await load()` first; after that the inherited properties and stream pickers read from the loaded
+    metadata without doing any I/O.
+    """
+
+    @property
+    def video_properties(self) -> dict:
+        if self._video_properties is None:
+            raise RuntimeError("AsyncPiped metadata is not loaded, await load() first")
+        return self._video_properties
+
+    async def load(self) -> dict:
+        if self._video_properties is not None:
+            return self._video_properties
+
+        if settings.metadata_cache_enabled:
+            cached_properties = await asyncio.to_thread(metadata_cache.get, self.video_id)
+            if cached_properties is not None:
+                await asyncio.to_thread(self.set_cached_properties, cached_properties)
+                return self._video_properties
+
+        video_properties, proxy = await async_fetch_video_properties(self.video_id)
+        self.set_resolved_properties(video_properties, proxy)
+
+        if settings.metadata_cache_enabled and "audioStreams" in self._video_properties:
+            await asyncio.to_thread(metadata_cache.set, self.video_id, self._video_properties)
+
+        return self._video_properties
+
+    async def download_audio_stream(
+        self, stream, starting: Optional[float] = None, ending: Optional[float] = None
+    ) -> str:
+        start = time.perf_counter()
+        file_path = await self.async_stream_transfer(
+            async_download_stream(
+                stream=stream, file_name=self.file_name, file_type="audio", start=starting, end=ending
+            )
+        )
+        if not is_clip(starting, ending):
+            await asyncio.to_thread(self.record_throughput, stream, time.perf_counter() - start)
+        return file_path
+
+    async def download_video_stream(
+        self, stream, starting: Optional[float] = None, ending: Optional[float] = None
+    ) -> str:
+        start = time.perf_counter()
+        file_path = await self.async_stream_transfer(
+            async_download_stream(
+                stream=stream, file_name=self.file_name, file_type="video", start=starting, end=ending
+            )
+        )
+        if not is_clip(starting, ending):
+            await asyncio.to_thread(self.record_throughput, stream, time.perf_counter() - start)
+        return file_path
+
+    async def async_stream_transfer(self, download) -> str:
+        acquired = await asyncio.to_thread(
+            proxy_registry.try_acquire, self.proxy.url, settings.proxy_max_concurrency, True
+        )
+        try:
+            return await download
+        except ThrottledException:
+            raise
+        except Exception:
+            await asyncio.to_thread(record_proxy_failure, self.proxy)
+            raise
+        finally:
+            await asyncio.to_thread(release_proxy, self.proxy, acquired)
@@ -0,0 +1,124 @@
+import asyncio
+import time
+from typing import AsyncIterator, Iterator, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from app.governor import REQUESTS, ThrottledException, rate_governor
+from app.hedged_requests import parse_piped_response
+from app.http_client import get_async_http_client, get_http_client
+from app.proxy_functions import (
+    acquire_proxy,
+    record_proxy_failure,
+    record_proxy_success,
+    release_proxy,
+)
+
+
+def get_video_id_from_url(url: str) -> Optional[str]:
+    """
+    Returns the video ID of a Piped watch URL such as /watch?v=<video_id>.
+    """
+    video_ids = parse_qs(urlparse(url).query).get("v")
+    return video_ids[0] if video_ids else None
+
+
+class PipedPlaylist:
+    """
+    Reads a playlist through Piped's paginated playlist API, one page at a time.
+    """
+
+    def __init__(self, playlist_id: str):
+        self.playlist_id: str = playlist_id
+        self.name: Optional[str] = None
+
+    def get_page(self, nextpage: Optional[str] = None) -> dict:
+        """
+        Fetches a page of the playlist within the rate governor's limits, like a video's metadata.
+        """
+        proxy, acquired = acquire_proxy()
+        try:
+            rate_governor.acquire(REQUESTS, proxy.url)
+            start = time.perf_counter()
+            if nextpage is None:
+                response = get_http_client().get(f"{proxy.url}/playlists/{self.playlist_id}")
+            else:
+                response = get_http_client().get(
+                    f"{proxy.url}/nextpage/playlists/{self.playlist_id}", params={"nextpage": nextpage}
+                )
+            page = parse_piped_response(response)
+        except ThrottledException:
+            raise
+        except Exception:
+            record_proxy_failure(proxy)
+            raise
+        finally:
+            release_proxy(proxy, acquired)
+        record_proxy_success(proxy, time.perf_counter() - start)
+        return page
+
+    async def async_get_page(self, nextpage: Optional[str] = None) -> dict:
+        proxy, acquired = await asyncio.to_thread(acquire_proxy)
+        try:
+            await rate_governor.async_acquire(REQUESTS, proxy.url)
+            start = time.perf_counter()
+            if nextpage is None:
+                response = await get_async_http_client().get(f"{proxy.url}/playlists/{self.playlist_id}")
+            else:
+                response = await get_async_http_client().get(
+                    f"{proxy.url}/nextpage/playlists/{self.playlist_id}", params={"nextpage": nextpage}
+                )
+            page = await asyncio.to_thread(parse_piped_response, response)
+        except ThrottledException:
+            raise
+        except Exception:
+            await asyncio.to_thread(record_proxy_failure, proxy)
+            raise
+        finally:
+            await asyncio.to_thread(release_proxy, proxy, acquired)
+        await asyncio.to_thread(record_proxy_success, proxy, time.perf_counter() - start)
+        return page
+
+    def iter_pages(self) -> Iterator[List[dict]]:
+        """
+        Yields the playlist's entries page by page, so callers can act on the first page before the rest
+        has been fetched.
+        """
+        page = self.get_page()
+        self.name = page.get("name")
+        yield page.get("relatedStreams", [])
+
+        while page.get("nextpage"):
+            page = self.get_page(page["nextpage"])
+            yield page.get("relatedStreams", [])
+
+    async def async_iter_pages(self) -> AsyncIterator[List[dict]]:
+        page = await self.async_get_page()
+        self.name = page.get("name")
+        yield page.get("relatedStreams", [])
+
+        while page.get("nextpage"):
+            page = await self.async_get_page(page["nextpage"])
+            yield page.get("relatedStreams", [])
+
+    def iter_video_ids(self) -> Iterator[List[str]]:
+        for entries in self.iter_pages():
+            yield get_video_ids(entries)
+
+    async def async_iter_video_ids(self) -> AsyncIterator[List[str]]:
+        async for entries in self.async_iter_pages():
+            yield get_video_ids(entries)
+
+
+def get_video_ids(entries: List[dict]) -> List[str]:
+    return [entry["video_id"] for entry in get_video_entries(entries)]
+
+
+def get_video_entries(entries: List[dict]) -> List[dict]:
+    """
+    Returns the video ID and duration of every video in a page of playlist entries.
+    """
+    video_entries = [
+        {"video_id": get_video_id_from_url(entry.get("url", "")), "duration": entry.get("duration")}
+        for entry in entries
+    ]
+    return [entry for entry in video_entries if entry["video_id"] is not None]
@@ -1,6 +1,14 @@
+import asyncio
+from threading import Event, Thread
+from typing import IO, Callable, Optional
+
 import ffmpeg
 
 from app.config import Settings
+from app.dash_clip import download_clip, is_clip
+from app.governor import REQUESTS, rate_governor
+from app.helper_classes import DownloadCancelledException
+from app.range_download import download_ranges
 
 settings = Settings()
 
@@ -29,39 +37,185 @@ class Stream:
         self.content_length = stream_data["contentLength"]
 
 
-def download_stream(
-    stream: Stream,
-    title: str,
-    file_type: str,
-) -> str:
+def get_stream_size(stream: Stream, duration: int) -> int:
+    """
+    Size of a stream in bytes, estimated from its bitrate and the video's duration when Piped doesn't report it.
+    """
+    if stream.content_length and stream.content_length > 0:
+        return stream.content_length
+    return int((stream.bitrate or 0) * (duration or 0) / 8)
+
+
+def get_stream_file_path(stream: Stream, file_name: str, file_type: str) -> str:
     output_path = f"{settings.download_path}/{file_type}"
 
-    file_name = f"{file_type}_{title}"
+    file_name = f"{file_type}_{file_name}"
+
+    return f"{output_path}/{file_name}.{get_file_ext_from_format(stream.format)}"
 
-    file_path = f"{output_path}/{file_name}.{get_file_ext_from_format(stream.format)}"
 
+def build_stream_output(stream: Stream, file_path: str, file_type: str):
     if file_type == "video":
         video_stream = ffmpeg.input(stream.url)
-        ffmpeg.output(
+        return ffmpeg.output(
             video_stream,
             filename=file_path,
             format=get_file_ext_from_format(stream.format),
             vcodec="copy",
             strict="experimental",
-        ).overwrite_output().run()
+        ).overwrite_output()
     elif file_type == "audio":
         audio_stream = ffmpeg.input(stream.url)
-        ffmpeg.output(
+        return ffmpeg.output(
             audio_stream,
             filename=file_path,
             format=get_file_ext_from_format(stream.format),
             acodec="copy",
             strict="experimental",
-        ).overwrite_output().run()
+        ).overwrite_output()
+    raise ValueError(f"Unknown file type: {file_type}")
+
+
+def download_stream(
+    stream: Stream,
+    file_name: str,
+    file_type: str,
+    cancel_event: Optional[Event] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> str:
+    """
+    Downloads a stream, or with start or end, only the clip between those times in seconds.
+
+    Every request the native downloaders send goes through the rate governor, and so does ffmpeg's one request for
+    the whole stream, though its bytes aren't counted.
+    """
+    file_path = get_stream_file_path(stream, file_name, file_type)
+
+    if is_clip(start, end):
+        return download_clip(stream, file_path, start, end, get_file_ext_from_format(stream.format), cancel_event)
+
+    if settings.segmented_download:
+        # DASH streams are already in their final container, so the bytes can be written as-is
+        return download_ranges(stream.url, file_path, stream.content_length, cancel_event, itag=stream.itag)
+
+    rate_governor.acquire(REQUESTS, stream.url, cancel_event=cancel_event)
+    run_ffmpeg(build_stream_output(stream, file_path, file_type), cancel_event)
 
     return file_path
 
 
+async def async_download_stream(
+    stream: Stream, file_name: str, file_type: str, start: Optional[float] = None, end: Optional[float] = None
+) -> str:
+    """
+    Async counterpart of download_stream that never blocks the event loop.
+
+    The segmented and clip downloaders run in a worker thread and are told to stop if the awaiting task is cancelled;
+    the ffmpeg path runs as an asyncio subprocess.
+    """
+    file_path = get_stream_file_path(stream, file_name, file_type)
+
+    if is_clip(start, end) or settings.segmented_download:
+        cancel_event = Event()
+        try:
+            if is_clip(start, end):
+                return await asyncio.to_thread(
+                    download_clip,
+                    stream,
+                    file_path,
+                    start,
+                    end,
+                    get_file_ext_from_format(stream.format),
+                    cancel_event,
+                )
+            return await asyncio.to_thread(
+                download_ranges, stream.url, file_path, stream.content_length, cancel_event, stream.itag
+            )
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    await rate_governor.async_acquire(REQUESTS, stream.url)
+    await run_ffmpeg_async(build_stream_output(stream, file_path, file_type))
+
+    return file_path
+
+
+def run_ffmpeg(output, cancel_event: Optional[Event] = None, progress: Optional[Callable[[dict], None]] = None) -> None:
+    """
+    Runs an ffmpeg output spec, killing the process if cancel_event is set before it exits.
+
+    With progress, ffmpeg writes its -progress reports to stdout and progress is called with each one, parsed by
+    parse_ffmpeg_progress.
+    """
+    if cancel_event is None and progress is None:
+        output.run()
+        return
+
+    if progress is not None:
+        output = output.global_args("-progress", "pipe:1", "-nostats")
+    process = output.run_async(pipe_stdout=progress is not None)
+    reader = None
+    if progress is not None:
+        reader = Thread(target=parse_ffmpeg_progress, args=(process.stdout, progress), daemon=True)
+        reader.start()
+
+    cancel_event = cancel_event or Event()
+    while process.poll() is None:
+        if cancel_event.wait(timeout=0.5):
+            process.kill()
+            process.wait()
+            raise DownloadCancelledException("Download cancelled")
+    if reader is not None:
+        reader.join()
+
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", None, None)
+
+
+def parse_ffmpeg_progress(stdout: IO[bytes], progress: Callable[[dict], None]) -> None:
+    """
+    Reads the key=value blocks ffmpeg's -progress writes, and calls progress with the position written so far in
+    seconds, the output size in bytes and the encoding speed of each block.
+    """
+    block = {}
+    for line in stdout:
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        if key != "progress":
+            block[key] = value
+            continue
+        report = {"done": value == "end"}
+        if block.get("out_time_us", "N/A").lstrip("-").isdigit():
+            report["out_time"] = max(int(block["out_time_us"]), 0) / 1_000_000
+        if block.get("total_size", "N/A").isdigit():
+            report["total_size"] = int(block["total_size"])
+        if block.get("speed", "N/A") != "N/A":
+            report["speed"] = block["speed"]
+        try:
+            progress(report)
+        except Exception:
+            # Keep draining stdout, or ffmpeg blocks once the pipe fills
+            pass
+        block = {}
+
+
+async def run_ffmpeg_async(output) -> None:
+    """
+    Runs an ffmpeg output spec as an asyncio subprocess, killing it if the awaiting task is cancelled.
+    """
+    process = await asyncio.create_subprocess_exec(*output.compile())
+    try:
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+    if returncode != 0:
+        raise ffmpeg.Error("ffmpeg", None, None)
+
+
 def get_file_ext_from_format(format: str) -> str:
     match format:
         case "M4A":
@@ -0,0 +1,164 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import redis
+
+from app.config import Settings
+from app.metrics import CACHE_REQUESTS, metrics
+from app.redis_client import get_redis
+
+settings = Settings()
+
+# Stop serving an entry this many seconds before its stream URLs expire
+EXPIRY_MARGIN = 60
+
+
+class LRUCacheTier:
+    """
+    In-process cache tier. Evicts the least recently used entry once max_size is reached.
+    """
+
+    name = "lru"
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: dict, ttl: int) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisCacheTier:
+    """
+    Cache tier shared by every API and worker process. Redis errors are treated as misses, and the tier
+    is skipped for a short while after one so an unreachable server doesn't add a timeout to every lookup.
+    """
+
+    name = "redis"
+
+    def __init__(self, db: int, prefix: str = "vidyodl:metadata:", backoff: int = 30):
+        self.db = db
+        self.prefix = prefix
+        self.backoff = backoff
+        self._disabled_until = 0.0
+
+    def get(self, key: str) -> Optional[dict]:
+        if time.time() < self._disabled_until:
+            return None
+        try:
+            value = get_redis(self.db).get(f"{self.prefix}{key}")
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: dict, ttl: int) -> None:
+        if time.time() < self._disabled_until:
+            return
+        try:
+            get_redis(self.db).set(f"{self.prefix}{key}", json.dumps(value), ex=ttl)
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+
+    def delete(self, key: str) -> None:
+        if time.time() < self._disabled_until:
+            return
+        try:
+            get_redis(self.db).delete(f"{self.prefix}{key}")
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+
+
+class MetadataCache:
+    """
+    Read-through cache of Piped /streams responses keyed by video_id.
+
+    Tiers are checked in order; a hit in a later tier is written back to the earlier ones.
+    """
+
+    def __init__(self, tiers: List):
+        self.tiers = tiers
+        self.stats: Dict[str, int] = {f"{tier.name}_hits": 0 for tier in tiers}
+        self.stats["misses"] = 0
+
+    def get(self, video_id: str) -> Optional[dict]:
+        for index, tier in enumerate(self.tiers):
+            value = tier.get(video_id)
+            if value is None:
+                continue
+            self.stats[f"{tier.name}_hits"] += 1
+            metrics.inc(CACHE_REQUESTS, labels={"cache": "metadata", "result": f"{tier.name}_hit"})
+            ttl = get_ttl_from_properties(value)
+            for earlier_tier in self.tiers[:index]:
+                earlier_tier.set(video_id, value, ttl)
+            return value
+        self.stats["misses"] += 1
+        metrics.inc(CACHE_REQUESTS, labels={"cache": "metadata", "result": "miss"})
+        return None
+
+    def set(self, video_id: str, value: dict) -> None:
+        ttl = get_ttl_from_properties(value)
+        if ttl <= 0:
+            return
+        for tier in self.tiers:
+            tier.set(video_id, value, ttl)
+
+    def delete(self, video_id: str) -> None:
+        """
+        Drops a video's entry from every tier, for when its stream URLs stopped working.
+        """
+        for tier in self.tiers:
+            tier.delete(video_id)
+
+
+def get_ttl_from_properties(video_properties: dict) -> int:
+    """
+    Returns how long a /streams response stays usable, based on the earliest `expire` parameter of its
+    signed stream URLs.
+    """
+    expiries = []
+    for stream in video_properties.get("audioStreams", []) + video_properties.get("videoStreams", []):
+        expire = parse_qs(urlparse(stream.get("url", "")).query).get("expire")
+        if expire and expire[0].isdigit():
+            expiries.append(int(expire[0]))
+
+    if not expiries:
+        return settings.metadata_cache_default_ttl
+    return int(min(expiries) - time.time() - EXPIRY_MARGIN)
+
+
+def build_metadata_cache() -> MetadataCache:
+    return MetadataCache(
+        [
+            LRUCacheTier(settings.metadata_cache_size),
+            RedisCacheTier(settings.metadata_cache_redis_db),
+        ]
+    )
+
+
+metadata_cache = build_metadata_cache()
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from app.config import Settings
+
+settings = Settings()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    id INTEGER PRIMARY KEY,
+    video_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    format TEXT NOT NULL,
+    title TEXT,
+    audio_itag INTEGER,
+    video_itag INTEGER,
+    size INTEGER,
+    duration INTEGER,
+    path TEXT NOT NULL UNIQUE,
+    checksum TEXT,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    UNIQUE (video_id, mode, format)
+);
+CREATE INDEX IF NOT EXISTS media_video_id ON media (video_id);
+CREATE INDEX IF NOT EXISTS media_accessed_at ON media (accessed_at);
+"""
+
+
+class Catalog:
+    """
+    SQLite catalog of finished downloads, so lookups by video or path never have to scan the download directory.
+
+    The database runs in WAL mode so the API and the workers can read while one of them writes. Each thread gets its
+    own connection.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def record(
+        self,
+        video_id: str,
+        mode: str,
+        format_out: str,
+        path: str,
+        title: Optional[str] = None,
+        audio_itag: Optional[int] = None,
+        video_itag: Optional[int] = None,
+        duration: Optional[int] = None,
+    ) -> None:
+        now = time.time()
+        size = os.path.getsize(path) if os.path.exists(path) else None
+        checksum = get_checksum(path) if settings.catalog_checksums and size is not None else None
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # A path is one output, so an entry that now points at it under another key is replaced
+            connection.execute(
+                "DELETE FROM media WHERE path = ? AND NOT (video_id = ? AND mode = ? AND format = ?)",
+                (path, video_id, mode, format_out),
+            )
+            connection.execute(
+                """
+                INSERT INTO media (
+                    video_id, mode, format, title, audio_itag, video_itag, size, duration, path, checksum, created_at,
+                    accessed_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (video_id, mode, format) DO UPDATE SET
+                    title = excluded.title,
+                    audio_itag = excluded.audio_itag,
+                    video_itag = excluded.video_itag,
+                    size = excluded.size,
+                    duration = excluded.duration,
+                    path = excluded.path,
+                    checksum = excluded.checksum,
+                    created_at = excluded.created_at,
+                    accessed_at = excluded.accessed_at
+                """,
+                (video_id, mode, format_out, title, audio_itag, video_itag, size, duration, path, checksum, now, now),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def lookup(self, video_id: str, mode: str, format_out: str) -> Optional[dict]:
+        row = self.connection.execute(
+            "SELECT * FROM media WHERE video_id = ? AND mode = ? AND format = ?", (video_id, mode, format_out)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def list_for_video(self, video_id: str) -> List[dict]:
+        rows = self.connection.execute("SELECT * FROM media WHERE video_id = ?", (video_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def contains(self, path: str) -> bool:
+        row = self.connection.execute("SELECT 1 FROM media WHERE path = ?", (path,)).fetchone()
+        return row is not None
+
+    def touch(self, path: str) -> None:
+        self.connection.execute("UPDATE media SET accessed_at = ? WHERE path = ?", (time.time(), path))
+
+    def remove(self, path: str) -> None:
+        self.connection.execute("DELETE FROM media WHERE path = ?", (path,))
+
+    def list_least_recently_used(self, accessed_before: float) -> List[dict]:
+        rows = self.connection.execute(
+            "SELECT * FROM media WHERE accessed_at < ? ORDER BY accessed_at", (accessed_before,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_total_size(self, accessed_before: Optional[float] = None) -> int:
+        """
+        Total size in bytes of the outputs in the catalog, or of those last used before accessed_before.
+        """
+        if accessed_before is None:
+            row = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM media").fetchone()
+        else:
+            row = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM media WHERE accessed_at < ?", (accessed_before,)
+            ).fetchone()
+        return row[0]
+
+
+def get_checksum(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+catalog = Catalog(settings.catalog_path)
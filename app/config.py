@@ -1,3 +1,6 @@
+from typing import List, Optional
+
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
 
@@ -38,10 +41,176 @@ class Settings(BaseSettings):
     celery_broker_db: int = 0
     celery_backend_db: int = 1
 
+    # Timeout in seconds for app-level Redis connections (metadata cache etc.)
+    redis_socket_timeout: float = 2.0
+
+    # Maximum number of use_celery=False downloads the API runs at the same time
+    inline_download_concurrency: int = 2
+
     # Celery retry settings
     celery_retry_max: int = 5
     celery_retry_delay: int = 10
 
+    # Celery queues. Stream fetches run on the I/O queue, whose workers can run many threads, and ffmpeg muxing runs on
+    # the CPU queue, whose workers should run one process per core.
+    celery_io_queue: str = "io"
+    celery_cpu_queue: str = "cpu"
+    # Threads per I/O worker process, which docker-compose starts the worker with. Stream transfer connections are
+    # pooled for this many jobs at once.
+    celery_io_concurrency: int = 50
+    # Run /download jobs as parallel audio and video fetch tasks followed by a mux task instead of one task
+    celery_split_pipeline: bool = True
+
+    # Download the audio and video streams of a video at the same time
+    concurrent_av_download: bool = True
+
+    # Shared HTTP client settings. HTTP/2 for Piped API calls is opt-in: it needs the h2 package, which isn't a
+    # dependency of the project (install httpx[http2] into the image), and is left off without it.
+    http2: bool = False
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    http_connect_timeout: float = 10.0
+    http_timeout: float = 30.0
+
+    # Native downloader settings. Streams are fetched as parallel HTTP Range segments when enabled,
+    # otherwise ffmpeg reads the stream URL over a single connection.
+    segmented_download: bool = True
+    download_segment_count: int = 8
+    download_segment_size: int = 10 * 1024 * 1024
+
+    # Piped metadata cache. Entries live in an in-process LRU and in Redis (on the broker's server) and
+    # expire with the signed stream URLs they contain, or after the default TTL if no expiry is found.
+    metadata_cache_enabled: bool = True
+    metadata_cache_size: int = 1024
+    metadata_cache_redis_db: int = 2
+    metadata_cache_default_ttl: int = 3600
+
+    # Shared proxy registry. Health checks and real requests update per-proxy EWMA latency, throughput and
+    # error rate in Redis, and every process picks proxies from the resulting ranking.
+    proxy_registry_enabled: bool = True
+    proxy_registry_redis_db: int = 3
+    proxy_ewma_alpha: float = 0.3
+    # How much a 100% error rate multiplies a proxy's latency score by, on top of 1
+    proxy_error_penalty: float = 4.0
+    # Seconds between the periodic health checks run by Celery beat
+    proxy_healthcheck_interval: int = 300
+    # Proxy selection strategy: fastest, weighted_random or power_of_two
+    proxy_selection_strategy: str = "power_of_two"
+    # Number of best ranked proxies the strategies choose from
+    proxy_candidate_count: int = 10
+    # Maximum in-flight requests per proxy across all processes
+    proxy_max_concurrency: int = 8
+    # Consecutive failures that open a proxy's circuit breaker, and seconds before it lets a probe through
+    proxy_breaker_failure_threshold: int = 3
+    proxy_breaker_cooldown: int = 60
+    # Number of recent request latencies kept per proxy for p50/p95/p99
+    latency_sample_size: int = 200
+
+    # Hedged metadata requests. When on, a /streams request that hasn't been answered within the proxy's
+    # hedge_percentile latency is also sent to the next best proxy, and the first valid response wins.
+    hedged_requests: bool = False
+    hedge_percentile: float = 95
+    # Below this many samples the proxy's percentile isn't trusted and hedge_default_delay is used instead
+    hedge_min_samples: int = 20
+    hedge_default_delay: float = 1.0
+
+    # Job deduplication. Requests for a (video_id, mode, format) that is already running get that task's ID, and
+    # requests for one that already finished get its output path.
+    dedup_enabled: bool = True
+    dedup_redis_db: int = 4
+    # Seconds before an in-flight claim expires, in case its worker dies without releasing it
+    dedup_lock_ttl: int = 6 * 60 * 60
+
+    # Fair scheduling. Download jobs wait in per-client queues and are released to Celery by deficit round-robin,
+    # keeping about scheduler_backlog_target messages in the broker's entry queues.
+    scheduler_enabled: bool = True
+    scheduler_redis_db: int = 5
+    scheduler_backlog_target: int = 100
+    scheduler_dispatch_interval: float = 2.0
+    # Bytes added to a client's deficit on each round-robin turn
+    scheduler_quantum: int = 64 * 1024 * 1024
+    # Upper bound on client turns per dispatch, for jobs much larger than the quantum
+    scheduler_max_visits: int = 1000
+    # Estimate each new job's cost from its metadata when it is already cached. Otherwise, and when off, jobs without a
+    # known duration get the default.
+    scheduler_estimate_costs: bool = True
+    scheduler_estimate_concurrency: int = 8
+    scheduler_default_cost: int = 100 * 1024 * 1024
+    # Typical bitrates in bits per second, for jobs whose cost is estimated from their duration
+    scheduler_audio_bitrate: int = 160_000
+    scheduler_av_bitrate: int = 2_500_000
+    # Estimated costs in bytes at which a job drops one priority level within its band
+    scheduler_cost_tiers: List[int] = [20 * 1024 * 1024, 200 * 1024 * 1024]
+
+    # SQLite catalog of finished downloads, keyed by (video_id, mode, format). Outputs are named after the video ID;
+    # titles and stream details live here. Defaults to catalog.sqlite3 in download_path.
+    catalog_path: Optional[str] = None
+    # Store a SHA-256 of every output so files can be served with a strong ETag
+    catalog_checksums: bool = True
+
+    # Transcoding. Outputs with a video codec other than copy are split at keyframes into segments of about
+    # transcode_segment_duration seconds, which are encoded in parallel and joined without re-encoding.
+    transcode_chunked: bool = True
+    transcode_segment_duration: int = 60
+    # Segments encoded at once by a worker. 0 uses every core available to it.
+    transcode_workers: int = 0
+    # Encode the segments of split pipeline jobs as tasks on the CPU queue, spreading them over every CPU worker,
+    # instead of in the worker that muxes them
+    transcode_distributed: bool = False
+
+    # Metrics shared by every process through Redis and served by the API at /metrics
+    metrics_enabled: bool = True
+    metrics_redis_db: int = 6
+    # Seconds between writes of a process's buffered metric samples to Redis
+    metrics_flush_interval: float = 5.0
+    # Minimum seconds between progress updates a job pushes as its Celery task state
+    metrics_progress_interval: float = 1.0
+
+    # Job events. Tasks publish their progress and completion over Redis pub/sub, and the API pushes them to clients
+    # subscribed to /events. Events a subscriber hasn't read yet are buffered up to events_buffer_size, after which
+    # the oldest are dropped.
+    events_enabled: bool = True
+    events_buffer_size: int = 1000
+    # Seconds between keepalives sent to idle subscribers
+    events_heartbeat_interval: float = 15.0
+
+    # Disk admission. Jobs reserve the disk space they will need, from the sizes of the streams they pick, before they
+    # start writing, and wait disk_retry_delay seconds to try again when it doesn't fit in the free space left above
+    # disk_min_free_bytes by every other reservation. The fair scheduler also holds jobs back while the disk is full.
+    disk_admission_enabled: bool = True
+    disk_redis_db: int = 7
+    disk_min_free_bytes: int = 1024 * 1024 * 1024
+    disk_retry_delay: int = 30
+    # Seconds before a reservation expires, in case its job dies without releasing it
+    disk_reservation_ttl: int = 6 * 60 * 60
+    # Delete the audio and video streams of a download once they are muxed into its output
+    cleanup_intermediates: bool = True
+
+    # Eviction of completed outputs. Least recently used outputs are deleted to keep their total size under
+    # store_max_bytes, 0 meaning no cap, and to make room for reservations that don't fit. Outputs used in the last
+    # store_min_idle seconds are never evicted. Celery beat enforces the cap every store_eviction_interval seconds.
+    store_eviction_enabled: bool = True
+    store_max_bytes: int = 0
+    store_min_idle: int = 10 * 60
+    store_eviction_interval: int = 5 * 60
+
+    # Rate governor. Token buckets in Redis cap the requests and bytes per second sent to each proxy host and to all
+    # of them together, across every process, so that added workers stay under the proxies' throttling thresholds
+    # instead of bursting into 429s. A limit of 0 means no limit, and governor_burst seconds' worth of a limit can be
+    # used at once.
+    governor_enabled: bool = True
+    governor_redis_db: int = 8
+    governor_global_requests_per_second: float = 0
+    governor_global_bytes_per_second: int = 0
+    governor_proxy_requests_per_second: float = 10
+    governor_proxy_bytes_per_second: int = 0
+    governor_burst: float = 1.0
+    # Bytes taken from the byte buckets at a time as a body arrives
+    governor_byte_quantum: int = 1024 * 1024
+    # Seconds every process leaves a host alone after it throttles a request without a Retry-After
+    governor_throttle_backoff: float = 5.0
+
     default_proxy: str = "https://pipedapi.kavin.rocks"
 
     # Set piped proxy
@@ -51,6 +220,12 @@ class Settings(BaseSettings):
     class Config:
         env_file = ".env"
 
+    @model_validator(mode="after")
+    def set_catalog_path(self) -> "Settings":
+        if self.catalog_path is None:
+            self.catalog_path = f"{self.download_path}/catalog.sqlite3"
+        return self
+
 
 class TestSettings(BaseSettings):
     """
@@ -64,5 +239,25 @@ class TestSettings(BaseSettings):
     invalid_video_id: str = "invalid_video_id"
     valid_video_id: str = "valid_video_id"
 
+    # Stand-in Piped server used by the benchmarks. Its API answers after fake_piped_latency seconds, and media
+    # responses are capped at fake_piped_bandwidth bytes per second each, 0 meaning uncapped.
+    fake_piped_host: str = "127.0.0.1"
+    fake_piped_port: int = 8070
+    fake_piped_latency: float = 0.05
+    fake_piped_bandwidth: int = 0
+    # Share of API and media requests answered with a 503
+    fake_piped_failure_rate: float = 0.0
+    # Requests per second over which requests are answered with a 429, as a throttling proxy would. 0 means no limit.
+    fake_piped_requests_per_second: float = 0
+    # Answer Range requests with a 206. When off, the full body is always sent.
+    fake_piped_range_support: bool = True
+    # Length in seconds of the generated test media, and videos per playlist and playlist page
+    fake_piped_media_duration: int = 30
+    fake_piped_playlist_size: int = 20
+    fake_piped_page_size: int = 10
+
+    # Directory benchmark results are written to, one JSON file per run
+    benchmark_results_path: str = "benchmarks/results"
+
     class Config:
         env_file = ".env.test"
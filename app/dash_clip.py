@@ -0,0 +1,291 @@
+import os
+import struct
+from bisect import bisect_right
+from threading import Event
+from typing import List, NamedTuple, Optional, Tuple
+
+import ffmpeg
+import httpx
+
+from app.governor import REQUESTS, check_throttled, rate_governor
+from app.helper_classes import DownloadCancelledException
+from app.http_client import get_download_client
+from app.metrics import TRANSFER_BYTES, metrics
+from app.range_download import CHUNK_SIZE
+
+# WebM (Matroska) element IDs, with their length markers
+SEGMENT_ID = 0x18538067
+INFO_ID = 0x1549A966
+TIMECODE_SCALE_ID = 0x2AD7B1
+CUES_ID = 0x1C53BB6B
+CUE_POINT_ID = 0xBB
+CUE_TIME_ID = 0xB3
+CUE_TRACK_POSITIONS_ID = 0xB7
+CUE_CLUSTER_POSITION_ID = 0xF1
+
+
+class UnsupportedIndexException(Exception):
+    """
+    Exception raised when a stream's index can't be used to locate fragments.
+    """
+
+    pass
+
+
+def is_clip(start: Optional[float], end: Optional[float]) -> bool:
+    return bool(start) or end is not None
+
+
+def get_clip_key(start: Optional[float], end: Optional[float]) -> str:
+    """
+    Short description of a clip's time window, used to tell its outputs apart. Empty when the whole video is
+    downloaded.
+    """
+    if not is_clip(start, end):
+        return ""
+    return f"{start or 0:g}-{end:g}" if end is not None else f"{start:g}-end"
+
+
+def get_payload_clip(payload: dict) -> Tuple[Optional[float], Optional[float]]:
+    return payload.get("start"), payload.get("end")
+
+
+def get_clip_fraction(duration: Optional[float], start: Optional[float], end: Optional[float]) -> float:
+    """
+    Share of a video's length a clip covers, 1 when the duration is unknown.
+    """
+    if not is_clip(start, end) or not duration:
+        return 1.0
+    length = min(end if end is not None else duration, duration) - (start or 0)
+    return max(length, 0) / duration
+
+
+class Fragment(NamedTuple):
+    start_time: float
+    offset: int
+    # Inclusive end offset, None when the fragment runs to the end of the file
+    end: Optional[int]
+
+
+def fetch_bytes(url: str, start: int, end: int) -> bytes:
+    rate_governor.acquire(REQUESTS, url)
+    response = get_download_client().get(url, headers={"Range": f"bytes={start}-{end}"})
+    check_throttled(response, url)
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise UnsupportedIndexException("Server doesn't honour Range requests")
+    return response.content
+
+
+def parse_sidx(data: bytes, sidx_end: int) -> List[Fragment]:
+    """
+    Parses an ISO BMFF sidx box. sidx_end is the file offset right after the box, which fragment offsets are relative
+    to.
+    """
+    _, box_type = struct.unpack_from(">I4s", data, 0)
+    if box_type != b"sidx":
+        raise UnsupportedIndexException(f"Expected a sidx box, got {box_type!r}")
+    version = data[8]
+    timescale = struct.unpack_from(">I", data, 16)[0]
+    if version == 0:
+        earliest_time, first_offset = struct.unpack_from(">II", data, 20)
+        pos = 28
+    else:
+        earliest_time, first_offset = struct.unpack_from(">QQ", data, 20)
+        pos = 36
+    reference_count = struct.unpack_from(">H", data, pos + 2)[0]
+    pos += 4
+
+    fragments = []
+    offset = sidx_end + first_offset
+    time = earliest_time
+    for _ in range(reference_count):
+        reference, duration = struct.unpack_from(">II", data, pos)
+        pos += 12
+        if reference >> 31:
+            raise UnsupportedIndexException("Hierarchical sidx indexes are not supported")
+        referenced_size = reference & 0x7FFFFFFF
+        fragments.append(Fragment(time / timescale, offset, offset + referenced_size - 1))
+        offset += referenced_size
+        time += duration
+    return fragments
+
+
+def read_vint(data: bytes, pos: int, keep_marker: bool = False) -> Tuple[Optional[int], int]:
+    """
+    Reads an EBML variable-length integer. Returns its value, None for an unknown size, and the position after it.
+    """
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise UnsupportedIndexException("Invalid EBML variable-length integer")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1 : pos + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, pos + length
+    return value, pos + length
+
+
+def iter_elements(data: bytes, start: int, end: int):
+    pos = start
+    while pos < end:
+        element_id, pos = read_vint(data, pos, keep_marker=True)
+        size, pos = read_vint(data, pos)
+        element_end = end if size is None else min(pos + size, end)
+        yield element_id, pos, element_end
+        pos = element_end
+
+
+def read_uint(data: bytes, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], "big")
+
+
+def parse_webm_init(data: bytes) -> Tuple[int, int]:
+    """
+    Returns the file offset of the Segment's data, which cue positions are relative to, and the timecode scale in
+    nanoseconds, from a WebM init segment.
+    """
+    timecode_scale = 1_000_000
+    for element_id, start, end in iter_elements(data, 0, len(data)):
+        if element_id != SEGMENT_ID:
+            continue
+        for child_id, child_start, child_end in iter_elements(data, start, end):
+            if child_id == INFO_ID:
+                for info_id, info_start, info_end in iter_elements(data, child_start, child_end):
+                    if info_id == TIMECODE_SCALE_ID:
+                        timecode_scale = read_uint(data, info_start, info_end)
+        return start, timecode_scale
+    raise UnsupportedIndexException("No Segment element in the WebM init segment")
+
+
+def parse_cues(data: bytes, segment_offset: int, timecode_scale: int) -> List[Fragment]:
+    """
+    Parses a WebM Cues element into one fragment per cued cluster.
+    """
+    cues = []
+    for element_id, start, end in iter_elements(data, 0, len(data)):
+        if element_id != CUES_ID:
+            raise UnsupportedIndexException("Expected a Cues element")
+        for cue_id, cue_start, cue_end in iter_elements(data, start, end):
+            if cue_id != CUE_POINT_ID:
+                continue
+            cue_time, cluster_position = None, None
+            for child_id, child_start, child_end in iter_elements(data, cue_start, cue_end):
+                if child_id == CUE_TIME_ID:
+                    cue_time = read_uint(data, child_start, child_end)
+                elif child_id == CUE_TRACK_POSITIONS_ID:
+                    for position_id, position_start, position_end in iter_elements(data, child_start, child_end):
+                        if position_id == CUE_CLUSTER_POSITION_ID:
+                            cluster_position = read_uint(data, position_start, position_end)
+            if cue_time is not None and cluster_position is not None:
+                cues.append((cue_time * timecode_scale / 1e9, segment_offset + cluster_position))
+
+    cues.sort(key=lambda cue: cue[1])
+    return [
+        Fragment(time, offset, cues[i + 1][1] - 1 if i + 1 < len(cues) else None)
+        for i, (time, offset) in enumerate(cues)
+    ]
+
+
+def get_fragments(stream) -> Tuple[bytes, List[Fragment]]:
+    """
+    Fetches a DASH stream's init segment and index, and returns the init bytes and the stream's fragments.
+    """
+    if stream.index_end is None or stream.index_end <= 0 or stream.init_end is None or stream.init_end <= 0:
+        raise UnsupportedIndexException("Stream has no index range")
+
+    init = fetch_bytes(stream.url, stream.init_start or 0, stream.init_end)
+    index = fetch_bytes(stream.url, stream.index_start, stream.index_end)
+    try:
+        if index[4:8] == b"sidx":
+            fragments = parse_sidx(index, stream.index_end + 1)
+        else:
+            segment_offset, timecode_scale = parse_webm_init(init)
+            fragments = parse_cues(index, segment_offset, timecode_scale)
+    except (struct.error, IndexError) as e:
+        raise UnsupportedIndexException(f"Malformed stream index: {e}")
+    if not fragments:
+        raise UnsupportedIndexException("Stream index has no fragments")
+    return init, fragments
+
+
+def select_fragments(fragments: List[Fragment], start: float, end: Optional[float]) -> List[Fragment]:
+    """
+    Returns the run of fragments covering [start, end). Fragments start on keyframes, so the first one begins at or
+    before start.
+    """
+    start_times = [fragment.start_time for fragment in fragments]
+    first = max(bisect_right(start_times, start) - 1, 0)
+    last = len(fragments) if end is None else max(bisect_right(start_times, end - 1e-6), first + 1)
+    return fragments[first:last]
+
+
+def fetch_range_to_file(url: str, f, start: int, end: Optional[int], cancel_event: Optional[Event] = None) -> None:
+    byte_range = f"bytes={start}-{end}" if end is not None else f"bytes={start}-"
+    rate_governor.acquire(REQUESTS, url, cancel_event=cancel_event)
+    with get_download_client().stream("GET", url, headers={"Range": byte_range}) as response:
+        check_throttled(response, url)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise httpx.HTTPError(f"Server ignored the Range request for {byte_range}")
+        transferred = 0
+        try:
+            for chunk in rate_governor.iter_bytes(url, response.iter_bytes(CHUNK_SIZE), cancel_event):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise DownloadCancelledException("Download cancelled")
+                f.write(chunk)
+                transferred += len(chunk)
+        finally:
+            metrics.inc(TRANSFER_BYTES, transferred, {"method": "clip"})
+
+
+def download_clip(
+    stream,
+    file_path: str,
+    start: Optional[float],
+    end: Optional[float],
+    file_format: str,
+    cancel_event: Optional[Event] = None,
+) -> str:
+    """
+    Downloads only the part of a DASH stream between start and end seconds into file_path.
+
+    The init segment and the index (an MP4 sidx box or WebM Cues) are fetched first to map the window to the byte
+    range of the fragments covering it. Those fragments are written after the init segment and then remuxed with
+    ffmpeg to cut the window out of them. Streams without a usable index are cut by ffmpeg straight from the URL,
+    which seeks with Range requests of its own.
+    """
+    # Imported here because Stream imports this module
+    from app.Stream import run_ffmpeg
+
+    start = start or 0.0
+    try:
+        init, fragments = get_fragments(stream)
+    except (UnsupportedIndexException, httpx.HTTPError):
+        fragments = None
+
+    if fragments is None:
+        source, offset = ffmpeg.input(stream.url, ss=start), start
+        fragments_path = None
+    else:
+        window = select_fragments(fragments, start, end)
+        fragments_path = f"{file_path}.fragments"
+        with open(fragments_path, "wb") as f:
+            f.write(init)
+            fetch_range_to_file(stream.url, f, window[0].offset, window[-1].end, cancel_event)
+        # The fragments keep their original timestamps, and ffmpeg seeks relative to the first one
+        source, offset = ffmpeg.input(fragments_path, ss=start - window[0].start_time), start
+
+    output_kwargs = {"t": end - offset} if end is not None else {}
+    try:
+        run_ffmpeg(
+            ffmpeg.output(source, file_path, format=file_format, c="copy", **output_kwargs).overwrite_output(),
+            cancel_event,
+        )
+    finally:
+        if fragments_path is not None and os.path.exists(fragments_path):
+            os.remove(fragments_path)
+    return file_path
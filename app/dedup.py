@@ -0,0 +1,122 @@
+import os
+import uuid
+from typing import Optional, Tuple
+
+from app.catalog import catalog
+from app.config import Settings
+from app.dash_clip import get_clip_key, get_payload_clip
+from app.helper_classes import Status
+from app.metrics import DEDUP_REQUESTS, metrics
+from app.redis_client import get_redis
+from app.stream_policy import get_output_name, get_payload_policy
+from app.transcode import get_payload_codecs, get_transcode_key
+
+settings = Settings()
+
+# Deletes a claim only if it still belongs to the given task, so a task can't release a newer claim
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_job_format(mode: str, payload: dict) -> str:
+    """
+    Returns the output format a download payload produces. Audio downloads keep the stream's own container, and
+    transcodes, a non-default stream policy and a clip are told apart by their encoders, key and time window.
+    """
+    format_out = "native" if mode == "audio" else payload.get("format_out", "mp4")
+    transcode_key = get_transcode_key(*get_payload_codecs(payload))
+    if transcode_key:
+        format_out = f"{format_out}.{transcode_key}"
+    policy_key = get_payload_policy(payload).key
+    if policy_key:
+        format_out = f"{format_out}+{policy_key}"
+    clip_key = get_clip_key(*get_payload_clip(payload))
+    return f"{format_out}@{clip_key}" if clip_key else format_out
+
+
+def get_job_output_name(payload: dict) -> str:
+    """
+    File name of the final output of an audio and video download payload.
+    """
+    return get_output_name(
+        payload["video_id"],
+        get_payload_policy(payload),
+        *get_payload_clip(payload),
+        get_transcode_key(*get_payload_codecs(payload)),
+    )
+
+
+def get_job_key(video_id: str, mode: str, format_out: str) -> str:
+    return f"{mode}:{format_out}:{video_id}"
+
+
+def get_completed_output(video_id: str, mode: str, format_out: str) -> Optional[str]:
+    """
+    Returns the output path of a finished download of this job, if the catalog has one and it is still on disk.
+    """
+    entry = catalog.lookup(video_id, mode, format_out)
+    if entry is None:
+        return None
+    if not os.path.exists(entry["path"]):
+        catalog.remove(entry["path"])
+        return None
+    catalog.touch(entry["path"])
+    return entry["path"]
+
+
+def mark_completed(video_id: str, mode: str, format_out: str, output_path: str, details: Optional[dict] = None) -> None:
+    """
+    Records a finished download in the catalog. details carries the title, duration and itags of the output.
+    """
+    catalog.record(video_id, mode, format_out, output_path, **(details or {}))
+
+
+def claim_job(video_id: str, mode: str, format_out: str) -> Tuple[str, bool]:
+    """
+    Single-flight lock for a job. Returns a new task ID and True if the caller now owns the job, or the ID of the
+    task already running it and False.
+    """
+    client = get_redis(settings.dedup_redis_db)
+    key = f"vidyodl:inflight:{get_job_key(video_id, mode, format_out)}"
+    task_id = str(uuid.uuid4())
+    while True:
+        if client.set(key, task_id, nx=True, ex=settings.dedup_lock_ttl):
+            return task_id, True
+        existing_task_id = client.get(key)
+        # The claim may have been released between SET and GET, in which case try again
+        if existing_task_id is not None:
+            return existing_task_id.decode(), False
+
+
+def release_job(video_id: str, mode: str, format_out: str, task_id: str) -> None:
+    client = get_redis(settings.dedup_redis_db)
+    client.eval(RELEASE_SCRIPT, 1, f"vidyodl:inflight:{get_job_key(video_id, mode, format_out)}", task_id)
+
+
+def prepare_job(video_id: str, mode: str, format_out: str, build_signature) -> Tuple[dict, Optional[object]]:
+    """
+    Deduplicates a download before it is enqueued.
+
+    Returns the response for the caller and the signature to publish, built by build_signature from the claimed task
+    ID, or None when nothing needs publishing because the output already exists or another task is running the same
+    job.
+    """
+    if not settings.dedup_enabled:
+        task_id = str(uuid.uuid4())
+        return {"status": Status.OK, "info": task_id}, build_signature(task_id)
+
+    completed_path = get_completed_output(video_id, mode, format_out)
+    if completed_path is not None:
+        metrics.inc(DEDUP_REQUESTS, labels={"result": "completed"})
+        return {"status": Status.OK, "info": completed_path, "completed": True}, None
+
+    task_id, claimed = claim_job(video_id, mode, format_out)
+    if not claimed:
+        metrics.inc(DEDUP_REQUESTS, labels={"result": "duplicate"})
+        return {"status": Status.OK, "info": task_id, "duplicate": True}, None
+    metrics.inc(DEDUP_REQUESTS, labels={"result": "new"})
+    return {"status": Status.OK, "info": task_id}, build_signature(task_id)
@@ -1,99 +1,556 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from threading import Event
+from typing import AsyncIterator, Callable, List, Optional
+
 import ffmpeg
-from pytube import Playlist
 
 from app import config
-from app.helper_classes import Status
-from app.Piped import Piped
+from app.governor import REQUESTS, rate_governor
+from app.helper_classes import DownloadCancelledException, Status
+from app.metrics import JobProgress
+from app.Piped import AsyncPiped, Piped
+from app.PipedPlaylist import PipedPlaylist
+from app.proxy_functions import release_proxy
+from app.proxy_registry import proxy_registry
+from app.range_download import download_to_pipe
+from app.storage import remove_intermediates
+from app.Stream import run_ffmpeg, run_ffmpeg_async
+from app.stream_policy import CONTAINER_FORMATS, StreamPolicy, get_output_name
+from app.transcode import is_chunked_transcode, transcode_chunked
 
 settings = config.Settings()
 
 path = settings.download_path
 
+# Output options that let a container be written to a pipe and played while it is still being written
+STREAMABLE_OUTPUT_KWARGS = {"mp4": {"movflags": "frag_keyframe+empty_moov+default_base_moof"}}
+
+TEE_CHUNK_SIZE = 256 * 1024
 
-def get_youtube_video_list_from_playlist(playlist_id: str) -> list:
-    playlist = Playlist(f"https://www.youtube.com/playlist?list={playlist_id}")
 
-    return playlist.videos
+def get_intermediate_name(
+    video_id: str,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    transcode_key: str = "",
+) -> str:
+    """
+    File name of the streams an audio and video download fetches before muxing them. It names the container and the
+    encoders too, so jobs that only differ in those never share their stream files, and an audio stream fetched for a
+    mux never takes the place of an audio-only download's output.
+    """
+    return f"{get_output_name(video_id, policy, start, end, transcode_key)}-av-{format_out}"
 
 
-def download_piped_video(video_id: str) -> dict:
+def download_piped_video(
+    video_id: str,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    job: Optional[JobProgress] = None,
+    transcode_key: str = "",
+) -> dict:
     try:
-        download_response = download_av_from_piped(video_id)
+        download_response = download_av_from_piped(video_id, format_out, policy, start, end, job, transcode_key)
         return {
             "status": Status.OK,
             "audio_path": download_response["audio_path"],
             "video_path": download_response["video_path"],
             "title": download_response["title"],
+            "timings": download_response["timings"],
+            "details": download_response["details"],
         }
     except Exception as e:
         return {"status": Status.ERROR, "error": str(e)}
 
 
-def download_youtube_playlist(playlist_id: str, path: str) -> None:
-    playlist = Playlist(f"https://www.youtube.com/playlist?list={playlist_id}")
+def download_youtube_playlist(playlist_id: str) -> None:
+    for video_ids in PipedPlaylist(playlist_id).iter_video_ids():
+        for video_id in video_ids:
+            download_result = download_piped_video(video_id)
+            if download_result["status"] == Status.ERROR:
+                raise Exception(download_result["error"])
+            audio_path, video_path = download_result["audio_path"], download_result["video_path"]
+            combine_result = combine_audio_video(audio_path, video_path, video_id)
+            if combine_result["status"] == Status.ERROR:
+                raise Exception(combine_result["error"])
 
-    for video in playlist.videos:
-        download_result = download_piped_video(video.video_id, path)
-        audio_path, video_path, video_title = (
-            download_result["audio_path"],
-            download_result["video_path"],
-            download_result["title"],
-        )
-        combine_audio_video(audio_path, video_path, video_title, path)
+
+def get_completed_path(file_name: str, format_out: str) -> str:
+    return f"{path}/completed/{file_name}.{format_out}"
+
+
+def build_combine_output(
+    audio_path: str,
+    video_path: str,
+    file_name: str,
+    format_out: str = "mp4",
+    vcodec_out: str = "copy",
+    acodec_out: str = "copy",
+):
+    audio_input = ffmpeg.input(audio_path)
+    video_input = ffmpeg.input(video_path)
+    return ffmpeg.output(
+        audio_input,
+        video_input,
+        get_completed_path(file_name, format_out),
+        format=CONTAINER_FORMATS.get(format_out, format_out),
+        vcodec=vcodec_out,
+        acodec=acodec_out,
+        strict="experimental",
+    ).overwrite_output()
 
 
 def combine_audio_video(
     audio_path: str,
     video_path: str,
-    title: str,
+    file_name: str,
     format_out: str = "mp4",
     vcodec_out: str = "copy",
     acodec_out: str = "copy",
+    job: Optional[JobProgress] = None,
 ) -> dict:
+    """
+    Muxes audio and video into the completed output, as the job's mux stage. Video encodes are split into segments
+    that are encoded in parallel, as its transcode stage, and report the segments done as they finish. The audio and
+    video files are deleted once the output is written.
+    """
+    job = job or JobProgress()
+    output_path = get_completed_path(file_name, format_out)
     try:
-        audio_input = ffmpeg.input(audio_path)
-        video_input = ffmpeg.input(video_path)
-        ffmpeg.output(
-            audio_input,
-            video_input,
-            f"{path}/completed/{title}.{format_out}",
-            format=format_out,
-            vcodec=vcodec_out,
-            acodec=acodec_out,
+        if is_chunked_transcode(vcodec_out):
+            with job.stage("transcode"):
+                transcode_chunked(
+                    audio_path,
+                    video_path,
+                    output_path,
+                    format_out,
+                    vcodec_out,
+                    acodec_out,
+                    lambda segments_done, segments_total: job.update(
+                        segments_done=segments_done, segments_total=segments_total, done=segments_done == segments_total
+                    ),
+                )
+        else:
+            with job.stage("mux"):
+                run_ffmpeg(
+                    build_combine_output(audio_path, video_path, file_name, format_out, vcodec_out, acodec_out),
+                    progress=lambda report: job.update(**report),
+                )
+    except Exception as e:
+        return {"status": Status.ERROR, "error": str(e)}
+    remove_intermediates(audio_path, video_path)
+    return {"status": Status.OK, "info": output_path}
+
+
+async def async_combine_audio_video(
+    audio_path: str,
+    video_path: str,
+    file_name: str,
+    format_out: str = "mp4",
+    vcodec_out: str = "copy",
+    acodec_out: str = "copy",
+) -> dict:
+    job = JobProgress()
+    output_path = get_completed_path(file_name, format_out)
+    try:
+        if is_chunked_transcode(vcodec_out):
+            with job.stage("transcode"):
+                await asyncio.to_thread(
+                    transcode_chunked, audio_path, video_path, output_path, format_out, vcodec_out, acodec_out
+                )
+        else:
+            with job.stage("mux"):
+                await run_ffmpeg_async(
+                    build_combine_output(audio_path, video_path, file_name, format_out, vcodec_out, acodec_out)
+                )
+    except Exception as e:
+        return {"status": Status.ERROR, "error": str(e)}
+    remove_intermediates(audio_path, video_path)
+    return {"status": Status.OK, "info": output_path}
+
+
+def mux_av_from_piped(
+    video_id: str,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    job: Optional[JobProgress] = None,
+) -> dict:
+    """
+    Downloads and muxes a video in one pass.
+
+    Both stream bodies are written into named pipes that a single ffmpeg process reads from, so only the
+    completed container is written to disk. The fetches and the mux overlap, so they are timed as one mux stage.
+    """
+    job = job or JobProgress()
+    pipe_dir = tempfile.mkdtemp(prefix="vidyodl-")
+    audio_pipe = os.path.join(pipe_dir, "audio")
+    video_pipe = os.path.join(pipe_dir, "video")
+    cancel_event = Event()
+
+    try:
+        piped_obj = Piped(video_id)
+
+        with job.stage("metadata"):
+            audio_stream, video_stream = piped_obj.get_streams(policy, format_out)
+
+        os.mkfifo(audio_pipe)
+        os.mkfifo(video_pipe)
+
+        output_path = f"{path}/completed/{get_output_name(video_id, policy)}.{format_out}"
+        output = ffmpeg.output(
+            ffmpeg.input(audio_pipe),
+            ffmpeg.input(video_pipe),
+            output_path,
+            format=CONTAINER_FORMATS.get(format_out, format_out),
+            vcodec="copy",
+            acodec="copy",
             strict="experimental",
-        ).overwrite_output().run()
+        ).overwrite_output()
+
+        def feed(url: str, pipe_path: str) -> None:
+            try:
+                download_to_pipe(url, pipe_path, cancel_event)
+            except Exception:
+                cancel_event.set()
+                raise
+
+        mux_error = None
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            feeders = [
+                executor.submit(feed, audio_stream.url, audio_pipe),
+                executor.submit(feed, video_stream.url, video_pipe),
+            ]
+            try:
+                with job.stage("mux"):
+                    run_ffmpeg(output, cancel_event, lambda report: job.update(**report))
+            except Exception as e:
+                mux_error = e
+                # Stops any feeder still waiting for ffmpeg to open its pipe
+                cancel_event.set()
+
+        # A feeder's own failure is more useful than ffmpeg dying because its input went away
+        for feeder in feeders:
+            error = feeder.exception()
+            if error is not None and not isinstance(error, (DownloadCancelledException, BrokenPipeError)):
+                raise error
+        if mux_error is not None:
+            raise mux_error
     except Exception as e:
         return {"status": Status.ERROR, "error": str(e)}
-    return {"status": Status.OK, "info": f"{path}/{title}.{format_out}"}
+    finally:
+        shutil.rmtree(pipe_dir, ignore_errors=True)
 
+    return {
+        "status": Status.OK,
+        "info": output_path,
+        "details": get_output_details(piped_obj, audio_stream, video_stream),
+    }
 
-def download_av_from_piped(video_id: str) -> dict:
-    piped_obj = Piped(video_id)
 
-    audio_stream = piped_obj.get_best_audio_stream()
-    video_stream = piped_obj.get_best_video_stream()
+async def async_tee_av_from_piped(
+    video_id: str, format_out: str = "mp4", on_finish: Optional[Callable[[dict], None]] = None
+) -> AsyncIterator[bytes]:
+    """
+    Starts a one-pass download of a video and returns an iterator over the output's bytes as ffmpeg writes them, so
+    a client can play the video while it downloads.
 
-    audio_path = piped_obj.download_audio_stream(audio_stream)
-    video_path = piped_obj.download_video_stream(video_stream)
+    The bytes are also written to a .part file, which becomes the completed output once ffmpeg exits cleanly and is
+    discarded otherwise, including when the client goes away. on_finish is then called with the result of the
+    download. ffmpeg only starts once the iterator is, so an iterator closed before it started leaves nothing behind
+    but never calls on_finish.
+    """
+    piped_obj = AsyncPiped(video_id)
+    await piped_obj.load()
+    audio_stream, video_stream = piped_obj.get_streams(None, format_out)
 
-    return {"audio_path": audio_path, "video_path": video_path, "title": piped_obj.title}
+    output = ffmpeg.output(
+        ffmpeg.input(audio_stream.url),
+        ffmpeg.input(video_stream.url),
+        "pipe:1",
+        format=CONTAINER_FORMATS.get(format_out, format_out),
+        vcodec="copy",
+        acodec="copy",
+        strict="experimental",
+        **STREAMABLE_OUTPUT_KWARGS.get(format_out, {}),
+    )
+    details = get_output_details(piped_obj, audio_stream, video_stream)
+    return iter_tee_transfer(
+        piped_obj,
+        [audio_stream.url, video_stream.url],
+        output.compile(),
+        get_completed_path(video_id, format_out),
+        details,
+        on_finish,
+    )
 
 
-def download_video_from_piped(video_id: str) -> dict:
-    piped_obj = Piped(video_id)
+async def iter_tee_transfer(
+    piped_obj: AsyncPiped,
+    urls: List[str],
+    args: List[str],
+    output_path: str,
+    details: dict,
+    on_finish: Optional[Callable[[dict], None]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Runs a tee's ffmpeg under the same limits as the other downloads: it holds a slot on the proxy that resolved the
+    stream URLs and takes a request token for each URL ffmpeg opens. Byte tokens are taken for the output, which a
+    stream copy keeps about the size of what ffmpeg fetches, and waiting for them stops reading ffmpeg's output,
+    which in turn stops it fetching.
+    """
+    acquired = await asyncio.to_thread(
+        proxy_registry.try_acquire, piped_obj.proxy.url, settings.proxy_max_concurrency, True
+    )
+    try:
+        for url in urls:
+            await rate_governor.async_acquire(REQUESTS, url)
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        output = iter_tee_output(process, output_path, details, on_finish)
+        # Closing the tee right away, rather than once it is garbage collected, stops ffmpeg and calls on_finish
+        async with aclosing(output), aclosing(rate_governor.async_iter_bytes(urls[-1], output)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+    finally:
+        await asyncio.to_thread(release_proxy, piped_obj.proxy, acquired)
 
-    video_stream = piped_obj.get_best_video_stream()
 
-    video_path = piped_obj.download_video_stream(video_stream)
+async def iter_tee_output(
+    process: asyncio.subprocess.Process,
+    output_path: str,
+    details: dict,
+    on_finish: Optional[Callable[[dict], None]] = None,
+) -> AsyncIterator[bytes]:
+    part_path = f"{output_path}.part"
+    try:
+        with open(part_path, "wb") as f:
+            while True:
+                chunk = await process.stdout.read(TEE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await asyncio.to_thread(f.write, chunk)
+                yield chunk
+        if await process.wait() != 0:
+            raise ffmpeg.Error("ffmpeg", None, None)
+        os.replace(part_path, output_path)
+    except BaseException as e:
+        # Also reached when the client disconnects and the generator is cancelled or closed
+        if process.returncode is None:
+            process.kill()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        if on_finish is not None:
+            # Once started, the thread finishes the call even if the await is cancelled again
+            await asyncio.to_thread(on_finish, {"status": Status.ERROR, "error": str(e) or type(e).__name__})
+        raise
 
-    return {"video_path": video_path, "title": piped_obj.title}
+    if on_finish is not None:
+        await asyncio.to_thread(on_finish, {"status": Status.OK, "info": output_path, "details": details})
+
+
+def get_output_details(piped_obj, audio_stream=None, video_stream=None) -> dict:
+    """
+    Describes a finished download for the media catalog.
+    """
+    return {
+        "title": piped_obj.title,
+        "duration": piped_obj.duration,
+        "audio_itag": audio_stream.itag if audio_stream is not None else None,
+        "video_itag": video_stream.itag if video_stream is not None else None,
+    }
+
+
+def download_av_from_piped(
+    video_id: str,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    job: Optional[JobProgress] = None,
+    transcode_key: str = "",
+) -> dict:
+    """
+    Downloads the audio and video streams of a video, or with start or end, only the clip between those times. The
+    metadata resolve and the two fetches are timed as stages of the job.
+    """
+    job = job or JobProgress()
+    piped_obj = Piped(video_id, get_intermediate_name(video_id, format_out, policy, start, end, transcode_key))
+
+    with job.stage("metadata"):
+        audio_stream, video_stream = piped_obj.get_streams(policy, format_out)
+
+    if not settings.concurrent_av_download:
+        with job.stage("audio"):
+            audio_path = piped_obj.download_audio_stream(audio_stream, starting=start, ending=end)
+
+        with job.stage("video"):
+            video_path = piped_obj.download_video_stream(video_stream, starting=start, ending=end)
+
+        return {
+            "audio_path": audio_path,
+            "video_path": video_path,
+            "title": piped_obj.title,
+            "timings": job.timings,
+            "details": get_output_details(piped_obj, audio_stream, video_stream),
+        }
+
+    # Both fetches share one event so a failure in either stops the other
+    cancel_event = Event()
+
+    def timed_download(name: str, download_func, stream) -> str:
+        with job.stage(name):
+            try:
+                return download_func(stream, cancel_event=cancel_event, starting=start, ending=end)
+            except Exception:
+                cancel_event.set()
+                raise
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        audio_future = executor.submit(timed_download, "audio", piped_obj.download_audio_stream, audio_stream)
+        video_future = executor.submit(timed_download, "video", piped_obj.download_video_stream, video_stream)
+
+    errors = [future.exception() for future in (audio_future, video_future) if future.exception() is not None]
+    if errors:
+        # Surface the original failure rather than the sibling's cancellation
+        raise next((error for error in errors if not isinstance(error, DownloadCancelledException)), errors[0])
+
+    return {
+        "audio_path": audio_future.result(),
+        "video_path": video_future.result(),
+        "title": piped_obj.title,
+        "timings": job.timings,
+        "details": get_output_details(piped_obj, audio_stream, video_stream),
+    }
+
+
+def download_video_from_piped(
+    video_id: str,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    job: Optional[JobProgress] = None,
+    transcode_key: str = "",
+) -> dict:
+    job = job or JobProgress()
+    piped_obj = Piped(video_id, get_intermediate_name(video_id, format_out, policy, start, end, transcode_key))
+
+    with job.stage("metadata"):
+        video_stream = piped_obj.get_best_video_stream(policy, format_out)
+
+    with job.stage("video"):
+        video_path = piped_obj.download_video_stream(video_stream, starting=start, ending=end)
+
+    return {
+        "video_path": video_path,
+        "title": piped_obj.title,
+        "timings": job.timings,
+        "details": get_output_details(piped_obj, None, video_stream),
+    }
+
+
+def download_audio_from_piped(
+    video_id: str,
+    format_out: Optional[str] = None,
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    job: Optional[JobProgress] = None,
+    transcode_key: str = "",
+) -> dict:
+    """
+    Downloads the audio stream of a video. With format_out, it is the audio of the pair an audio and video download
+    into that container picks, fetched for that download's mux.
+    """
+    job = job or JobProgress()
+    if format_out is None:
+        file_name = get_output_name(video_id, policy, start, end)
+    else:
+        file_name = get_intermediate_name(video_id, format_out, policy, start, end, transcode_key)
+    piped_obj = Piped(video_id, file_name)
+
+    with job.stage("metadata"):
+        audio_stream = piped_obj.get_best_audio_stream(policy, format_out)
+
+    with job.stage("audio"):
+        audio_path = piped_obj.download_audio_stream(audio_stream, starting=start, ending=end)
+
+    return {
+        "audio_path": audio_path,
+        "title": piped_obj.title,
+        "timings": job.timings,
+        "details": get_output_details(piped_obj, audio_stream),
+    }
+
+
+async def async_download_av_from_piped(
+    video_id: str,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    transcode_key: str = "",
+) -> dict:
+    job = JobProgress()
+    piped_obj = AsyncPiped(video_id, get_intermediate_name(video_id, format_out, policy, start, end, transcode_key))
+    with job.stage("metadata"):
+        await piped_obj.load()
+
+    audio_stream, video_stream = piped_obj.get_streams(policy, format_out)
+
+    async def timed_download(name: str, download_func, stream) -> str:
+        with job.stage(name):
+            return await download_func(stream, starting=start, ending=end)
+
+    # The task group cancels the sibling download as soon as one of them fails
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            audio_task = task_group.create_task(timed_download("audio", piped_obj.download_audio_stream, audio_stream))
+            video_task = task_group.create_task(timed_download("video", piped_obj.download_video_stream, video_stream))
+    except ExceptionGroup as e:
+        raise e.exceptions[0] from None
+
+    return {
+        "audio_path": audio_task.result(),
+        "video_path": video_task.result(),
+        "title": piped_obj.title,
+        "timings": job.timings,
+        "details": get_output_details(piped_obj, audio_stream, video_stream),
+    }
+
+
+async def async_download_audio_from_piped(
+    video_id: str, policy: Optional[StreamPolicy] = None, start: Optional[float] = None, end: Optional[float] = None
+) -> dict:
+    job = JobProgress()
+    piped_obj = AsyncPiped(video_id, get_output_name(video_id, policy, start, end))
+    with job.stage("metadata"):
+        await piped_obj.load()
 
+    audio_stream = piped_obj.get_best_audio_stream(policy)
 
-def download_audio_from_piped(video_id: str) -> dict:
-    piped_obj = Piped(video_id)
+    with job.stage("audio"):
+        audio_path = await piped_obj.download_audio_stream(audio_stream, starting=start, ending=end)
 
-    audio_stream = piped_obj.get_best_audio_stream()
+    return {"audio_path": audio_path, "title": piped_obj.title, "details": get_output_details(piped_obj, audio_stream)}
 
-    audio_path = piped_obj.download_audio_stream(audio_stream)
 
-    return {"audio_path": audio_path, "title": piped_obj.title}
+async def async_download_youtube_playlist(playlist_id: str) -> None:
+    async for video_ids in PipedPlaylist(playlist_id).async_iter_video_ids():
+        for video_id in video_ids:
+            download_result = await async_download_av_from_piped(video_id)
+            combine_result = await async_combine_audio_video(
+                download_result["audio_path"], download_result["video_path"], video_id
+            )
+            if combine_result["status"] == Status.ERROR:
+                raise Exception(combine_result["error"])
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, FrozenSet, NamedTuple, Optional, Set
+
+import redis
+
+from app.config import Settings
+from app.redis_client import get_async_redis, get_redis
+
+settings = Settings()
+
+CHANNEL_PREFIX = "vidyodl:events"
+
+# Pub/sub channels aren't scoped to a database, so events go through the broker's
+EVENTS_DB = settings.celery_broker_db
+
+# Seconds the listener waits before reconnecting after losing Redis
+RECONNECT_DELAY = 1.0
+
+
+def get_event_channel(client: str) -> str:
+    return f"{CHANNEL_PREFIX}:{client}"
+
+
+def publish_event(event: str, task_id: str, payload: Optional[dict] = None, **data) -> None:
+    """
+    Publishes a job event: progress, success or failure of the task with the given ID. The client and group that
+    subscribers filter on come from the job's payload. Events are best effort and never fail the task.
+    """
+    if not settings.events_enabled:
+        return
+    payload = payload or {}
+    message = {
+        "event": event,
+        "task_id": task_id,
+        "video_id": payload.get("video_id") or payload.get("playlist_id"),
+        "client": payload.get("client"),
+        "group": payload.get("group"),
+        "time": time.time(),
+        **data,
+    }
+    try:
+        get_redis(EVENTS_DB).publish(
+            get_event_channel(message["client"] or "default"), json.dumps(message, default=str)
+        )
+    except redis.RedisError:
+        pass
+
+
+class EventFilter(NamedTuple):
+    """
+    Which events a subscriber gets: those of any of its tasks, groups or clients, or every event if it names none.
+    """
+
+    task_ids: FrozenSet[str] = frozenset()
+    groups: FrozenSet[str] = frozenset()
+    clients: FrozenSet[str] = frozenset()
+
+    def matches(self, message: dict) -> bool:
+        if not (self.task_ids or self.groups or self.clients):
+            return True
+        return (
+            message.get("task_id") in self.task_ids
+            or message.get("group") in self.groups
+            or message.get("client") in self.clients
+        )
+
+
+class Subscription:
+    """
+    Buffer of the events matching one subscriber's filter. When the subscriber falls behind by events_buffer_size
+    events, the oldest are dropped, and the next read returns a dropped event with their count instead, so the
+    subscriber knows to look up the state of its tasks.
+    """
+
+    def __init__(self, event_filter: EventFilter):
+        self.filter = event_filter
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.events_buffer_size)
+        self.dropped = 0
+
+    def put(self, message: dict) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """
+        Returns the next event, or None if none arrives within timeout seconds.
+        """
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            return {"event": "dropped", "count": dropped}
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBroker:
+    """
+    Fans job events out to the subscribers of one API process.
+
+    The process holds a single pattern subscription on every event channel, started with the first subscriber, and
+    matches each event against every subscriber's filter in memory, so the number of subscribers adds no Redis
+    connections or load. If Redis goes away the listener reconnects and sends every subscriber a reconnected event,
+    as events published in between are lost.
+    """
+
+    def __init__(self):
+        self._subscriptions: Set[Subscription] = set()
+        self._listener: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+
+    async def subscribe(self, event_filter: EventFilter) -> Subscription:
+        """
+        Adds a subscriber. Returns once the listener is subscribed, so no event published afterwards is missed.
+        """
+        subscription = Subscription(event_filter)
+        self._subscriptions.add(subscription)
+        if self._listener is None or self._listener.done():
+            self._ready.clear()
+            self._listener = asyncio.create_task(self._listen())
+        try:
+            await asyncio.wait_for(self._ready.wait(), settings.redis_socket_timeout)
+        except asyncio.TimeoutError:
+            # Redis is unreachable; live events arrive once the listener connects
+            pass
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+
+    async def _listen(self) -> None:
+        reconnecting = False
+        while True:
+            client = get_async_redis(EVENTS_DB)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(f"{CHANNEL_PREFIX}:*")
+                    self._ready.set()
+                    if reconnecting:
+                        # Subscribers may have missed events while the listener was away
+                        for subscription in list(self._subscriptions):
+                            subscription.put({"event": "reconnected"})
+                    async for message in pubsub.listen():
+                        if message["type"] != "pmessage":
+                            continue
+                        event = json.loads(message["data"])
+                        for subscription in list(self._subscriptions):
+                            if subscription.filter.matches(event):
+                                subscription.put(event)
+            except (redis.RedisError, OSError, ValueError):
+                self._ready.clear()
+                reconnecting = True
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                await client.aclose()
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+
+def get_state_events(statuses: Dict[str, dict]) -> list:
+    """
+    Events describing the current state of tasks, sent to a new subscriber before live events so it can't miss a
+    task that finished before it subscribed.
+    """
+    return [
+        {"event": "state", "task_id": task_id, "state": status["state"], "result": status["result"]}
+        for task_id, status in statuses.items()
+    ]
+
+
+def format_sse(message: dict) -> str:
+    return f"event: {message['event']}\ndata: {json.dumps(message, default=str)}\n\n"
+
+
+async def iter_sse(
+    broker: EventBroker, subscription: Subscription, initial_events: Optional[list] = None
+) -> AsyncIterator[str]:
+    """
+    Yields a subscription's events in the Server-Sent Events format, with a comment line as a keepalive whenever no
+    event arrives for events_heartbeat_interval seconds.
+    """
+    try:
+        for message in initial_events or []:
+            yield format_sse(message)
+        while True:
+            message = await subscription.get(settings.events_heartbeat_interval)
+            yield ": keepalive\n\n" if message is None else format_sse(message)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+event_broker = EventBroker()
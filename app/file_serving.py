@@ -0,0 +1,178 @@
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Mapping, Optional, Tuple
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from app.catalog import catalog
+
+# Bytes read per chunk when the server can't send the file itself
+CHUNK_SIZE = 1024 * 1024
+
+CONTENT_TYPES = {".mkv": "video/x-matroska", ".webm": "video/webm", ".mp4": "video/mp4", ".m4a": "audio/mp4"}
+
+
+class RangeNotSatisfiableException(Exception):
+    """
+    Exception raised when the range a client asked for starts past the end of the file.
+    """
+
+    pass
+
+
+def get_served_entry(video_id: str, mode: str, format_out: Optional[str] = None) -> Optional[dict]:
+    """
+    Returns the catalog entry of the output to serve for a video: the one with the given job format, or the newest
+    one of the mode. Entries whose file is gone are dropped from the catalog, and the served one is marked as used.
+    """
+    if format_out is not None:
+        entries = [entry for entry in [catalog.lookup(video_id, mode, format_out)] if entry is not None]
+    else:
+        entries = sorted(
+            (entry for entry in catalog.list_for_video(video_id) if entry["mode"] == mode),
+            key=lambda entry: entry["created_at"],
+            reverse=True,
+        )
+    for entry in entries:
+        if os.path.exists(entry["path"]):
+            catalog.touch(entry["path"])
+            return entry
+        catalog.remove(entry["path"])
+    return None
+
+
+def get_etag(entry: dict, stat: os.stat_result) -> str:
+    """
+    Strong ETag from the catalog's SHA-256 of the file when it still describes the file on disk, otherwise a weak one
+    from its size and modification time.
+    """
+    if entry.get("checksum") and entry.get("size") == stat.st_size:
+        return f'"{entry["checksum"]}"'
+    return f'W/"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, which ignores the W/ prefix
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def is_range_current(if_range: Optional[str], etag: str, mtime: float) -> bool:
+    """
+    Whether a Range request may be answered with a part of the file. With If-Range, only if the client's copy is
+    still this file, by a strong ETag match or an exact Last-Modified date.
+    """
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        return not etag.startswith("W/") and if_range == etag
+    try:
+        return parsedate_to_datetime(if_range).timestamp() == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the inclusive byte range of a single-range Range header, clamped to the file. Returns None for anything
+    else, including several ranges, which are answered with the whole file.
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header or "")
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        if int(last) == 0:
+            raise RangeNotSatisfiableException(range_header)
+        return max(size - int(last), 0), size - 1
+    if int(first) >= size:
+        raise RangeNotSatisfiableException(range_header)
+    if last and int(last) < int(first):
+        return None
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+class FileRangeResponse(Response):
+    """
+    Sends bytes start to end of a file.
+
+    When the ASGI server offers the zero-copy send extension, the open file is handed to it to send with sendfile.
+    Servers without it, uvicorn among them, get the bytes in large chunks read with pread in a worker thread, so the
+    event loop never waits on the disk.
+    """
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, media_type: str):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.end = end
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        count = self.end - self.start + 1
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.start, "count": count})
+                return
+
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), self.start, count, os.POSIX_FADV_SEQUENTIAL)
+            offset = self.start
+            while offset <= self.end:
+                chunk = await anyio.to_thread.run_sync(
+                    os.pread, f.fileno(), min(CHUNK_SIZE, self.end - offset + 1), offset
+                )
+                if not chunk:
+                    # The file was truncated while it was being sent
+                    break
+                offset += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def build_file_response(entry: dict, request_headers: Mapping[str, str]) -> Response:
+    """
+    Answers a GET or HEAD for a completed output, honouring If-None-Match, Range and If-Range.
+    """
+    path = entry["path"]
+    stat = os.stat(path)
+    etag = get_etag(entry, stat)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-cache",
+        "Content-Disposition": f'attachment; filename="{os.path.basename(path)}"',
+    }
+    media_type = CONTENT_TYPES.get(os.path.splitext(path)[1]) or mimetypes.guess_type(path)[0] or "video/mp4"
+    if entry["mode"] == "audio":
+        media_type = media_type.replace("video/", "audio/")
+
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={key: headers[key] for key in ("ETag", "Last-Modified")})
+
+    start, end, status_code = 0, stat.st_size - 1, 200
+    if is_range_current(request_headers.get("if-range"), etag, stat.st_mtime):
+        try:
+            byte_range = parse_range(request_headers.get("range"), stat.st_size)
+        except RangeNotSatisfiableException:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+
+    headers["Content-Length"] = str(max(end - start + 1, 0))
+    return FileRangeResponse(path, start, end, status_code, headers, media_type)
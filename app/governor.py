@@ -0,0 +1,270 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from threading import Event
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+import redis
+
+from app.config import Settings
+from app.helper_classes import DownloadCancelledException
+from app.metrics import GOVERNOR_WAIT, THROTTLED_RESPONSES, metrics
+from app.redis_client import get_redis
+
+settings = Settings()
+
+REQUESTS = "requests"
+BYTES = "bytes"
+
+# Seconds a host's throttling block is remembered when no bucket limits its requests, so unlimited requests only check
+# Redis this often
+BLOCK_CHECK_INTERVAL = 1.0
+
+# Takes amount tokens from every bucket at once if each holds enough, refilling them for the time since they were last
+# used. Amounts over a bucket's capacity only need a full bucket and leave it in debt. Returns the seconds to wait
+# before trying again, 0 once the tokens were taken, or the time left on the host's throttling block.
+# KEYS: block key, bucket keys...
+# ARGV: amount, then the rate and capacity of each bucket
+ACQUIRE_SCRIPT = """
+local blocked = redis.call('PTTL', KEYS[1])
+if blocked > 0 then
+    return tostring(blocked / 1000)
+end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local amount = tonumber(ARGV[1])
+local wait = 0
+local levels = {}
+for i = 2, #KEYS do
+    local rate = tonumber(ARGV[2 * i - 2])
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'time')
+    local tokens = tonumber(state[1]) or capacity
+    local last = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(now - last, 0) * rate)
+    levels[i] = tokens
+    local needed = math.min(amount, capacity)
+    if tokens < needed then
+        wait = math.max(wait, (needed - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i = 2, #KEYS do
+    local rate = tonumber(ARGV[2 * i - 2])
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local tokens = levels[i] - amount
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens), 'time', tostring(now))
+    -- A bucket left alone until it refills is the same as a missing one
+    redis.call('EXPIRE', KEYS[i], math.ceil((capacity - tokens) / rate) + 1)
+end
+return '0'
+"""
+
+
+class ThrottledException(Exception):
+    """
+    Exception raised when a proxy throttles a request, with a 429 or an empty body. The proxy is working, so this is
+    not counted against its circuit breaker.
+    """
+
+    pass
+
+
+def get_host(url: str) -> str:
+    # Stream URLs are served by the proxy's own host, so limits are kept per host
+    return httpx.URL(url).host
+
+
+def get_retry_after(response: httpx.Response) -> float:
+    """
+    Seconds a 429 response asks the client to wait, from its Retry-After header in seconds or as a date, or
+    governor_throttle_backoff without one.
+    """
+    retry_after = response.headers.get("retry-after", "").strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return settings.governor_throttle_backoff
+
+
+class RateGovernor:
+    """
+    Token buckets in Redis that keep the request rate and bandwidth used against each proxy host, and against all of
+    them together, under the configured limits, across every API and worker process.
+
+    Callers take one request token before each HTTP request and byte tokens as a body arrives, waiting whenever a
+    bucket runs dry, so scaling out workers spreads the same aggregate rate over them instead of bursting into the
+    proxies' throttling. A host that throttles anyway is blocked for the time it asked for, so every process backs
+    off from it together. Without Redis, requests are let through unlimited, and Redis is left alone for backoff
+    seconds before it is tried again.
+    """
+
+    def __init__(self, db: int, prefix: str = "vidyodl:governor", backoff: int = 30):
+        self.db = db
+        self.prefix = prefix
+        self.backoff = backoff
+        self._disabled_until = 0.0
+        self._acquire_script = None
+        # Host -> (time of the last check, time its block ends)
+        self._blocks: Dict[str, Tuple[float, float]] = {}
+
+    @property
+    def available(self) -> bool:
+        return settings.governor_enabled and time.time() >= self._disabled_until
+
+    def block_key(self, host: str) -> str:
+        return f"{self.prefix}:blocked:{host}"
+
+    def get_buckets(self, kind: str, host: str) -> List[Tuple[str, float, float]]:
+        """
+        Returns the (key, rate, capacity) of the global and per-host buckets of a kind that have a limit.
+        """
+        if kind == REQUESTS:
+            limits = (
+                (f"{self.prefix}:{kind}", settings.governor_global_requests_per_second),
+                (f"{self.prefix}:{kind}:{host}", settings.governor_proxy_requests_per_second),
+            )
+        else:
+            limits = (
+                (f"{self.prefix}:{kind}", settings.governor_global_bytes_per_second),
+                (f"{self.prefix}:{kind}:{host}", settings.governor_proxy_bytes_per_second),
+            )
+        return [(key, rate, max(rate * settings.governor_burst, 1)) for key, rate in limits if rate > 0]
+
+    def try_acquire(self, kind: str, url: str, amount: int = 1) -> float:
+        """
+        Takes amount tokens of a kind for a request to url. Returns 0 if they were taken, or else the seconds to wait
+        before trying again.
+        """
+        if not self.available:
+            return 0.0
+        host = get_host(url)
+        buckets = self.get_buckets(kind, host)
+        if not buckets:
+            # Only requests wait out a throttling block
+            return self.get_block(host) if kind == REQUESTS else 0.0
+        try:
+            if self._acquire_script is None:
+                self._acquire_script = get_redis(self.db).register_script(ACQUIRE_SCRIPT)
+            wait = self._acquire_script(
+                keys=[self.block_key(host), *(key for key, _, _ in buckets)],
+                args=[amount, *(value for _, rate, capacity in buckets for value in (rate, capacity))],
+            )
+            return float(wait)
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return 0.0
+
+    def get_block(self, host: str) -> float:
+        """
+        Seconds left on host's throttling block, checked in Redis at most every BLOCK_CHECK_INTERVAL seconds.
+        """
+        now = time.time()
+        checked_at, blocked_until = self._blocks.get(host, (0.0, 0.0))
+        if now - checked_at >= BLOCK_CHECK_INTERVAL:
+            try:
+                blocked = get_redis(self.db).pttl(self.block_key(host))
+            except redis.RedisError:
+                self._disabled_until = now + self.backoff
+                return 0.0
+            blocked_until = now + max(blocked, 0) / 1000
+            self._blocks[host] = (now, blocked_until)
+        return max(blocked_until - now, 0.0)
+
+    def acquire(self, kind: str, url: str, amount: int = 1, cancel_event: Optional[Event] = None) -> None:
+        """
+        Waits until amount tokens of a kind were taken for a request to url.
+        """
+        started = None
+        while True:
+            wait = self.try_acquire(kind, url, amount)
+            if wait <= 0:
+                break
+            started = started or time.perf_counter()
+            if cancel_event is None:
+                time.sleep(wait)
+            elif cancel_event.wait(wait):
+                raise DownloadCancelledException("Download cancelled")
+        if started is not None:
+            metrics.inc(GOVERNOR_WAIT, time.perf_counter() - started, {"kind": kind})
+
+    async def async_acquire(self, kind: str, url: str, amount: int = 1) -> None:
+        started = None
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, kind, url, amount)
+            if wait <= 0:
+                break
+            started = started or time.perf_counter()
+            await asyncio.sleep(wait)
+        if started is not None:
+            metrics.inc(GOVERNOR_WAIT, time.perf_counter() - started, {"kind": kind})
+
+    def throttle(self, url: str, seconds: float) -> None:
+        """
+        Blocks every request to url's host for the given seconds.
+        """
+        host = get_host(url)
+        metrics.inc(THROTTLED_RESPONSES, labels={"host": host})
+        now = time.time()
+        self._blocks[host] = (now, now + seconds)
+        if not self.available:
+            return
+        try:
+            get_redis(self.db).set(self.block_key(host), 1, px=max(int(seconds * 1000), 1))
+        except redis.RedisError:
+            self._disabled_until = now + self.backoff
+
+    def iter_bytes(self, url: str, chunks: Iterator[bytes], cancel_event: Optional[Event] = None) -> Iterator[bytes]:
+        """
+        Passes a response body through, taking byte tokens governor_byte_quantum at a time. Reading stops while the
+        buckets refill, which lets TCP slow the sender down. Without a byte limit, the body is passed through as is.
+        """
+        if not settings.governor_enabled or not self.get_buckets(BYTES, get_host(url)):
+            yield from chunks
+            return
+        credit = 0
+        for chunk in chunks:
+            if credit < len(chunk):
+                self.acquire(BYTES, url, settings.governor_byte_quantum, cancel_event)
+                credit += settings.governor_byte_quantum
+            credit -= len(chunk)
+            yield chunk
+
+    async def async_iter_bytes(self, url: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        if not settings.governor_enabled or not self.get_buckets(BYTES, get_host(url)):
+            async for chunk in chunks:
+                yield chunk
+            return
+        credit = 0
+        async for chunk in chunks:
+            if credit < len(chunk):
+                await self.async_acquire(BYTES, url, settings.governor_byte_quantum)
+                credit += settings.governor_byte_quantum
+            credit -= len(chunk)
+            yield chunk
+
+
+def check_throttled(response: httpx.Response, url: str) -> None:
+    """
+    Raises ThrottledException for a 429 response, after blocking the host for as long as it asked.
+    """
+    if response.status_code == 429:
+        rate_governor.throttle(url, get_retry_after(response))
+        raise ThrottledException(f"Throttled by {get_host(url)}")
+
+
+def raise_throttled(url: str) -> None:
+    """
+    Raises ThrottledException for a response whose body came back empty, which proxies send when they throttle
+    without saying so, after blocking the host for governor_throttle_backoff seconds.
+    """
+    rate_governor.throttle(url, settings.governor_throttle_backoff)
+    raise ThrottledException(f"Empty response from {get_host(url)}")
+
+
+rate_governor = RateGovernor(settings.governor_redis_db)
@@ -0,0 +1,170 @@
+import asyncio
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Tuple
+
+from app.config import Settings
+from app.governor import (
+    REQUESTS,
+    ThrottledException,
+    check_throttled,
+    raise_throttled,
+    rate_governor,
+)
+from app.http_client import get_async_http_client, get_http_client
+from app.proxy import Proxy
+from app.proxy_functions import (
+    acquire_proxy,
+    record_proxy_failure,
+    record_proxy_success,
+    release_proxy,
+)
+from app.proxy_registry import proxy_registry
+
+settings = Settings()
+
+
+class InvalidPipedResponse(Exception):
+    """
+    Exception raised when a Piped API response is not usable JSON or carries an error.
+    """
+
+    pass
+
+
+def get_hedge_delay(proxy: Proxy) -> float:
+    """
+    Returns how long to wait on a proxy before hedging: its configured latency percentile, or the default delay
+    while it has too few samples.
+    """
+    percentile = proxy_registry.get_latency_percentile(proxy.url, settings.hedge_percentile, settings.hedge_min_samples)
+    return percentile if percentile is not None else settings.hedge_default_delay
+
+
+def parse_piped_response(response) -> dict:
+    """
+    Returns the metadata in a Piped API response. Throttling, by a 429 or an empty body, raises ThrottledException.
+    """
+    check_throttled(response, str(response.url))
+    response.raise_for_status()
+    if not response.content:
+        raise_throttled(str(response.url))
+    data = response.json()
+    if not isinstance(data, dict) or "error" in data:
+        raise InvalidPipedResponse(f"Invalid Piped response: {str(data)[:200]}")
+    return data
+
+
+def fetch_from_proxy(video_id: str, proxy: Proxy, acquired: bool) -> dict:
+    """
+    Fetches a video's metadata from a proxy within the rate governor's limits. Throttling isn't a proxy failure, so
+    it is left out of the proxy's error rate and circuit breaker.
+    """
+    try:
+        rate_governor.acquire(REQUESTS, proxy.url)
+        start = time.perf_counter()
+        response = get_http_client().get(f"{proxy.url}/streams/{video_id}")
+        video_properties = parse_piped_response(response)
+    except ThrottledException:
+        raise
+    except Exception:
+        record_proxy_failure(proxy)
+        raise
+    finally:
+        release_proxy(proxy, acquired)
+    record_proxy_success(proxy, time.perf_counter() - start)
+    return video_properties
+
+
+async def async_fetch_from_proxy(video_id: str, proxy: Proxy, acquired: bool) -> dict:
+    try:
+        await rate_governor.async_acquire(REQUESTS, proxy.url)
+        start = time.perf_counter()
+        response = await get_async_http_client().get(f"{proxy.url}/streams/{video_id}")
+        video_properties = await asyncio.to_thread(parse_piped_response, response)
+    except ThrottledException:
+        raise
+    except Exception:
+        await asyncio.to_thread(record_proxy_failure, proxy)
+        raise
+    finally:
+        await asyncio.to_thread(release_proxy, proxy, acquired)
+    await asyncio.to_thread(record_proxy_success, proxy, time.perf_counter() - start)
+    return video_properties
+
+
+def fetch_video_properties(video_id: str) -> Tuple[dict, Proxy]:
+    """
+    Resolves /streams/{video_id}, returning the metadata and the proxy that answered.
+
+    With hedged_requests on, the request is sent to a second proxy if the first hasn't answered within its
+    hedge delay (or has already failed) and the first valid response wins. Blocking httpx requests can't be
+    interrupted, so the losing request is abandoned: its result is dropped when it finishes.
+    """
+    primary, acquired = acquire_proxy()
+    if not settings.hedged_requests:
+        return fetch_from_proxy(video_id, primary, acquired), primary
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = {executor.submit(fetch_from_proxy, video_id, primary, acquired): primary}
+        done, _ = wait(futures, timeout=get_hedge_delay(primary))
+
+        winner = next((future for future in done if future.exception() is None), None)
+        if winner is not None:
+            return winner.result(), futures[winner]
+
+        secondary, secondary_acquired = acquire_proxy(exclude={primary.url})
+        if secondary.url != primary.url:
+            futures[executor.submit(fetch_from_proxy, video_id, secondary, secondary_acquired)] = secondary
+        else:
+            release_proxy(secondary, secondary_acquired)
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result(), futures[future]
+                error = future.exception()
+        raise error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def async_fetch_video_properties(video_id: str) -> Tuple[dict, Proxy]:
+    """
+    Async counterpart of fetch_video_properties. Here the losing request is cancelled.
+    """
+    primary, acquired = await asyncio.to_thread(acquire_proxy)
+    if not settings.hedged_requests:
+        return await async_fetch_from_proxy(video_id, primary, acquired), primary
+
+    tasks = {asyncio.create_task(async_fetch_from_proxy(video_id, primary, acquired)): primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=await asyncio.to_thread(get_hedge_delay, primary))
+
+        winner = next((task for task in done if task.exception() is None), None)
+        if winner is not None:
+            return winner.result(), tasks[winner]
+
+        secondary, secondary_acquired = await asyncio.to_thread(acquire_proxy, None, {primary.url})
+        if secondary.url != primary.url:
+            tasks[asyncio.create_task(async_fetch_from_proxy(video_id, secondary, secondary_acquired))] = secondary
+        else:
+            await asyncio.to_thread(release_proxy, secondary, secondary_acquired)
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), tasks[task]
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -1,3 +1,11 @@
 class Status:
     OK = "ok"
     ERROR = "error"
+
+
+class DownloadCancelledException(Exception):
+    """
+    Exception raised when a download is cancelled before it finishes.
+    """
+
+    pass
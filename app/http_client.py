@@ -0,0 +1,106 @@
+from importlib.util import find_spec
+from typing import Optional
+
+import httpx
+
+from app.config import Settings
+
+settings = Settings()
+
+# HTTP/2 needs the optional h2 package (httpx[http2])
+http2_available = find_spec("h2") is not None
+
+_client: Optional[httpx.Client] = None
+_async_client: Optional[httpx.AsyncClient] = None
+_download_client: Optional[httpx.Client] = None
+
+
+def get_timeout() -> httpx.Timeout:
+    return httpx.Timeout(settings.http_timeout, connect=settings.http_connect_timeout)
+
+
+def get_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.http_max_connections,
+        max_keepalive_connections=settings.http_max_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_expiry,
+    )
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Returns the process-wide client used for Piped API calls.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.Client(
+            http2=settings.http2 and http2_available,
+            limits=get_limits(),
+            timeout=get_timeout(),
+            follow_redirects=True,
+        )
+    return _client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Returns the process-wide async client used for Piped API calls and proxy health checks.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            http2=settings.http2 and http2_available,
+            limits=get_limits(),
+            timeout=get_timeout(),
+            follow_redirects=True,
+        )
+    return _async_client
+
+
+def get_download_connection_limit() -> int:
+    """
+    Connections stream transfers can hold at once: every segment of both streams of each job an I/O worker runs, so
+    segments never wait for a pooled connection until the pool timeout.
+    """
+    jobs = max(settings.celery_io_concurrency, settings.inline_download_concurrency)
+    streams_per_job = 2 if settings.concurrent_av_download else 1
+    return jobs * streams_per_job * settings.download_segment_count
+
+
+def get_download_client() -> httpx.Client:
+    """
+    Returns the process-wide client used for stream transfers.
+
+    This one stays on HTTP/1.1: Piped proxies throttle per connection, and HTTP/2 would multiplex every
+    Range segment over a single connection.
+    """
+    global _download_client
+    if _download_client is None:
+        _download_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=get_download_connection_limit(),
+                max_keepalive_connections=get_download_connection_limit(),
+                keepalive_expiry=settings.http_keepalive_expiry,
+            ),
+            timeout=get_timeout(),
+            follow_redirects=True,
+        )
+    return _download_client
+
+
+def close_http_clients() -> None:
+    global _client, _download_client
+    if _client is not None:
+        _client.close()
+        _client = None
+    if _download_client is not None:
+        _download_client.close()
+        _download_client = None
+
+
+async def aclose_http_clients() -> None:
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    close_http_clients()
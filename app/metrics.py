@@ -0,0 +1,241 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import redis
+
+from app.config import Settings
+from app.redis_client import get_redis
+
+settings = Settings()
+
+STAGE_DURATION = "vidyodl_stage_duration_seconds"
+PROXY_THROUGHPUT = "vidyodl_proxy_throughput_bytes_per_second"
+TRANSFER_BYTES = "vidyodl_transfer_bytes_total"
+CACHE_REQUESTS = "vidyodl_cache_requests_total"
+DEDUP_REQUESTS = "vidyodl_dedup_requests_total"
+EVICTED_BYTES = "vidyodl_store_evicted_bytes_total"
+THROTTLED_RESPONSES = "vidyodl_throttled_responses_total"
+GOVERNOR_WAIT = "vidyodl_governor_wait_seconds_total"
+
+# Histogram help texts and bucket upper bounds
+HISTOGRAMS = {
+    STAGE_DURATION: (
+        "Duration of download job stages: metadata, audio, video, mux and transcode",
+        (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+    ),
+    PROXY_THROUGHPUT: (
+        "Stream download throughput by the proxy that resolved the stream",
+        tuple(2**power * 1024 for power in range(6, 19, 2)),
+    ),
+}
+
+COUNTERS = {
+    TRANSFER_BYTES: "Bytes fetched by the native downloaders",
+    CACHE_REQUESTS: "Metadata cache lookups by the tier that answered them, or miss",
+    DEDUP_REQUESTS: "Submitted jobs by whether they were new, already running or already completed",
+    EVICTED_BYTES: "Bytes of completed outputs deleted to stay under the store's size cap or make room for new jobs",
+    THROTTLED_RESPONSES: "Responses by which a proxy host throttled a request, with a 429 or an empty body",
+    GOVERNOR_WAIT: "Seconds spent waiting for the rate governor, by requests or bytes",
+}
+
+# Callback for a job's progress, called with its Celery task state metadata
+ProgressReporter = Callable[[dict], None]
+
+
+def format_labels(labels: Optional[Dict[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = {
+        key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for key, value in labels.items()
+    }
+    return ",".join(f'{key}="{value}"' for key, value in sorted(escaped.items()))
+
+
+def format_value(value: float) -> str:
+    # Exact, since byte counters quickly outgrow the six significant digits of the g format
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_sample(name: str, labels: str, value: float) -> str:
+    return f"{name}{{{labels}}} {format_value(value)}" if labels else f"{name} {format_value(value)}"
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms shared by every API and worker process through Redis, rendered in the Prometheus text
+    format by the API's /metrics endpoint.
+
+    Increments are buffered in process and written in one pipeline from a background thread at most every
+    metrics_flush_interval seconds, so recording a sample costs a dict update, even on an event loop. Histograms keep
+    per-bucket counts, which are summed into cumulative buckets when rendered. Redis errors drop the buffered samples
+    and skip the store for a short while.
+    """
+
+    def __init__(self, db: int, prefix: str = "vidyodl:metrics", backoff: int = 30):
+        self.db = db
+        self.prefix = prefix
+        self.backoff = backoff
+        self._disabled_until = 0.0
+        self._lock = Lock()
+        self._pending: Dict[Tuple[str, str], float] = defaultdict(float)
+        self._last_flush = time.time()
+        self._flushing = False
+
+    def metric_key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    @property
+    def available(self) -> bool:
+        return settings.metrics_enabled and time.time() >= self._disabled_until
+
+    def inc(self, name: str, amount: float = 1, labels: Optional[Dict[str, str]] = None) -> None:
+        self._add([(self.metric_key(name), format_labels(labels), amount)])
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        _, buckets = HISTOGRAMS[name]
+        label_string = format_labels(labels)
+        bucket = next((format_value(bound) for bound in buckets if value <= bound), "+Inf")
+        key = self.metric_key(name)
+        self._add(
+            [
+                (key, f"{label_string}|{bucket}", 1),
+                (key, f"{label_string}|sum", value),
+                (key, f"{label_string}|count", 1),
+            ]
+        )
+
+    def _add(self, increments: List[Tuple[str, str, float]]) -> None:
+        if not self.available:
+            return
+        with self._lock:
+            for key, field, amount in increments:
+                self._pending[(key, field)] += amount
+            due = not self._flushing and time.time() - self._last_flush >= settings.metrics_flush_interval
+            if due:
+                self._flushing = True
+        if due:
+            Thread(target=self.flush, daemon=True).start()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+            self._last_flush = time.time()
+        try:
+            if pending and self.available:
+                pipeline = get_redis(self.db).pipeline(transaction=False)
+                for (key, field), amount in pending.items():
+                    pipeline.hincrbyfloat(key, field, amount)
+                pipeline.execute()
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+        finally:
+            self._flushing = False
+
+    def collect(self) -> Dict[str, Dict[str, float]]:
+        names = list(HISTOGRAMS) + list(COUNTERS)
+        try:
+            pipeline = get_redis(self.db).pipeline(transaction=False)
+            for name in names:
+                pipeline.hgetall(self.metric_key(name))
+            values = pipeline.execute()
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return {}
+        return {
+            name: {field.decode(): float(value) for field, value in fields.items()}
+            for name, fields in zip(names, values)
+        }
+
+    def render(self, gauges: Optional[Dict[str, Tuple[str, Dict[str, float]]]] = None) -> str:
+        """
+        Renders every stored metric, plus gauges given as name -> (help, label string -> value), in the Prometheus
+        text format.
+        """
+        self.flush()
+        stored = self.collect()
+        lines = []
+
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            series = defaultdict(dict)
+            for field, value in stored.get(name, {}).items():
+                label_string, _, suffix = field.rpartition("|")
+                series[label_string][suffix] = value
+            for label_string, values in sorted(series.items()):
+                cumulative = 0.0
+                for bucket in [format_value(bound) for bound in buckets] + ["+Inf"]:
+                    cumulative += values.get(bucket, 0)
+                    bucket_labels = f'{label_string},le="{bucket}"' if label_string else f'le="{bucket}"'
+                    lines.append(format_sample(f"{name}_bucket", bucket_labels, cumulative))
+                lines.append(format_sample(f"{name}_sum", label_string, values.get("sum", 0)))
+                lines.append(format_sample(f"{name}_count", label_string, values.get("count", 0)))
+
+        for name, help_text in COUNTERS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for label_string, value in sorted(stored.get(name, {}).items()):
+                lines.append(format_sample(name, label_string, value))
+
+        for name, (help_text, values) in (gauges or {}).items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for label_string, value in sorted(values.items()):
+                lines.append(format_sample(name, label_string, value))
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(settings.metrics_redis_db)
+
+
+class JobProgress:
+    """
+    Stage timings of one download job.
+
+    Each stage's duration is recorded in the stage latency histogram and in timings. report, if given, is called
+    with the job's state when a stage starts or ends, and with progress from inside a stage, such as ffmpeg's
+    position, at most every metrics_progress_interval seconds. Stages may run concurrently, as the audio and video
+    fetches do.
+    """
+
+    def __init__(self, report: Optional[ProgressReporter] = None):
+        self.report = report
+        self.timings: Dict[str, float] = {}
+        self.running: List[str] = []
+        self._lock = Lock()
+        self._last_update = 0.0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        with self._lock:
+            self.running.append(name)
+        self._report({})
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe(STAGE_DURATION, elapsed, {"stage": name})
+            with self._lock:
+                self.timings[name] = round(elapsed, 3)
+                self.running.remove(name)
+            self._report({})
+
+    def update(self, **info) -> None:
+        now = time.time()
+        if now - self._last_update < settings.metrics_progress_interval and not info.get("done"):
+            return
+        self._last_update = now
+        self._report(info)
+
+    def _report(self, info: dict) -> None:
+        if self.report is None:
+            return
+        with self._lock:
+            state = {"stages": list(self.running), "timings": dict(self.timings), **info}
+        try:
+            self.report(state)
+        except Exception:
+            # Progress is best effort and never fails the download
+            pass
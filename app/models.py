@@ -1,5 +1,44 @@
-from pydantic import BaseModel
+from typing import List, Literal
+
+from pydantic import BaseModel, model_validator
+
+from app.stream_policy import StreamPolicy, check_encoders
+
+# Kinds of download: audio and video muxed together, or the audio alone
+DownloadMode = Literal["av", "audio"]
+
+# Scheduling hint for queued downloads. Within a hint, cheaper jobs run first.
+PriorityHint = Literal["high", "normal", "low"]
+
+# Containers audio and video downloads can be muxed into
+OutputFormat = Literal["mp4", "webm", "mkv"]
+
+# ffmpeg encoders downloads can be transcoded with. copy keeps the stream as it is.
+VideoEncoder = Literal["copy", "libx264", "libx265", "libvpx-vp9", "libsvtav1"]
+AudioEncoder = Literal["copy", "aac", "libopus", "libvorbis", "libmp3lame"]
 
 
 class downloadResponseModel(BaseModel):
     response: dict
+
+
+class batchDownloadRequestModel(BaseModel):
+    video_ids: List[str]
+    mode: DownloadMode = "av"
+    stream_mux: bool = False
+    priority: PriorityHint = "normal"
+    format_out: OutputFormat = "mp4"
+    vcodec_out: VideoEncoder = "copy"
+    acodec_out: AudioEncoder = "copy"
+    policy: StreamPolicy = StreamPolicy()
+
+    @model_validator(mode="after")
+    def check_output_encoders(self) -> "batchDownloadRequestModel":
+        # Encoders are only used in av mode
+        if self.mode == "av":
+            check_encoders(self.format_out, self.vcodec_out, self.acodec_out)
+        return self
+
+
+class taskStatusRequestModel(BaseModel):
+    task_ids: List[str]
@@ -1,10 +1,15 @@
 import asyncio
 import json
+import random
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Set, Tuple
 
 import httpx
 
 from app.config import Settings
+from app.http_client import get_async_http_client
 from app.proxy import Proxy
+from app.proxy_registry import proxy_registry
 
 settings = Settings()
 
@@ -22,6 +27,106 @@ def get_proxies_from_file():
     return proxy_list
 
 
+def get_current_proxy() -> Proxy:
+    """
+    Returns the best ranked proxy in the shared registry, falling back to this process's FASTEST_PROXY when the
+    registry is empty or unreachable.
+    """
+    proxy = proxy_registry.get_best()
+    if proxy is not None:
+        return proxy
+    return FASTEST_PROXY
+
+
+def order_candidates(ranking: List[Tuple[str, float]], strategy: str) -> List[str]:
+    """
+    Orders ranked (url, score) pairs, lower score being better, by the given selection strategy.
+
+    - fastest: always the best ranked proxy first.
+    - weighted_random: a random order in which each proxy is drawn with probability proportional to 1/score.
+    - power_of_two: two random proxies are compared on score scaled by their in-flight requests and the
+      better one goes first, followed by the rest in weighted random order.
+    """
+    if strategy == "fastest":
+        return [url for url, _ in ranking]
+
+    remaining = list(ranking)
+    ordered = []
+
+    if strategy == "power_of_two" and len(remaining) >= 2:
+        first, second = random.sample(remaining, 2)
+        inflight = proxy_registry.get_inflight([first[0], second[0]])
+        loads = [first[1] * (1 + inflight[0]), second[1] * (1 + inflight[1])]
+        winner = first if loads[0] <= loads[1] else second
+        ordered.append(winner[0])
+        remaining.remove(winner)
+
+    while remaining:
+        weights = [1 / max(score, 1e-3) for _, score in remaining]
+        pick = random.choices(remaining, weights=weights)[0]
+        ordered.append(pick[0])
+        remaining.remove(pick)
+
+    return ordered
+
+
+def acquire_proxy(strategy: Optional[str] = None, exclude: Optional[Set[str]] = None) -> Tuple[Proxy, bool]:
+    """
+    Picks a proxy with the configured strategy, skipping proxies whose circuit breaker is open or that are
+    at their concurrency cap, and takes one of its slots.
+
+    Proxy URLs in exclude are never picked. Returns the proxy and whether a slot was taken, which should be passed
+    to release_proxy when done. Falls back to FASTEST_PROXY, without a slot, when the registry has no proxy whose
+    breaker lets requests through.
+    """
+    ranking = proxy_registry.get_ranking_with_scores(settings.proxy_candidate_count)
+    allowed = []
+    for url in order_candidates(ranking, strategy or settings.proxy_selection_strategy):
+        if exclude and url in exclude:
+            continue
+        if not proxy_registry.breaker_allows(url):
+            continue
+        if proxy_registry.try_acquire(url, settings.proxy_max_concurrency):
+            return Proxy({"name": url, "url": url}), True
+        allowed.append(url)
+
+    # Every healthy proxy is at its cap: go over it on the preferred one rather than on an unranked default
+    if allowed:
+        return Proxy({"name": allowed[0], "url": allowed[0]}), proxy_registry.try_acquire(
+            allowed[0], settings.proxy_max_concurrency, force=True
+        )
+    return FASTEST_PROXY, False
+
+
+def release_proxy(proxy: Proxy, acquired: bool) -> None:
+    if acquired:
+        proxy_registry.release(proxy.url)
+
+
+def record_proxy_success(proxy: Proxy, latency: float) -> None:
+    proxy_registry.record_latency(proxy.url, latency)
+    proxy_registry.record_request_latency(proxy.url, latency)
+    proxy_registry.breaker_success(proxy.url)
+
+
+def record_proxy_failure(proxy: Proxy) -> None:
+    proxy_registry.record_error(proxy.url)
+    proxy_registry.breaker_failure(proxy.url)
+
+
+@contextmanager
+def proxy_slot(proxy: Proxy) -> Iterator[None]:
+    """
+    Counts work that has to stay on an already chosen proxy, such as fetching the stream URLs it resolved,
+    towards that proxy's in-flight requests.
+    """
+    acquired = proxy_registry.try_acquire(proxy.url, settings.proxy_max_concurrency, force=True)
+    try:
+        yield
+    finally:
+        release_proxy(proxy, acquired)
+
+
 def get_fastest_proxy():
     sorted_proxies = sorted(UP_PROXIES, key=lambda proxy: proxy.speed)
     return sorted_proxies[0]
@@ -32,12 +137,6 @@ def set_fastest_proxy():
     FASTEST_PROXY.update(get_fastest_proxy())
 
 
-def update_fastest_proxy():
-    global UP_PROXIES, FASTEST_PROXY
-    UP_PROXIES.remove(FASTEST_PROXY)
-    FASTEST_PROXY.update(get_fastest_proxy())
-
-
 async def get_async_healthcheck(session: httpx.AsyncClient, proxy: Proxy):
     try:
         response = await session.request(method="GET", url=f"{proxy.url}/healthcheck")
@@ -45,16 +144,37 @@ async def get_async_healthcheck(session: httpx.AsyncClient, proxy: Proxy):
             proxy.up = True
             proxy.speed = response.elapsed.total_seconds()
             UP_PROXIES.append(proxy)
+            await asyncio.to_thread(proxy_registry.record_latency, proxy.url, proxy.speed, proxy.name)
         else:
             proxy.up = False
             proxy.speed = None
+            await asyncio.to_thread(proxy_registry.mark_down, proxy.url, proxy.name)
     except Exception:
         proxy.up = False
         proxy.speed = None
+        await asyncio.to_thread(proxy_registry.mark_down, proxy.url, proxy.name)
 
 
-async def set_proxies_async(proxy_list: list):
+async def set_proxies_async(proxy_list: list, session: Optional[httpx.AsyncClient] = None):
     UP_PROXIES.clear()
 
-    async with httpx.AsyncClient() as session:
-        await asyncio.gather(*[get_async_healthcheck(session, proxy) for proxy in proxy_list])
+    if session is None:
+        session = get_async_http_client()
+    await asyncio.gather(*[get_async_healthcheck(session, proxy) for proxy in proxy_list])
+
+
+def refresh_proxy_registry() -> List[Proxy]:
+    """
+    Health checks every proxy in proxy.json and records the results in the shared registry.
+
+    Meant for callers without a running event loop, such as the periodic Celery task. A throwaway client is
+    used because the shared async client is bound to the API's event loop.
+    """
+
+    async def refresh(proxy_list: List[Proxy]) -> None:
+        async with httpx.AsyncClient(timeout=settings.http_timeout) as session:
+            await set_proxies_async(proxy_list, session)
+
+    proxy_list = get_proxies_from_file()
+    asyncio.run(refresh(proxy_list))
+    return [proxy for proxy in proxy_list if proxy.up]
@@ -0,0 +1,306 @@
+import time
+from typing import List, Optional, Tuple
+
+import redis
+
+from app.config import Settings
+from app.proxy import Proxy
+from app.redis_client import get_redis
+
+settings = Settings()
+
+# Updates one proxy's stats hash and its score in the ranking sorted set atomically.
+# KEYS: stats hash, ranking zset
+# ARGV: url, name, kind (latency | throughput | error | down), value, alpha, now, error_penalty
+UPDATE_SCRIPT = """
+local stats, ranking = KEYS[1], KEYS[2]
+local url, name, kind = ARGV[1], ARGV[2], ARGV[3]
+local value, alpha = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+redis.call('HSET', stats, 'url', url, 'updated_at', ARGV[6])
+if name ~= '' then
+    redis.call('HSET', stats, 'name', name)
+end
+
+local function ewma(field, sample)
+    local current = redis.call('HGET', stats, field)
+    if current then
+        sample = alpha * sample + (1 - alpha) * tonumber(current)
+    end
+    redis.call('HSET', stats, field, sample)
+    return sample
+end
+
+if kind == 'latency' then
+    ewma('latency_ewma', value)
+    ewma('error_rate', 0)
+    redis.call('HSET', stats, 'up', 1)
+elseif kind == 'throughput' then
+    ewma('throughput_ewma', value)
+elseif kind == 'error' then
+    ewma('error_rate', 1)
+elseif kind == 'down' then
+    ewma('error_rate', 1)
+    redis.call('HSET', stats, 'up', 0)
+    redis.call('ZREM', ranking, url)
+    return
+end
+
+local latency = redis.call('HGET', stats, 'latency_ewma')
+if latency and redis.call('HGET', stats, 'up') == '1' then
+    local error_rate = tonumber(redis.call('HGET', stats, 'error_rate') or '0')
+    redis.call('ZADD', ranking, tonumber(latency) * (1 + tonumber(ARGV[7]) * error_rate), url)
+end
+"""
+
+
+def percentile_of(sorted_samples: List[float], percentile: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted, non-empty list.
+    """
+    index = max(0, min(len(sorted_samples) - 1, int(round(percentile / 100 * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+class ProxyRegistry:
+    """
+    Proxy health shared by every API and worker process through Redis.
+
+    Each proxy keeps an EWMA of its latency, download throughput and error rate in a hash, and a sorted
+    set ranks the proxies that are up by latency penalised by error rate, so picking the best one is a
+    single ZRANGE. Each proxy also has a circuit breaker and an in-flight request counter used by the
+    selection strategies in proxy_functions.
+
+    Redis errors never break a download: reads return nothing and writes are dropped, and the registry is
+    skipped for a short while afterwards.
+    """
+
+    def __init__(self, db: int, prefix: str = "vidyodl:proxies", backoff: int = 30):
+        self.db = db
+        self.prefix = prefix
+        self.ranking_key = f"{prefix}:ranking"
+        self.backoff = backoff
+        self._disabled_until = 0.0
+        self._update_script = None
+
+    def stats_key(self, url: str) -> str:
+        return f"{self.prefix}:stats:{url}"
+
+    @property
+    def available(self) -> bool:
+        return settings.proxy_registry_enabled and time.time() >= self._disabled_until
+
+    def _update(self, url: str, kind: str, value: float = 0.0, name: str = "") -> None:
+        if not self.available:
+            return
+        try:
+            if self._update_script is None:
+                self._update_script = get_redis(self.db).register_script(UPDATE_SCRIPT)
+            self._update_script(
+                keys=[self.stats_key(url), self.ranking_key],
+                args=[url, name, kind, value, settings.proxy_ewma_alpha, time.time(), settings.proxy_error_penalty],
+            )
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+
+    def record_latency(self, url: str, seconds: float, name: str = "") -> None:
+        self._update(url, "latency", seconds, name)
+
+    def record_throughput(self, url: str, bytes_per_second: float) -> None:
+        self._update(url, "throughput", bytes_per_second)
+
+    def record_error(self, url: str) -> None:
+        self._update(url, "error")
+
+    def mark_down(self, url: str, name: str = "") -> None:
+        self._update(url, "down", name=name)
+
+    def get_ranking(self, count: int = -1) -> List[str]:
+        """
+        Returns proxy URLs that are up, best first.
+        """
+        if not self.available:
+            return []
+        try:
+            urls = get_redis(self.db).zrange(self.ranking_key, 0, count - 1 if count > 0 else -1)
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return []
+        return [url.decode() for url in urls]
+
+    def get_best(self) -> Optional[Proxy]:
+        ranking = self.get_ranking(1)
+        if not ranking:
+            return None
+        stats = self.get_stats(ranking[0])
+        return Proxy({"name": stats.get("name", ranking[0]), "url": ranking[0]})
+
+    def get_stats(self, url: str) -> dict:
+        if not self.available:
+            return {}
+        try:
+            stats = get_redis(self.db).hgetall(self.stats_key(url))
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return {}
+        return {key.decode(): value.decode() for key, value in stats.items()}
+
+    def list_proxies(self) -> List[dict]:
+        proxies = []
+        for url in self.get_ranking():
+            stats = {"url": url, **self.get_stats(url)}
+            stats["latency_percentiles"] = self.get_latency_percentiles(url)
+            proxies.append(stats)
+        return proxies
+
+    # Request latency percentiles
+
+    def samples_key(self, url: str) -> str:
+        return f"{self.prefix}:samples:{url}"
+
+    def record_request_latency(self, url: str, seconds: float) -> None:
+        """
+        Keeps the last latency_sample_size request latencies of a proxy for percentile estimates.
+        """
+        if not self.available:
+            return
+        try:
+            pipeline = get_redis(self.db).pipeline()
+            pipeline.lpush(self.samples_key(url), seconds)
+            pipeline.ltrim(self.samples_key(url), 0, settings.latency_sample_size - 1)
+            pipeline.execute()
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+
+    def get_latency_samples(self, url: str) -> List[float]:
+        if not self.available:
+            return []
+        try:
+            samples = get_redis(self.db).lrange(self.samples_key(url), 0, -1)
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return []
+        return sorted(float(sample) for sample in samples)
+
+    def get_latency_percentile(self, url: str, percentile: float, min_samples: int = 1) -> Optional[float]:
+        samples = self.get_latency_samples(url)
+        if len(samples) < max(min_samples, 1):
+            return None
+        return percentile_of(samples, percentile)
+
+    def get_latency_percentiles(self, url: str) -> dict:
+        samples = self.get_latency_samples(url)
+        if not samples:
+            return {}
+        return {f"p{percentile}": percentile_of(samples, percentile) for percentile in (50, 95, 99)}
+
+    def get_ranking_with_scores(self, count: int = -1) -> List[Tuple[str, float]]:
+        if not self.available:
+            return []
+        try:
+            ranking = get_redis(self.db).zrange(self.ranking_key, 0, count - 1 if count > 0 else -1, withscores=True)
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return []
+        return [(url.decode(), score) for url, score in ranking]
+
+    # Concurrency caps
+
+    def inflight_key(self, url: str) -> str:
+        return f"{self.prefix}:inflight:{url}"
+
+    def get_inflight(self, urls: List[str]) -> List[int]:
+        if not urls or not self.available:
+            return [0] * len(urls)
+        try:
+            counts = get_redis(self.db).mget([self.inflight_key(url) for url in urls])
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return [0] * len(urls)
+        return [int(count) if count is not None else 0 for count in counts]
+
+    def try_acquire(self, url: str, cap: int, force: bool = False) -> bool:
+        """
+        Takes one of a proxy's concurrency slots and returns whether one was taken. With force the slot is taken
+        even past the cap, so work that has to stay on this proxy still counts towards its load.
+
+        Counters expire after an hour so slots leaked by a killed worker don't block a proxy forever.
+        """
+        if not self.available:
+            return False
+        try:
+            pipeline = get_redis(self.db).pipeline()
+            pipeline.incr(self.inflight_key(url))
+            pipeline.expire(self.inflight_key(url), 3600)
+            inflight, _ = pipeline.execute()
+            if inflight > cap and not force:
+                get_redis(self.db).decr(self.inflight_key(url))
+                return False
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+            return False
+        return True
+
+    def release(self, url: str) -> None:
+        if not self.available:
+            return
+        try:
+            get_redis(self.db).decr(self.inflight_key(url))
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+
+    # Circuit breakers
+
+    def probe_key(self, url: str) -> str:
+        return f"{self.prefix}:probe:{url}"
+
+    def breaker_allows(self, url: str) -> bool:
+        """
+        Closed breakers allow every request. Open breakers reject requests until the cooldown has passed, then
+        go half-open and let a single probe request through; its outcome closes or re-opens the breaker.
+        """
+        if not self.available:
+            return True
+        try:
+            client = get_redis(self.db)
+            state, opened_at = client.hmget(self.stats_key(url), "breaker_state", "breaker_opened_at")
+            if state is None or state == b"closed":
+                return True
+            if state == b"open" and time.time() - float(opened_at or 0) < settings.proxy_breaker_cooldown:
+                return False
+            # Half-open: only whoever claims the probe key gets through
+            if not client.set(self.probe_key(url), 1, nx=True, ex=settings.proxy_breaker_cooldown):
+                return False
+            client.hset(self.stats_key(url), "breaker_state", "half_open")
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+        return True
+
+    def breaker_success(self, url: str) -> None:
+        if not self.available:
+            return
+        try:
+            pipeline = get_redis(self.db).pipeline()
+            pipeline.hset(self.stats_key(url), mapping={"breaker_state": "closed", "breaker_failures": 0})
+            pipeline.delete(self.probe_key(url))
+            pipeline.execute()
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+
+    def breaker_failure(self, url: str) -> None:
+        if not self.available:
+            return
+        try:
+            client = get_redis(self.db)
+            failures = client.hincrby(self.stats_key(url), "breaker_failures", 1)
+            state = client.hget(self.stats_key(url), "breaker_state")
+            if state == b"half_open" or failures >= settings.proxy_breaker_failure_threshold:
+                pipeline = client.pipeline()
+                pipeline.hset(self.stats_key(url), mapping={"breaker_state": "open", "breaker_opened_at": time.time()})
+                pipeline.delete(self.probe_key(url))
+                pipeline.execute()
+        except redis.RedisError:
+            self._disabled_until = time.time() + self.backoff
+
+
+proxy_registry = ProxyRegistry(settings.proxy_registry_redis_db)
@@ -0,0 +1,257 @@
+import errno
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+from typing import List, Optional, Set, Tuple
+
+import httpx
+
+from app.config import Settings
+from app.governor import REQUESTS, check_throttled, raise_throttled, rate_governor
+from app.helper_classes import DownloadCancelledException
+from app.http_client import get_download_client
+from app.metrics import TRANSFER_BYTES, metrics
+
+settings = Settings()
+
+CHUNK_SIZE = 256 * 1024
+PIPE_POLL_INTERVAL = 0.05
+
+
+def split_into_segments(content_length: int, segment_size: int) -> List[Tuple[int, int]]:
+    """
+    Splits [0, content_length) into inclusive (start, end) byte ranges of at most segment_size bytes.
+    """
+    return [(start, min(start + segment_size, content_length) - 1) for start in range(0, content_length, segment_size)]
+
+
+def download_ranges(
+    url: str,
+    file_path: str,
+    content_length: int,
+    cancel_event: Optional[Event] = None,
+    itag: Optional[int] = None,
+) -> str:
+    """
+    Downloads url into file_path using parallel HTTP Range requests.
+
+    Bytes are written to a preallocated <file_path>.part with positional writes, so segments can finish in any
+    order. Completed segments are recorded in a <file_path>.part.json checkpoint; a later call for the same
+    itag and content length (e.g. a Celery retry with a freshly resolved URL) only fetches what is missing.
+    Falls back to a single sequential GET when the length is unknown or the server ignores the Range header.
+    """
+    if content_length is None or content_length <= 0:
+        return download_single(url, file_path, cancel_event)
+
+    part_path = f"{file_path}.part"
+    checkpoint = Checkpoint(f"{part_path}.json", itag, content_length, settings.download_segment_size)
+    resuming = checkpoint.load() and os.path.exists(part_path) and os.path.getsize(part_path) == content_length
+
+    if not resuming:
+        checkpoint.reset()
+
+    segments = [
+        segment
+        for segment in split_into_segments(content_length, settings.download_segment_size)
+        if segment not in checkpoint.completed
+    ]
+    client = get_download_client()
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT | (0 if resuming else os.O_TRUNC), 0o644)
+    try:
+        if not resuming:
+            preallocate(fd, content_length)
+
+            # The first segment doubles as the probe for Range support
+            if not fetch_segment(client, url, fd, segments[0], cancel_event):
+                os.close(fd)
+                fd = None
+                checkpoint.remove()
+                return download_single(url, file_path, cancel_event)
+            checkpoint.mark_completed(fd, segments[0])
+            segments = segments[1:]
+
+        def fetch_and_record(segment: Tuple[int, int]) -> None:
+            fetch_segment(client, url, fd, segment, cancel_event, require_range=True)
+            checkpoint.mark_completed(fd, segment)
+
+        if segments:
+            with ThreadPoolExecutor(max_workers=settings.download_segment_count) as executor:
+                for future in [executor.submit(fetch_and_record, segment) for segment in segments]:
+                    future.result()
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+    os.replace(part_path, file_path)
+    checkpoint.remove()
+
+    return file_path
+
+
+class Checkpoint:
+    """
+    Sidecar record of which byte ranges of a .part file are already on disk.
+    """
+
+    def __init__(self, path: str, itag: Optional[int], content_length: int, segment_size: int):
+        self.path = path
+        self.itag = itag
+        self.content_length = content_length
+        self.segment_size = segment_size
+        self.completed: Set[Tuple[int, int]] = set()
+        self._lock = Lock()
+
+    def load(self) -> bool:
+        """
+        Loads completed ranges from disk. Returns False if there is no checkpoint or it belongs to another stream.
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if (
+            data.get("itag") != self.itag
+            or data.get("content_length") != self.content_length
+            or data.get("segment_size") != self.segment_size
+        ):
+            return False
+
+        self.completed = {tuple(segment) for segment in data.get("completed", [])}
+        return True
+
+    def reset(self) -> None:
+        self.completed = set()
+        self._write()
+
+    def mark_completed(self, fd: int, segment: Tuple[int, int]) -> None:
+        # Make sure the bytes are on disk before the checkpoint claims they are
+        os.fdatasync(fd)
+        with self._lock:
+            self.completed.add(segment)
+            self._write()
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _write(self) -> None:
+        data = {
+            "itag": self.itag,
+            "content_length": self.content_length,
+            "segment_size": self.segment_size,
+            "completed": sorted(self.completed),
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+def fetch_segment(
+    client: httpx.Client,
+    url: str,
+    fd: int,
+    segment: Tuple[int, int],
+    cancel_event: Optional[Event] = None,
+    require_range: bool = False,
+) -> bool:
+    """
+    Fetches one byte range and writes it at its offset in fd, within the rate governor's limits.
+
+    Returns False without writing anything if the server answered with the full body instead of a 206.
+    """
+    start, end = segment
+    rate_governor.acquire(REQUESTS, url, cancel_event=cancel_event)
+    with client.stream("GET", url, headers={"Range": f"bytes={start}-{end}"}) as response:
+        check_throttled(response, url)
+        response.raise_for_status()
+        if response.status_code != 206:
+            if require_range:
+                raise httpx.HTTPError(f"Server stopped honouring Range requests for bytes {start}-{end}")
+            return False
+
+        offset = start
+        for chunk in rate_governor.iter_bytes(url, response.iter_bytes(CHUNK_SIZE), cancel_event):
+            if cancel_event is not None and cancel_event.is_set():
+                raise DownloadCancelledException("Download cancelled")
+            offset += os.pwrite(fd, chunk, offset)
+
+    if offset == start:
+        raise_throttled(url)
+    if offset != end + 1:
+        raise httpx.HTTPError(f"Short read for bytes {start}-{end}: got {offset - start} bytes")
+    metrics.inc(TRANSFER_BYTES, offset - start, {"method": "segmented"})
+    return True
+
+
+def download_single(url: str, file_path: str, cancel_event: Optional[Event] = None) -> str:
+    part_path = f"{file_path}.part"
+    client = get_download_client()
+    rate_governor.acquire(REQUESTS, url, cancel_event=cancel_event)
+    with client.stream("GET", url) as response, open(part_path, "wb") as f:
+        check_throttled(response, url)
+        response.raise_for_status()
+        for chunk in rate_governor.iter_bytes(url, response.iter_bytes(CHUNK_SIZE), cancel_event):
+            if cancel_event is not None and cancel_event.is_set():
+                raise DownloadCancelledException("Download cancelled")
+            f.write(chunk)
+    metrics.inc(TRANSFER_BYTES, os.path.getsize(part_path), {"method": "single"})
+    os.replace(part_path, file_path)
+    return file_path
+
+
+def open_pipe(pipe_path: str, cancel_event: Optional[Event] = None):
+    """
+    Opens a named pipe for writing once its reader (ffmpeg) has opened it. A blocking open would wait forever if the
+    reader exits first, so the pipe is polled without blocking until it has a reader or cancel_event is set.
+    """
+    cancel_event = cancel_event or Event()
+    while True:
+        try:
+            fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            # ENXIO means nothing has the pipe open for reading yet
+            if e.errno != errno.ENXIO:
+                raise
+        if cancel_event.wait(PIPE_POLL_INTERVAL):
+            raise DownloadCancelledException("Download cancelled")
+    os.set_blocking(fd, True)
+    return os.fdopen(fd, "wb")
+
+
+def download_to_pipe(url: str, pipe_path: str, cancel_event: Optional[Event] = None) -> None:
+    """
+    Streams the body of url into a named pipe, once its reader (ffmpeg) opens it.
+    """
+    client = get_download_client()
+    transferred = 0
+    rate_governor.acquire(REQUESTS, url, cancel_event=cancel_event)
+    try:
+        with open_pipe(pipe_path, cancel_event) as pipe, client.stream("GET", url) as response:
+            check_throttled(response, url)
+            response.raise_for_status()
+            for chunk in rate_governor.iter_bytes(url, response.iter_bytes(CHUNK_SIZE), cancel_event):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise DownloadCancelledException("Download cancelled")
+                pipe.write(chunk)
+                transferred += len(chunk)
+    finally:
+        metrics.inc(TRANSFER_BYTES, transferred, {"method": "pipe"})
+
+
+def preallocate(fd: int, size: int) -> None:
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not every filesystem (e.g. some NFS mounts) supports fallocate
+            pass
+    os.ftruncate(fd, size)
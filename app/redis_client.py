@@ -0,0 +1,59 @@
+from typing import Dict
+
+import redis
+import redis.asyncio
+
+from app.config import Settings
+
+settings = Settings()
+
+redis_version = "redis" if settings.redis_tls == 0 else "rediss"
+
+_clients: Dict[int, redis.Redis] = {}
+
+
+def build_redis_url(user: str, password: str, host: str, port: int, db: int) -> str:
+    return (
+        f"{redis_version}://"
+        + f"{user}"
+        + f"{':' if password != '' else ''}"
+        + f"{password}"
+        + f"{'@' if password != '' else ''}"
+        + f"{host}:{port}"
+        + f"/{db}"
+    )
+
+
+def get_redis(db: int) -> redis.Redis:
+    """
+    Returns a shared client for the given db on the Celery broker's Redis server.
+    """
+    if db not in _clients:
+        url = build_redis_url(
+            settings.celery_broker_user,
+            settings.celery_broker_password,
+            settings.celery_broker_host,
+            settings.celery_broker_port,
+            db,
+        )
+        _clients[db] = redis.Redis.from_url(
+            url,
+            socket_connect_timeout=settings.redis_socket_timeout,
+            socket_timeout=settings.redis_socket_timeout,
+        )
+    return _clients[db]
+
+
+def get_async_redis(db: int) -> redis.asyncio.Redis:
+    """
+    Returns a new asyncio client for the given db on the Celery broker's Redis server. It is bound to the running event
+    loop, so unlike get_redis it isn't shared, and the caller closes it.
+    """
+    url = build_redis_url(
+        settings.celery_broker_user,
+        settings.celery_broker_password,
+        settings.celery_broker_host,
+        settings.celery_broker_port,
+        db,
+    )
+    return redis.asyncio.Redis.from_url(url, socket_connect_timeout=settings.redis_socket_timeout)
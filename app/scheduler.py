@@ -0,0 +1,261 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.cache import metadata_cache
+from app.config import Settings
+from app.dash_clip import get_clip_fraction, get_payload_clip
+from app.Piped import Piped
+from app.redis_client import get_redis
+from app.Stream import get_stream_size
+from app.stream_policy import StreamPolicy, get_payload_policy
+
+settings = Settings()
+
+# Celery priority band of each priority hint. On the Redis transport 0 is the highest priority.
+PRIORITY_BANDS = {"high": 0, "normal": 3, "low": 6}
+
+# Queues a client's jobs and adds the client to the round-robin ring if it wasn't in it.
+# KEYS: client queue, active clients set, ring list
+# ARGV: client, job entries...
+PUSH_SCRIPT = """
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+"""
+
+# Takes a client out of the ring, unless jobs were queued for it in the meantime.
+# KEYS: client queue, active clients set, ring list, deficits hash
+# ARGV: client
+REMOVE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) > 0 then
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[1])
+redis.call('LREM', KEYS[3], 0, ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+return 1
+"""
+
+
+def get_stream_sizes(
+    video_id: str,
+    mode: str,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> Dict[str, int]:
+    """
+    Returns the size in bytes of each stream a download would pick, audio and, unless mode is audio, video, from their
+    content length or else their bitrate. Clips get their share of the video's length. The metadata fetched here is
+    cached, so the worker doesn't fetch it again.
+    """
+    piped_obj = Piped(video_id)
+    if mode == "audio":
+        streams = {"audio": piped_obj.get_best_audio_stream(policy)}
+    else:
+        streams = dict(zip(("audio", "video"), piped_obj.get_streams(policy, format_out)))
+    clip_fraction = get_clip_fraction(piped_obj.duration, start, end)
+    return {kind: int(get_stream_size(stream, piped_obj.duration) * clip_fraction) for kind, stream in streams.items()}
+
+
+def estimate_cost(
+    video_id: str,
+    mode: str,
+    duration: Optional[int] = None,
+    format_out: str = "mp4",
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> int:
+    """
+    Estimates how many bytes a download transfers.
+
+    The size comes from the streams the download would pick, when the video's metadata is already cached. Jobs are
+    estimated while their request waits, so the metadata is never fetched for this. When only the duration is known,
+    as for playlist entries, it is multiplied by a typical bitrate instead.
+    """
+    if duration:
+        bitrate = settings.scheduler_audio_bitrate if mode == "audio" else settings.scheduler_av_bitrate
+        return int(duration * bitrate / 8 * get_clip_fraction(duration, start, end))
+    if not settings.scheduler_estimate_costs or not settings.metadata_cache_enabled:
+        return settings.scheduler_default_cost
+    if metadata_cache.get(video_id) is None:
+        return settings.scheduler_default_cost
+    try:
+        return (
+            sum(get_stream_sizes(video_id, mode, format_out, policy, start, end).values())
+            or settings.scheduler_default_cost
+        )
+    except Exception:
+        return settings.scheduler_default_cost
+
+
+def estimate_costs(mode: str, payloads: List[dict]) -> List[int]:
+    """
+    Estimates the cost of many downloads, looking their metadata up concurrently.
+    """
+
+    def estimate_payload_cost(payload: dict) -> int:
+        return estimate_cost(
+            payload["video_id"],
+            mode,
+            payload.get("duration"),
+            payload.get("format_out", "mp4"),
+            get_payload_policy(payload),
+            *get_payload_clip(payload),
+        )
+
+    with ThreadPoolExecutor(max_workers=settings.scheduler_estimate_concurrency) as executor:
+        return list(executor.map(estimate_payload_cost, payloads))
+
+
+def get_priority(cost: int, hint: str = "normal") -> int:
+    """
+    Returns the Celery priority of a job. The hint picks a band of three levels and the estimated cost picks the level
+    within it, so short jobs overtake long ones with the same hint.
+    """
+    tier = sum(cost >= threshold for threshold in settings.scheduler_cost_tiers)
+    return PRIORITY_BANDS.get(hint, PRIORITY_BANDS["normal"]) + min(tier, 2)
+
+
+class FairScheduler:
+    """
+    Per-client fair queueing in front of the Celery queues.
+
+    Jobs wait in one Redis list per client and are released to Celery by deficit round-robin: on each turn a client's
+    deficit grows by scheduler_quantum bytes, and its queued jobs are released while their estimated cost fits in it.
+    Clients with many or large jobs therefore get the same share of throughput as everyone else instead of filling the
+    broker queue ahead of them. Only enough jobs to keep scheduler_backlog_target messages in the broker are released
+    at a time, and a single dispatcher runs at once.
+    """
+
+    def __init__(self, db: int, prefix: str = "vidyodl:fair"):
+        self.db = db
+        self.prefix = prefix
+        self.ring_key = f"{prefix}:ring"
+        self.active_key = f"{prefix}:active"
+        self.deficits_key = f"{prefix}:deficits"
+        self._push_script = None
+        self._remove_script = None
+
+    def queue_key(self, client: str) -> str:
+        return f"{self.prefix}:queue:{client}"
+
+    def push(self, client: str, jobs: List[Tuple[dict, int]]) -> None:
+        """
+        Queues (signature, cost) pairs for a client.
+        """
+        if jobs:
+            self._push(client, [json.dumps({"signature": signature, "cost": cost}) for signature, cost in jobs])
+
+    def _push(self, client: str, entries: List[str]) -> None:
+        if self._push_script is None:
+            self._push_script = get_redis(self.db).register_script(PUSH_SCRIPT)
+        self._push_script(keys=[self.queue_key(client), self.active_key, self.ring_key], args=[client, *entries])
+
+    def push_front(self, client: str, entries: List[dict]) -> None:
+        """
+        Puts popped entries back at the head of a client's queue, in their original order.
+        """
+        client_key = self.queue_key(client)
+        pipeline = get_redis(self.db).pipeline()
+        for entry in reversed(entries):
+            pipeline.lpush(client_key, json.dumps(entry))
+        pipeline.execute()
+        # Puts the client back in the ring in case it was taken out when its queue ran empty
+        self._push(client, [])
+
+    def remove_if_empty(self, client: str) -> None:
+        if self._remove_script is None:
+            self._remove_script = get_redis(self.db).register_script(REMOVE_SCRIPT)
+        self._remove_script(
+            keys=[self.queue_key(client), self.active_key, self.ring_key, self.deficits_key], args=[client]
+        )
+
+    def get_pending(self) -> dict:
+        """
+        Returns the number of queued jobs of every client with jobs waiting.
+        """
+        redis_client = get_redis(self.db)
+        clients = [client.decode() for client in redis_client.lrange(self.ring_key, 0, -1)]
+        pipeline = redis_client.pipeline()
+        for client in clients:
+            pipeline.llen(self.queue_key(client))
+        return dict(zip(clients, pipeline.execute()))
+
+    def dispatch(self, budget: int, send: Callable[[List[dict]], None], byte_budget: Optional[int] = None) -> int:
+        """
+        Releases up to budget jobs in deficit round-robin order and passes their signatures to send in one call.
+        With byte_budget, jobs are also held back once their estimated costs would add up to more than it, so jobs
+        wait here rather than in the workers while the disk is full. Returns the number of jobs released, or 0 if
+        another dispatcher is running.
+        """
+        if budget <= 0 or (byte_budget is not None and byte_budget <= 0):
+            return 0
+        redis_client = get_redis(self.db)
+        lock = redis_client.lock(f"{self.prefix}:dispatch", timeout=60)
+        if not lock.acquire(blocking=False):
+            return 0
+
+        released = {}
+        try:
+            visits = 0
+            while budget > 0 and visits < settings.scheduler_max_visits:
+                client = redis_client.lmove(self.ring_key, self.ring_key, "LEFT", "RIGHT")
+                if client is None:
+                    break
+                client = client.decode()
+                visits += 1
+
+                deficit = float(redis_client.hget(self.deficits_key, client) or 0) + settings.scheduler_quantum
+                visit_released = 0
+                byte_limited = False
+                while budget > 0:
+                    head = redis_client.lindex(self.queue_key(client), 0)
+                    if head is None:
+                        break
+                    entry = json.loads(head)
+                    if entry["cost"] > deficit:
+                        break
+                    if byte_budget is not None and entry["cost"] > byte_budget:
+                        byte_limited = True
+                        break
+                    redis_client.lpop(self.queue_key(client))
+                    released.setdefault(client, []).append(entry)
+                    deficit -= entry["cost"]
+                    budget -= 1
+                    visit_released += 1
+                    if byte_budget is not None:
+                        byte_budget -= entry["cost"]
+
+                if byte_limited and not visit_released:
+                    # The disk, not the client's share, held the job back, so the client keeps its turn and its
+                    # deficit for the next dispatch
+                    redis_client.lmove(self.ring_key, self.ring_key, "RIGHT", "LEFT")
+                elif redis_client.llen(self.queue_key(client)) == 0:
+                    self.remove_if_empty(client)
+                else:
+                    redis_client.hset(self.deficits_key, client, deficit)
+                if byte_limited:
+                    # The rest of the ring waits for the next dispatch, rather than going round until
+                    # scheduler_max_visits and crediting a deficit on every visit
+                    break
+
+            if released:
+                try:
+                    send([entry["signature"] for entries in released.values() for entry in entries])
+                except Exception:
+                    for client, entries in released.items():
+                        self.push_front(client, entries)
+                    raise
+        finally:
+            lock.release()
+        return sum(len(entries) for entries in released.values())
+
+
+fair_scheduler = FairScheduler(settings.scheduler_redis_db)
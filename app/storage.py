@@ -0,0 +1,203 @@
+import os
+import shutil
+import time
+from typing import Optional, Tuple
+
+import redis
+
+from app.catalog import catalog
+from app.config import Settings
+from app.dash_clip import get_payload_clip
+from app.metrics import EVICTED_BYTES, metrics
+from app.redis_client import get_redis
+from app.scheduler import get_stream_sizes
+from app.stream_policy import get_payload_policy
+
+settings = Settings()
+
+RESERVATIONS_KEY = "vidyodl:disk:reservations"
+EXPIRY_KEY = "vidyodl:disk:expiry"
+
+# Drops expired reservations, then records a reservation if its bytes fit in the available bytes next to every other
+# reservation. Reserving the same part again replaces its earlier size. Returns whether it fit and the bytes reserved
+# by the other reservations.
+# KEYS: reservations hash, expiry sorted set
+# ARGV: reservation, bytes, available bytes, now, expiry time
+RESERVE_SCRIPT = """
+for _, reservation in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[4])) do
+    redis.call('HDEL', KEYS[1], reservation)
+    redis.call('ZREM', KEYS[2], reservation)
+end
+local reserved = 0
+for _, size in ipairs(redis.call('HVALS', KEYS[1])) do
+    reserved = reserved + tonumber(size)
+end
+reserved = reserved - tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+if reserved + tonumber(ARGV[2]) > tonumber(ARGV[3]) then
+    return {0, reserved}
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[5], ARGV[1])
+return {1, reserved}
+"""
+
+# Deletes every part of a job's reservation.
+# KEYS: reservations hash, expiry sorted set
+# ARGV: job ID followed by the separator
+RELEASE_SCRIPT = """
+for _, reservation in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if string.sub(reservation, 1, #ARGV[1]) == ARGV[1] then
+        redis.call('HDEL', KEYS[1], reservation)
+        redis.call('ZREM', KEYS[2], reservation)
+    end
+end
+"""
+
+
+class InsufficientSpaceException(Exception):
+    """
+    Exception raised when the disk has no room for a download, even after evicting idle outputs.
+    """
+
+    pass
+
+
+def get_free_bytes() -> int:
+    """
+    Free bytes on the download volume above disk_min_free_bytes.
+    """
+    return shutil.disk_usage(settings.download_path).free - settings.disk_min_free_bytes
+
+
+def get_reservation_size(mode: str, payload: dict, kinds: Tuple[str, ...], copies: int) -> int:
+    """
+    Bytes to reserve for a job's streams of the given kinds when copies times their size is on disk at its peak.
+    """
+    try:
+        sizes = get_stream_sizes(
+            payload["video_id"],
+            mode,
+            payload.get("format_out", "mp4"),
+            get_payload_policy(payload),
+            *get_payload_clip(payload),
+        )
+        return sum(sizes[kind] for kind in kinds) * copies
+    except Exception:
+        # The download resolves the metadata again and reports the failure itself
+        return settings.scheduler_default_cost * copies
+
+
+def remove_intermediates(*paths: Optional[str]) -> None:
+    """
+    Deletes the downloaded streams of a job once its output is written. Paths that are completed outputs in the catalog
+    are kept, since other jobs serve them.
+    """
+    if not settings.cleanup_intermediates:
+        return
+    for path in paths:
+        if path is None or catalog.contains(path):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def evict_outputs(needed: int = 0) -> int:
+    """
+    Deletes completed outputs, least recently used first, until their total size is under store_max_bytes and at
+    least needed bytes were freed. Outputs used in the last store_min_idle seconds are kept. Returns the bytes freed.
+    """
+    if not settings.store_eviction_enabled:
+        return 0
+    target = needed
+    if settings.store_max_bytes:
+        target = max(target, catalog.get_total_size() - settings.store_max_bytes)
+    freed = 0
+    if target <= 0:
+        return freed
+
+    for entry in catalog.list_least_recently_used(time.time() - settings.store_min_idle):
+        if freed >= target:
+            break
+        try:
+            size = entry["size"] or os.path.getsize(entry["path"])
+            os.remove(entry["path"])
+            freed += size
+        except FileNotFoundError:
+            pass
+        catalog.remove(entry["path"])
+    if freed:
+        metrics.inc(EVICTED_BYTES, freed)
+    return freed
+
+
+class DiskReservations:
+    """
+    Disk space set aside for running jobs, shared by every process through Redis.
+
+    A job reserves what it will write before it starts writing, one part per stage that downloads, and releases every
+    part once it finishes for good. A reservation only fits if the free space left by every other one covers it, so
+    jobs wait instead of failing halfway with a full disk. Reservations are held until the job ends, so the bytes a
+    running job has already written are counted against the free space twice, erring on the side of waiting.
+    """
+
+    def __init__(self, db: int):
+        self.db = db
+        self._reserve_script = None
+        self._release_script = None
+
+    def reserve(self, job_id: str, part: str, size: int) -> bool:
+        """
+        Reserves size bytes for a part of a job, evicting idle outputs to make room if needed. Returns False if it
+        doesn't fit. Without Redis, the size is only checked against the free space.
+        """
+        if not settings.disk_admission_enabled:
+            return True
+        fits, reserved = self._reserve(job_id, part, size)
+        if not fits and evict_outputs(reserved + size - get_free_bytes()) > 0:
+            fits, _ = self._reserve(job_id, part, size)
+        return fits
+
+    def _reserve(self, job_id: str, part: str, size: int) -> tuple:
+        available = get_free_bytes()
+        try:
+            if self._reserve_script is None:
+                self._reserve_script = get_redis(self.db).register_script(RESERVE_SCRIPT)
+            now = time.time()
+            fits, reserved = self._reserve_script(
+                keys=[RESERVATIONS_KEY, EXPIRY_KEY],
+                args=[f"{job_id}:{part}", size, available, now, now + settings.disk_reservation_ttl],
+            )
+            return bool(fits), reserved
+        except redis.RedisError:
+            return size <= available, 0
+
+    def release(self, job_id: str) -> None:
+        if not settings.disk_admission_enabled:
+            return
+        try:
+            if self._release_script is None:
+                self._release_script = get_redis(self.db).register_script(RELEASE_SCRIPT)
+            self._release_script(keys=[RESERVATIONS_KEY, EXPIRY_KEY], args=[f"{job_id}:"])
+        except redis.RedisError:
+            # The reservation expires on its own
+            pass
+
+    def get_reserved(self) -> int:
+        """
+        Bytes reserved by running jobs, expired reservations included until the next reservation drops them.
+        """
+        return sum(int(size) for size in get_redis(self.db).hvals(RESERVATIONS_KEY))
+
+    def get_available(self) -> int:
+        """
+        Bytes new jobs can still reserve, counting the outputs eviction could delete for them.
+        """
+        available = get_free_bytes() - self.get_reserved()
+        if settings.store_eviction_enabled:
+            available += catalog.get_total_size(time.time() - settings.store_min_idle)
+        return available
+
+
+disk_reservations = DiskReservations(settings.disk_redis_db)
@@ -0,0 +1,200 @@
+import hashlib
+import json
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from app.dash_clip import get_clip_key
+from app.Stream import Stream, get_stream_size
+
+# Codecs each output container can take by stream copy. None means any codec.
+CONTAINER_CODECS = {
+    "mp4": {"video": {"avc1", "av01", "vp9", "hev1", "hvc1"}, "audio": {"mp4a", "mp3"}},
+    "webm": {"video": {"vp8", "vp9", "av01"}, "audio": {"opus", "vorbis"}},
+    "mkv": {"video": None, "audio": None},
+}
+
+# ffmpeg muxer name of each output container
+CONTAINER_FORMATS = {"mp4": "mp4", "webm": "webm", "mkv": "matroska"}
+
+# Codec each ffmpeg encoder writes, named as in CONTAINER_CODECS
+ENCODER_CODECS = {
+    "libx264": "avc1",
+    "libx265": "hev1",
+    "libvpx-vp9": "vp9",
+    "libsvtav1": "av01",
+    "aac": "mp4a",
+    "libopus": "opus",
+    "libvorbis": "vorbis",
+    "libmp3lame": "mp3",
+}
+
+
+class NoCompatibleStreamsException(Exception):
+    """
+    Exception raised when no streams of a video satisfy a stream policy.
+    """
+
+    pass
+
+
+class IncompatibleEncoderException(ValueError):
+    """
+    Exception raised when an encoder writes a codec the output container can't hold.
+    """
+
+    pass
+
+
+def check_encoders(format_out: str, vcodec_out: str = "copy", acodec_out: str = "copy") -> None:
+    """
+    Raises IncompatibleEncoderException if the output container can't hold what vcodec_out or acodec_out write. Copied
+    streams are always picked to fit the container.
+    """
+    for kind, encoder in (("video", vcodec_out), ("audio", acodec_out)):
+        if encoder == "copy":
+            continue
+        codecs = CONTAINER_CODECS.get(format_out, {}).get(kind)
+        if codecs is not None and ENCODER_CODECS.get(encoder) not in codecs:
+            raise IncompatibleEncoderException(f"{format_out} can't hold {kind} encoded with {encoder}")
+
+
+class StreamPolicy(BaseModel):
+    """
+    Constraints and preferences for picking the streams of a download.
+
+    - **max_height**: Highest video resolution to fetch. The tallest stream at or below it is picked, or the shortest
+    one if every stream is taller.
+    - **max_fps**: Highest video frame rate to fetch.
+    - **max_size**: Estimated size in bytes the audio and video together should stay under. Lower resolutions are
+    tried until the pair fits, and the smallest pair is used if none does.
+    - **video_codecs** / **audio_codecs**: Preferred codecs, best first, such as avc1, vp9, av01, mp4a or opus. They
+    break ties between video streams of the same resolution, and pick the audio codec.
+    """
+
+    max_height: Optional[int] = None
+    max_fps: Optional[int] = None
+    max_size: Optional[int] = None
+    video_codecs: List[str] = []
+    audio_codecs: List[str] = []
+
+    @property
+    def key(self) -> str:
+        """
+        Short fingerprint of a non-default policy, used to tell its outputs apart. Empty for the default policy.
+        """
+        values = self.model_dump(exclude_defaults=True)
+        if not values:
+            return ""
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def get_payload_policy(payload: dict) -> StreamPolicy:
+    return StreamPolicy(**payload.get("policy", {}))
+
+
+def get_output_name(
+    video_id: str,
+    policy: Optional[StreamPolicy] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    transcode_key: str = "",
+) -> str:
+    """
+    File name of a download's output and intermediate files, so outputs of different policies, clips and encoders
+    don't overwrite each other.
+    """
+    parts = [video_id]
+    if policy is not None and policy.key:
+        parts.append(policy.key)
+    clip_key = get_clip_key(start, end)
+    if clip_key:
+        parts.append(clip_key)
+    if transcode_key:
+        parts.append(transcode_key)
+    return "-".join(parts)
+
+
+def get_codec_family(stream: Stream) -> str:
+    codec = (stream.codec or "").split(".")[0].lower()
+    return "vp9" if codec == "vp09" else codec
+
+
+def is_copy_compatible(stream: Stream, kind: str, format_out: Optional[str]) -> bool:
+    if format_out is None:
+        return True
+    codecs = CONTAINER_CODECS.get(format_out, {}).get(kind)
+    return codecs is None or get_codec_family(stream) in codecs
+
+
+def get_codec_rank(stream: Stream, preferred_codecs: List[str]) -> int:
+    preferred_codecs = [codec.lower() for codec in preferred_codecs]
+    codec = get_codec_family(stream)
+    return preferred_codecs.index(codec) if codec in preferred_codecs else len(preferred_codecs)
+
+
+def select_audio_stream(audio_streams: List[Stream], policy: StreamPolicy, format_out: Optional[str] = None) -> Stream:
+    """
+    Picks the highest bitrate audio stream that can be copied into format_out, in the most preferred codec.
+    """
+    candidates = [stream for stream in audio_streams if is_copy_compatible(stream, "audio", format_out)]
+    if not candidates:
+        raise NoCompatibleStreamsException(f"No audio stream can be copied into {format_out}")
+    return min(candidates, key=lambda stream: (get_codec_rank(stream, policy.audio_codecs), -(stream.bitrate or 0)))
+
+
+def get_height_rank(stream: Stream, max_height: Optional[int]) -> int:
+    # Streams at or below the target come first, tallest first, followed by the taller ones, shortest first
+    height = stream.height or 0
+    if max_height is None or height <= max_height:
+        return -height
+    return height
+
+
+def select_video_candidates(
+    video_streams: List[Stream], policy: StreamPolicy, format_out: Optional[str] = None
+) -> List[Stream]:
+    """
+    Returns the video streams the policy allows, best first: tallest at or below max_height, then most preferred
+    codec, then highest frame rate within max_fps, then fewest bytes.
+    """
+    # Streams that carry audio too are only used when a video has nothing else
+    candidates = [stream for stream in video_streams if stream.video_only] or list(video_streams)
+    candidates = [stream for stream in candidates if is_copy_compatible(stream, "video", format_out)]
+    if policy.max_fps is not None:
+        candidates = [stream for stream in candidates if (stream.fps or 0) <= policy.max_fps] or candidates
+    if not candidates:
+        raise NoCompatibleStreamsException(f"No video stream can be copied into {format_out}")
+
+    return sorted(
+        candidates,
+        key=lambda stream: (
+            get_height_rank(stream, policy.max_height),
+            get_codec_rank(stream, policy.video_codecs),
+            -(stream.fps or 0),
+            stream.content_length or stream.bitrate or 0,
+        ),
+    )
+
+
+def select_streams(
+    audio_streams: List[Stream],
+    video_streams: List[Stream],
+    policy: StreamPolicy,
+    format_out: str = "mp4",
+    duration: int = 0,
+) -> Tuple[Stream, Stream]:
+    """
+    Picks an audio and video stream pair that ffmpeg can stream copy into format_out. The choice only depends on the
+    streams and the policy, so separate fetch tasks for the same download pick the same pair.
+    """
+    audio_stream = select_audio_stream(audio_streams, policy, format_out)
+    video_candidates = select_video_candidates(video_streams, policy, format_out)
+    if policy.max_size is None:
+        return audio_stream, video_candidates[0]
+
+    audio_size = get_stream_size(audio_stream, duration)
+    for video_stream in video_candidates:
+        if audio_size + get_stream_size(video_stream, duration) <= policy.max_size:
+            return audio_stream, video_stream
+    return audio_stream, min(video_candidates, key=lambda stream: get_stream_size(stream, duration))
@@ -1,35 +1,73 @@
+import json
+from functools import partial
+from typing import Optional, Tuple
+
 import celery
+from celery import chord, group
+from celery.signals import worker_process_shutdown
+from kombu.exceptions import ChannelError
 
 from app import config
+from app.cache import metadata_cache
+from app.dash_clip import get_payload_clip, is_clip
+from app.dedup import (
+    get_completed_output,
+    get_job_format,
+    get_job_output_name,
+    mark_completed,
+    prepare_job,
+    release_job,
+)
 from app.download_utils import (
     combine_audio_video,
     download_audio_from_piped,
     download_piped_video,
+    download_video_from_piped,
+    get_completed_path,
+    mux_av_from_piped,
 )
+from app.events import publish_event
+from app.governor import ThrottledException
 from app.helper_classes import Status
-from app.proxy_functions import update_fastest_proxy
+from app.http_client import close_http_clients
+from app.metrics import JobProgress, metrics
+from app.PipedPlaylist import PipedPlaylist, get_video_entries
+from app.proxy_functions import refresh_proxy_registry
+from app.redis_client import build_redis_url
+from app.scheduler import estimate_costs, fair_scheduler, get_priority
+from app.storage import (
+    InsufficientSpaceException,
+    disk_reservations,
+    evict_outputs,
+    get_reservation_size,
+    remove_intermediates,
+)
+from app.Stream import run_ffmpeg
+from app.stream_policy import get_payload_policy
+from app.transcode import (
+    EncodeJob,
+    concat_segments,
+    get_payload_codecs,
+    get_transcode_key,
+    is_chunked_transcode,
+    plan_transcode,
+)
 
 settings = config.Settings()
 
-redis_version = "redis" if settings.redis_tls == 0 else "rediss"
-
-celery_broker = (
-    f"{redis_version}://"
-    + f"{settings.celery_broker_user}"
-    + f"{':' if settings.celery_broker_password != '' else ''}"
-    + f"{settings.celery_broker_password}"
-    + f"{'@' if settings.celery_broker_password != '' else ''}"
-    + f"{settings.celery_broker_host}:{settings.celery_broker_port}"
-    + f"/{settings.celery_broker_db}"
+celery_broker = build_redis_url(
+    settings.celery_broker_user,
+    settings.celery_broker_password,
+    settings.celery_broker_host,
+    settings.celery_broker_port,
+    settings.celery_broker_db,
 )
-celery_backend = (
-    f"{redis_version}://"
-    + f"{settings.celery_backend_user}"
-    + f"{':' if settings.celery_backend_password != '' else ''}"
-    + f"{settings.celery_backend_password}"
-    + f"{'@' if settings.celery_backend_password != '' else ''}"
-    + f"{settings.celery_backend_host}:{settings.celery_backend_port}"
-    + f"/{settings.celery_backend_db}"
+celery_backend = build_redis_url(
+    settings.celery_backend_user,
+    settings.celery_backend_password,
+    settings.celery_backend_host,
+    settings.celery_backend_port,
+    settings.celery_backend_db,
 )
 
 celery_app = celery.Celery(
@@ -40,6 +78,43 @@ celery_app = celery.Celery(
     broker_connection_retry_on_startup=True,
 )
 
+celery_app.conf.beat_schedule = {
+    "refresh-proxy-registry": {
+        "task": "app.tasks.refresh_proxies_task",
+        "schedule": settings.proxy_healthcheck_interval,
+    },
+}
+if settings.scheduler_enabled:
+    celery_app.conf.beat_schedule["dispatch-downloads"] = {
+        "task": "app.tasks.dispatch_downloads_task",
+        "schedule": settings.scheduler_dispatch_interval,
+        "options": {"expires": settings.scheduler_dispatch_interval, "priority": 0},
+    }
+if settings.store_eviction_enabled and settings.store_max_bytes:
+    celery_app.conf.beat_schedule["evict-outputs"] = {
+        "task": "app.tasks.evict_outputs_task",
+        "schedule": settings.store_eviction_interval,
+    }
+
+# Ten priority levels instead of the Redis transport's default four. 0 is the highest.
+celery_app.conf.broker_transport_options = {"priority_steps": list(range(10))}
+
+# Network-bound stages go to the I/O queue and ffmpeg to the CPU queue. Everything else stays on the default queue.
+celery_app.conf.task_routes = {
+    "app.tasks.fetch_stream_task": {"queue": settings.celery_io_queue},
+    "app.tasks.download_piped_audio_task": {"queue": settings.celery_io_queue},
+    "app.tasks.mux_av_task": {"queue": settings.celery_cpu_queue},
+    "app.tasks.transcode_segment_task": {"queue": settings.celery_cpu_queue},
+    "app.tasks.concat_segments_task": {"queue": settings.celery_cpu_queue},
+    "app.tasks.dispatch_downloads_task": {"queue": settings.celery_io_queue},
+}
+
+
+@worker_process_shutdown.connect
+def close_worker_http_clients(**kwargs):
+    close_http_clients()
+    metrics.flush()
+
 
 class SubtaskException(Exception):
     """
@@ -49,44 +124,571 @@ class SubtaskException(Exception):
     pass
 
 
+def uses_stream_mux(payload: dict) -> bool:
+    # Clips are cut from their own fragments and transcodes need the streams on disk, which the stream muxer can't do
+    return (
+        payload.get("stream_mux", False)
+        and not is_clip(*get_payload_clip(payload))
+        and get_payload_codecs(payload) == ("copy", "copy")
+    )
+
+
+def get_disk_copies(payload: dict) -> int:
+    """
+    How many times the size of its streams an audio and video job has on disk at its peak: the streams themselves,
+    unless they are stream muxed, the output, and the encoded segments of a chunked transcode.
+    """
+    if uses_stream_mux(payload):
+        return 1
+    return 3 if is_chunked_transcode(get_payload_codecs(payload)[0]) else 2
+
+
+def reserve_disk_space(
+    task: celery.Task, job_task_id: str, mode: str, payload: dict, kinds: Tuple[str, ...], copies: int
+) -> None:
+    """
+    Reserves the disk space a task's streams of the given kinds need before it downloads them. When they don't fit,
+    the task is retried after disk_retry_delay seconds, as often as it takes for space to free up.
+    """
+    if not settings.disk_admission_enabled:
+        return
+    size = get_reservation_size(mode, payload, kinds, copies)
+    if not disk_reservations.reserve(job_task_id, "+".join(kinds), size):
+        raise task.retry(
+            exc=InsufficientSpaceException(f"No disk space for {size} bytes"),
+            countdown=settings.disk_retry_delay,
+            max_retries=None,
+        )
+
+
+def report_progress(task_id: str, meta: dict, payload: Optional[dict] = None) -> None:
+    """
+    Stores a job's progress as the PROGRESS state of the task that produces its output, which /status returns as its
+    result until the job finishes, and publishes it to /events subscribers.
+    """
+    celery_app.backend.store_result(task_id, meta, "PROGRESS")
+    publish_event("progress", task_id, payload, meta=meta)
+
+
+def get_job_progress(task_id: str, payload: Optional[dict] = None) -> JobProgress:
+    return JobProgress(partial(report_progress, task_id, payload=payload))
+
+
+def report_transcode_progress(task_id: str, segments_done: int, segments_total: int) -> None:
+    report_progress(
+        task_id,
+        {
+            "stages": ["transcode"],
+            "segments_done": segments_done,
+            "segments_total": segments_total,
+            "done": segments_done == segments_total,
+        },
+    )
+
+
+class DeduplicatedTask(celery.Task):
+    """
+    Base for download tasks that hold a single-flight claim on their (video_id, mode, format) job.
+
+    The claim and the job's disk reservation are released once the task finishes for good, and a successful output is
+    recorded in the catalog so later requests for the same job return it straight away. Retries keep the claim. The
+    job's success or failure is then published to /events subscribers.
+    """
+
+    dedup_mode = "av"
+    # Position of the payload in the task's arguments
+    payload_index = 0
+
+    def get_job(self, payload: dict) -> tuple:
+        return payload["video_id"], self.dedup_mode, get_job_format(self.dedup_mode, payload)
+
+    def on_success(self, retval, task_id, args, kwargs):
+        payload = args[self.payload_index]
+        if settings.dedup_enabled:
+            video_id, mode, format_out = self.get_job(payload)
+            if isinstance(retval, dict) and retval.get("status") == Status.OK:
+                mark_completed(video_id, mode, format_out, retval["info"], retval.get("details"))
+            release_job(video_id, mode, format_out, task_id)
+        disk_reservations.release(task_id)
+        publish_event("success", task_id, payload, result=retval)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        payload = args[self.payload_index]
+        if settings.dedup_enabled:
+            release_job(*self.get_job(payload), task_id)
+        disk_reservations.release(task_id)
+        # A task with an error callback, such as the pipeline's mux task, leaves publishing the failure to it
+        if not self.request.errbacks:
+            publish_event("failure", task_id, payload, error=str(exc))
+
+    def get_completed_output(self, payload: dict):
+        if not settings.dedup_enabled:
+            return None
+        return get_completed_output(*self.get_job(payload))
+
+
+def forget_stream_urls(video_id: str) -> None:
+    """
+    Drops a video's cached metadata after a failed transfer, so the retry resolves fresh stream URLs instead of getting
+    the same, possibly dead, ones back.
+    """
+    if settings.metadata_cache_enabled:
+        metadata_cache.delete(video_id)
+
+
 @celery_app.task(
     bind=True,
+    base=DeduplicatedTask,
+    dedup_mode="av",
     autoretry_for=(SubtaskException,),
     default_retry_delay=settings.celery_retry_delay,
     retries=settings.celery_retry_max,
 )
 def download_piped_video_task(self, payload: dict):
     video_id = payload["video_id"]
-    download_result = download_piped_video(video_id)
+    format_out = payload.get("format_out", "mp4")
+    policy = get_payload_policy(payload)
+    start, end = get_payload_clip(payload)
+
+    completed_path = self.get_completed_output(payload)
+    if completed_path is not None:
+        return {"status": Status.OK, "info": completed_path}
+
+    reserve_disk_space(self, self.request.id, "av", payload, ("audio", "video"), get_disk_copies(payload))
+    job = get_job_progress(self.request.id, payload)
+
+    if uses_stream_mux(payload):
+        mux_result = mux_av_from_piped(video_id, format_out, policy, job)
+        if mux_result["status"] == Status.ERROR:
+            forget_stream_urls(video_id)
+            raise self.retry(exc=SubtaskException(mux_result["error"]))
+        return {**mux_result, "timings": job.timings}
+
+    transcode_key = get_transcode_key(*get_payload_codecs(payload))
+    download_result = download_piped_video(video_id, format_out, policy, start, end, job, transcode_key)
     if download_result["status"] == Status.ERROR:
+        forget_stream_urls(video_id)
         raise self.retry(exc=SubtaskException(download_result["error"]))
 
     audio_path = download_result["audio_path"]
     video_path = download_result["video_path"]
-    title = download_result["title"]
 
-    combine_result = combine_audio_video(audio_path, video_path, title)
+    combine_result = combine_audio_video(
+        audio_path,
+        video_path,
+        get_job_output_name(payload),
+        format_out,
+        *get_payload_codecs(payload),
+        job=job,
+    )
 
     if combine_result["status"] == Status.ERROR:
         raise self.retry(exc=SubtaskException(combine_result["error"]))
 
-    return combine_result
+    return {**combine_result, "timings": job.timings, "details": download_result["details"]}
 
 
 @celery_app.task(
     bind=True,
+    base=DeduplicatedTask,
+    dedup_mode="audio",
     autoretry_for=(SubtaskException,),
     default_retry_delay=settings.celery_retry_delay,
     retries=settings.celery_retry_max,
 )
 def download_piped_audio_task(self, payload: dict) -> dict:
+    completed_path = self.get_completed_output(payload)
+    if completed_path is not None:
+        return {"status": Status.OK, "info": completed_path}
+
+    reserve_disk_space(self, self.request.id, "audio", payload, ("audio",), 1)
     try:
         video_id = payload["video_id"]
-        download_response = download_audio_from_piped(video_id)
+        start, end = get_payload_clip(payload)
+        download_response = download_audio_from_piped(
+            video_id,
+            policy=get_payload_policy(payload),
+            start=start,
+            end=end,
+            job=get_job_progress(self.request.id, payload),
+        )
+    except ThrottledException as e:
+        # The proxy is up but over its rate limit, which the governor now waits out for every worker
+        raise self.retry(exc=SubtaskException(str(e)), countdown=settings.governor_throttle_backoff)
+    except Exception as e:
+        # Proxy failures are already recorded against the proxy's circuit breaker, and the cached stream URLs are
+        # dropped, so the retry resolves them again through whichever proxy is best by then
+        forget_stream_urls(video_id)
+        raise self.retry(exc=SubtaskException(str(e)))
+
+    return {
+        "status": Status.OK,
+        "info": download_response["audio_path"],
+        "timings": download_response["timings"],
+        "details": download_response["details"],
+    }
+
+
+@celery_app.task(
+    bind=True,
+    autoretry_for=(SubtaskException,),
+    default_retry_delay=settings.celery_retry_delay,
+    retries=settings.celery_retry_max,
+)
+def fetch_stream_task(self, payload: dict, kind: str, job_task_id: Optional[str] = None) -> dict:
+    """
+    First stage of the split download pipeline: downloads the audio or the video stream of a video. Its stage timings
+    are returned for the mux task, and its progress is reported under the job's task ID, which is the mux task's.
+    """
+    download_func = download_audio_from_piped if kind == "audio" else download_video_from_piped
+    if job_task_id:
+        # Each fetch reserves room for its stream and its share of the output, released with the mux task's claim
+        reserve_disk_space(self, job_task_id, "av", payload, (kind,), get_disk_copies(payload))
+    job = get_job_progress(job_task_id, payload) if job_task_id else JobProgress()
+    try:
+        download_response = download_func(
+            payload["video_id"],
+            payload.get("format_out", "mp4"),
+            get_payload_policy(payload),
+            *get_payload_clip(payload),
+            job,
+            get_transcode_key(*get_payload_codecs(payload)),
+        )
+    except ThrottledException as e:
+        raise self.retry(exc=SubtaskException(str(e)), countdown=settings.governor_throttle_backoff)
     except Exception as e:
-        if str(e) == "Expecting value: line 1 column 1 (char 0)":
-            print("The proxy may be down. Setting a new proxy...")
-            update_fastest_proxy()
+        forget_stream_urls(payload["video_id"])
         raise self.retry(exc=SubtaskException(str(e)))
 
-    return {"status": Status.OK, "info": download_response["audio_path"]}
+    return {
+        "status": Status.OK,
+        "info": download_response[f"{kind}_path"],
+        # Both fetches resolve the metadata, so theirs are told apart when the mux task merges the timings
+        "timings": {
+            stage if stage == kind else f"{kind}_{stage}": elapsed
+            for stage, elapsed in download_response["timings"].items()
+        },
+        "details": download_response["details"],
+    }
+
+
+@celery_app.task(
+    bind=True,
+    base=DeduplicatedTask,
+    dedup_mode="av",
+    payload_index=1,
+    autoretry_for=(SubtaskException,),
+    default_retry_delay=settings.celery_retry_delay,
+    retries=settings.celery_retry_max,
+)
+def mux_av_task(self, fetch_results: list, payload: dict) -> dict:
+    """
+    Second stage of the split download pipeline: muxes the fetched audio and video streams.
+
+    With transcode_distributed, a transcode replaces this task with a chord of segment encodes across the CPU workers,
+    whose final concat task takes over this task's ID.
+    """
+    audio_result, video_result = fetch_results
+    format_out = payload.get("format_out", "mp4")
+    vcodec_out, acodec_out = get_payload_codecs(payload)
+    details = {**audio_result["details"], "video_itag": video_result["details"]["video_itag"]}
+
+    if settings.transcode_distributed and is_chunked_transcode(vcodec_out):
+        output_path = get_completed_path(get_job_output_name(payload), format_out)
+        try:
+            jobs, encoded_paths, audio_path = plan_transcode(
+                audio_result["info"], video_result["info"], output_path, vcodec_out, acodec_out
+            )
+        except Exception as e:
+            raise self.retry(exc=SubtaskException(str(e)))
+        encodes = group(transcode_segment_task.s(*job, self.request.id, len(encoded_paths)) for job in jobs)
+        concat = concat_segments_task.s(
+            payload, encoded_paths, audio_path, output_path, details, [audio_result["info"], video_result["info"]]
+        )
+        raise self.replace(chord(encodes, concat))
+
+    job = get_job_progress(self.request.id, payload)
+    combine_result = combine_audio_video(
+        audio_result["info"],
+        video_result["info"],
+        get_job_output_name(payload),
+        format_out,
+        vcodec_out,
+        acodec_out,
+        job=job,
+    )
+
+    if combine_result["status"] == Status.ERROR:
+        raise self.retry(exc=SubtaskException(combine_result["error"]))
+
+    timings = {**audio_result.get("timings", {}), **video_result.get("timings", {}), **job.timings}
+    return {**combine_result, "timings": timings, "details": details}
+
+
+@celery_app.task(
+    bind=True,
+    autoretry_for=(SubtaskException,),
+    default_retry_delay=settings.celery_retry_delay,
+    retries=settings.celery_retry_max,
+)
+def transcode_segment_task(
+    self,
+    source_path: str,
+    output_path: str,
+    vcodec_out: str,
+    acodec_out: str,
+    job_task_id: str,
+    segments_total: int,
+) -> str:
+    """
+    Encodes one segment, or the audio, of a distributed transcode and reports the transcode's progress.
+    """
+    try:
+        # CPU workers already run one process per core
+        run_ffmpeg(EncodeJob(source_path, output_path, vcodec_out, acodec_out).build(threads=1))
+    except Exception as e:
+        raise self.retry(exc=SubtaskException(str(e)))
+
+    if vcodec_out is not None:
+        counter_key = f"vidyodl:transcode:{job_task_id}"
+        segments_done = celery_app.backend.client.incr(counter_key)
+        celery_app.backend.client.expire(counter_key, settings.dedup_lock_ttl)
+        report_transcode_progress(job_task_id, segments_done, segments_total)
+    return output_path
+
+
+@celery_app.task(
+    bind=True,
+    base=DeduplicatedTask,
+    dedup_mode="av",
+    payload_index=1,
+    autoretry_for=(SubtaskException,),
+    default_retry_delay=settings.celery_retry_delay,
+    retries=settings.celery_retry_max,
+)
+def concat_segments_task(
+    self,
+    encode_results: list,
+    payload: dict,
+    encoded_paths: list,
+    audio_path: str,
+    output_path: str,
+    details: dict,
+    stream_paths: Optional[list] = None,
+) -> dict:
+    """
+    Final stage of a distributed transcode: joins the encoded segments into the output and deletes the fetched streams.
+    """
+    try:
+        concat_segments(encoded_paths, audio_path, output_path, payload.get("format_out", "mp4"))
+    except Exception as e:
+        raise self.retry(exc=SubtaskException(str(e)))
+    remove_intermediates(*(stream_paths or []))
+    return {"status": Status.OK, "info": output_path, "details": details}
+
+
+@celery_app.task
+def release_pipeline_claim(request, exc, traceback, payload: dict) -> None:
+    """
+    Error callback of mux_av_task. Releases the pipeline's dedup claim and disk reservation when a fetch stage fails
+    for good, in which case the mux task never runs, and publishes the pipeline's failure.
+    """
+    if settings.dedup_enabled:
+        release_job(payload["video_id"], "av", get_job_format("av", payload), request.id)
+    disk_reservations.release(request.id)
+    publish_event("failure", request.id, payload, error=str(exc))
+
+
+def build_signature(mode: str, payload: dict, task_id: str):
+    """
+    Returns the signature of a download whose final output is produced by the task with the given ID. Audio and
+    video downloads run as a pipeline of two fetch tasks followed by a mux task, unless they are stream muxed.
+    """
+    if mode == "audio":
+        return download_piped_audio_task.s(payload).set(task_id=task_id)
+    if uses_stream_mux(payload) or not settings.celery_split_pipeline:
+        return download_piped_video_task.s(payload).set(task_id=task_id)
+    fetch = group(fetch_stream_task.s(payload, "audio", task_id), fetch_stream_task.s(payload, "video", task_id))
+    mux = mux_av_task.s(payload).set(task_id=task_id).on_error(release_pipeline_claim.s(payload))
+    return chord(fetch, mux)
+
+
+def enqueue_signatures(signatures: list) -> list:
+    """
+    Publishes a batch of task signatures and returns their task IDs.
+
+    Only the producer and its broker connection are shared by the batch, which saves acquiring one from the pool per
+    message. Each message is still its own broker round trip (an exchange lookup and an LPUSH on the Redis transport):
+    kombu publishes one message at a time and has no pipelined batch publish.
+    """
+    if not signatures:
+        return []
+    with celery_app.producer_or_acquire() as producer:
+        return [signature.apply_async(producer=producer).id for signature in signatures]
+
+
+def get_task_statuses(task_ids: list) -> dict:
+    """
+    Looks up the state of many tasks with MGETs against the Redis result backend instead of one AsyncResult
+    round trip per task. Tasks without a stored result are reported as PENDING.
+    """
+    backend = celery_app.backend
+    statuses = {}
+    for start in range(0, len(task_ids), 1000):
+        chunk = task_ids[start : start + 1000]
+        values = backend.client.mget([backend.get_key_for_task(task_id) for task_id in chunk])
+        for task_id, value in zip(chunk, values):
+            if value is None:
+                statuses[task_id] = {"state": "PENDING", "result": None}
+                continue
+            meta = json.loads(value)
+            statuses[task_id] = {"state": meta.get("status"), "result": meta.get("result")}
+    return statuses
+
+
+def get_queue_depths() -> dict:
+    """
+    Returns the number of messages waiting in each Celery queue.
+    """
+    queues = {settings.celery_io_queue, settings.celery_cpu_queue, celery_app.conf.task_default_queue}
+    depths = {}
+    with celery_app.connection_for_read() as connection:
+        channel = connection.default_channel
+        for queue in sorted(queues):
+            try:
+                depths[queue] = channel.queue_declare(queue, passive=True).message_count
+            except ChannelError:
+                # The Redis transport reports an empty queue as missing
+                depths[queue] = 0
+    return depths
+
+
+def get_backlog() -> int:
+    """
+    Returns the number of messages waiting in the queues download jobs enter Celery through.
+    """
+    backlog = 0
+    with celery_app.connection_for_read() as connection:
+        channel = connection.default_channel
+        for queue in (settings.celery_io_queue, celery_app.conf.task_default_queue):
+            try:
+                backlog += channel.queue_declare(queue, passive=True).message_count
+            except ChannelError:
+                # The Redis transport reports an empty queue as missing
+                pass
+    return backlog
+
+
+def dispatch_downloads() -> int:
+    """
+    Releases jobs from the fair scheduler until the broker backlog reaches its target, and with disk admission, while
+    their estimated costs fit in the disk space left. Returns how many were released.
+    """
+    budget = settings.scheduler_backlog_target - get_backlog()
+    byte_budget = disk_reservations.get_available() if settings.disk_admission_enabled else None
+    return fair_scheduler.dispatch(
+        budget,
+        lambda signatures: enqueue_signatures([celery_app.signature(signature) for signature in signatures]),
+        byte_budget,
+    )
+
+
+def submit_downloads(
+    mode: str, payloads: list, client: str = "default", priority: str = "normal", group: Optional[str] = None
+) -> list:
+    """
+    Deduplicates download jobs for a list of payloads and queues the new ones. The payloads are tagged with the client
+    and, if given, the group they were submitted in, which /events subscribers can filter on.
+
+    Each new job gets a Celery priority from the priority hint and its estimated cost. With the fair scheduler on, the
+    jobs are queued under the client's key and released to Celery in fair-share order; otherwise they are published in
+    one group.
+
+    Returns one response per payload, in order: the task ID of a new or already running task, or the output path of
+    a finished download.
+    """
+    payloads = [{**payload, "client": client, **({"group": group} if group else {})} for payload in payloads]
+    jobs = [(payload["video_id"], mode, get_job_format(mode, payload)) for payload in payloads]
+    prepared = [prepare_job(*job, partial(build_signature, mode, payload)) for job, payload in zip(jobs, payloads)]
+    new_jobs = [
+        (job, payload, response, signature)
+        for job, payload, (response, signature) in zip(jobs, payloads, prepared)
+        if signature is not None
+    ]
+
+    try:
+        costs = estimate_costs(mode, [payload for _, payload, _, _ in new_jobs])
+        signatures = [
+            signature.set(priority=get_priority(cost, priority)) for (_, _, _, signature), cost in zip(new_jobs, costs)
+        ]
+        if settings.scheduler_enabled:
+            fair_scheduler.push(client, list(zip(signatures, costs)))
+        else:
+            enqueue_signatures(signatures)
+    except Exception:
+        if settings.dedup_enabled:
+            for job, _, response, _ in new_jobs:
+                release_job(*job, response["info"])
+        raise
+
+    if settings.scheduler_enabled and new_jobs:
+        try:
+            dispatch_downloads()
+        except Exception:
+            # The jobs are queued; the periodic dispatch releases them
+            pass
+
+    return [response for response, _ in prepared]
+
+
+@celery_app.task(bind=True)
+def ingest_playlist_task(self, payload: dict) -> dict:
+    """
+    Walks a playlist page by page through the Piped API and enqueues a download task for every video as each page
+    arrives. Progress, including the task IDs enqueued so far, is reported as task state. Videos that were already
+    downloaded are listed by output path, and repeated videos share one task ID.
+
+    The videos are submitted in a group named after this task's ID, so /events subscribers can follow the whole
+    playlist.
+    """
+    event_payload = {**payload, "group": self.request.id}
+    playlist_id = payload["playlist_id"]
+    client = payload.get("client", "default")
+    priority = payload.get("priority", "normal")
+    download_payload = {
+        key: value for key, value in payload.items() if key not in ("playlist_id", "client", "priority")
+    }
+    task_ids = []
+
+    try:
+        for entries in PipedPlaylist(playlist_id).iter_pages():
+            # Playlist entries carry their duration, which is enough to estimate each job's cost
+            download_payloads = [{**download_payload, **entry} for entry in get_video_entries(entries)]
+            responses = submit_downloads("av", download_payloads, client, priority, self.request.id)
+            task_ids.extend(response["info"] for response in responses)
+            report_progress(self.request.id, {"enqueued": len(task_ids), "task_ids": task_ids}, event_payload)
+    except Exception as e:
+        # Not retried: pages that were already enqueued would be enqueued again
+        result = {"status": Status.ERROR, "error": str(e), "info": task_ids}
+        publish_event("failure", self.request.id, event_payload, result=result)
+        return result
+
+    result = {"status": Status.OK, "info": task_ids}
+    publish_event("success", self.request.id, event_payload, result=result)
+    return result
+
+
+@celery_app.task
+def refresh_proxies_task() -> dict:
+    up_proxies = refresh_proxy_registry()
+    return {"status": Status.OK, "info": [proxy.url for proxy in up_proxies]}
+
+
+@celery_app.task
+def dispatch_downloads_task() -> dict:
+    return {"status": Status.OK, "info": dispatch_downloads()}
+
+
+@celery_app.task
+def evict_outputs_task() -> dict:
+    return {"status": Status.OK, "info": evict_outputs()}
@@ -0,0 +1,204 @@
+import glob
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import ffmpeg
+
+from app.config import Settings
+from app.Stream import run_ffmpeg
+from app.stream_policy import CONTAINER_FORMATS
+
+settings = Settings()
+
+# Callback for transcode progress, called with the number of segments done and the total
+ProgressCallback = Callable[[int, int], None]
+
+
+def get_payload_codecs(payload: dict) -> Tuple[str, str]:
+    return payload.get("vcodec_out", "copy"), payload.get("acodec_out", "copy")
+
+
+def get_transcode_key(vcodec_out: str = "copy", acodec_out: str = "copy") -> str:
+    """
+    Short description of the encoders of a download, used to tell its outputs apart. Empty when both streams are
+    copied.
+    """
+    if vcodec_out == "copy" and acodec_out == "copy":
+        return ""
+    return f"{vcodec_out}.{acodec_out}"
+
+
+def is_chunked_transcode(vcodec_out: str) -> bool:
+    return settings.transcode_chunked and vcodec_out != "copy"
+
+
+def get_cpu_count() -> int:
+    # Cores this process may run on, which can be fewer than the machine has in a container
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_worker_count() -> int:
+    return settings.transcode_workers or get_cpu_count()
+
+
+def get_work_dir(output_path: str) -> str:
+    output_name = os.path.splitext(os.path.basename(output_path))[0]
+    return f"{settings.download_path}/transcode/{output_name}"
+
+
+def get_encoded_path(segment_path: str) -> str:
+    directory, name = os.path.split(segment_path)
+    return os.path.join(directory, name.replace("source_", "encoded_", 1))
+
+
+def split_at_keyframes(video_path: str, work_dir: str) -> List[str]:
+    """
+    Splits a video stream by stream copy into segments of about transcode_segment_duration seconds. The segment muxer
+    only cuts on keyframes, so every segment is a whole number of GOPs and can be encoded on its own. Returns the
+    segment paths in order.
+    """
+    duration = float(ffmpeg.probe(video_path)["format"].get("duration", 0))
+    segment_times = range(settings.transcode_segment_duration, int(duration), settings.transcode_segment_duration)
+    output_kwargs = {"segment_times": ",".join(str(time) for time in segment_times)} if segment_times else {}
+
+    os.makedirs(work_dir, exist_ok=True)
+    run_ffmpeg(
+        ffmpeg.output(
+            ffmpeg.input(video_path),
+            f"{work_dir}/source_%05d.mkv",
+            format="segment",
+            segment_format="matroska",
+            reset_timestamps=1,
+            vcodec="copy",
+            an=None,
+            **output_kwargs,
+        ).overwrite_output()
+    )
+    return sorted(glob.glob(f"{work_dir}/source_*.mkv"))
+
+
+class EncodeJob(NamedTuple):
+    """
+    Encodes the video or, when vcodec_out is None, the audio of a file into a Matroska file. The other stream is
+    dropped.
+    """
+
+    source_path: str
+    output_path: str
+    vcodec_out: Optional[str]
+    acodec_out: Optional[str]
+
+    def build(self, threads: int = 0):
+        if self.vcodec_out is not None:
+            stream_kwargs = {"vcodec": self.vcodec_out, "an": None}
+        else:
+            stream_kwargs = {"acodec": self.acodec_out, "vn": None}
+        return ffmpeg.output(
+            ffmpeg.input(self.source_path),
+            self.output_path,
+            format="matroska",
+            threads=threads,
+            strict="experimental",
+            **stream_kwargs,
+        ).overwrite_output()
+
+
+def plan_transcode(
+    audio_path: str, video_path: str, output_path: str, vcodec_out: str, acodec_out: str
+) -> Tuple[List[EncodeJob], List[str], str]:
+    """
+    Splits the video of a transcode into segments. Returns the encode jobs, the encoded segment paths in order and the
+    path of the audio to mux in, which is the source audio when it is copied.
+    """
+    segment_paths = split_at_keyframes(video_path, get_work_dir(output_path))
+    encoded_paths = [get_encoded_path(segment_path) for segment_path in segment_paths]
+    jobs = [
+        EncodeJob(segment_path, encoded_path, vcodec_out, None)
+        for segment_path, encoded_path in zip(segment_paths, encoded_paths)
+    ]
+    if acodec_out == "copy":
+        return jobs, encoded_paths, audio_path
+    audio_out = f"{get_work_dir(output_path)}/audio.mka"
+    jobs.append(EncodeJob(audio_path, audio_out, None, acodec_out))
+    return jobs, encoded_paths, audio_out
+
+
+def build_concat_output(segment_paths: List[str], audio_path: str, output_path: str, format_out: str):
+    """
+    Joins encoded video segments with the concat demuxer and muxes in the audio, all by stream copy.
+    """
+    list_path = f"{get_work_dir(output_path)}/segments.txt"
+    with open(list_path, "w") as f:
+        for segment_path in segment_paths:
+            escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+
+    video_input = ffmpeg.input(list_path, format="concat", safe=0)
+    audio_input = ffmpeg.input(audio_path)
+    return ffmpeg.output(
+        video_input.video,
+        audio_input.audio,
+        output_path,
+        format=CONTAINER_FORMATS.get(format_out, format_out),
+        vcodec="copy",
+        acodec="copy",
+        strict="experimental",
+    ).overwrite_output()
+
+
+def concat_segments(segment_paths: List[str], audio_path: str, output_path: str, format_out: str) -> str:
+    """
+    Writes the output of a transcode from its encoded segments and removes its working files.
+    """
+    try:
+        run_ffmpeg(build_concat_output(segment_paths, audio_path, output_path, format_out))
+    finally:
+        shutil.rmtree(get_work_dir(output_path), ignore_errors=True)
+    return output_path
+
+
+def transcode_chunked(
+    audio_path: str,
+    video_path: str,
+    output_path: str,
+    format_out: str = "mp4",
+    vcodec_out: str = "libx264",
+    acodec_out: str = "copy",
+    progress: Optional[ProgressCallback] = None,
+) -> str:
+    """
+    Transcodes a video in parallel, one GOP-aligned segment per job.
+
+    Each job is its own ffmpeg process, so a thread pool is enough to keep transcode_workers cores busy, and unlike a
+    process pool it also works inside daemonic Celery worker processes. The audio is encoded alongside the segments.
+    If a job fails, the others are killed. progress is called as each segment finishes.
+    """
+    cancel_event = Event()
+    try:
+        jobs, encoded_paths, audio_out = plan_transcode(audio_path, video_path, output_path, vcodec_out, acodec_out)
+        workers = min(get_worker_count(), len(jobs))
+        threads = max(get_cpu_count() // workers, 1)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_ffmpeg, job.build(threads), cancel_event): job for job in jobs}
+            segments_done = 0
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    cancel_event.set()
+                    for pending in futures:
+                        pending.cancel()
+                    raise future.exception()
+                if futures[future].vcodec_out is not None:
+                    segments_done += 1
+                    if progress is not None:
+                        progress(segments_done, len(encoded_paths))
+    except Exception:
+        shutil.rmtree(get_work_dir(output_path), ignore_errors=True)
+        raise
+
+    return concat_segments(encoded_paths, audio_out, output_path, format_out)
@@ -0,0 +1,216 @@
+import asyncio
+import os
+import random
+import re
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import ffmpeg
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+
+from app.config import TestSettings
+
+CHUNK_SIZE = 64 * 1024
+
+# Bitrates of the placeholder media written when ffmpeg is not available
+FALLBACK_BITRATES = {"audio": 128_000, "video": 2_000_000}
+
+
+def generate_media(media_dir: str, duration: int) -> Dict[str, str]:
+    """
+    Writes a video-only H.264 MP4 and an AAC audio file of the given duration, which is what the API picks for mp4
+    outputs. Without ffmpeg, random bytes of a similar size are written instead, which are enough to benchmark
+    transfers but not muxing.
+    """
+    os.makedirs(media_dir, exist_ok=True)
+    paths = {"audio": f"{media_dir}/audio_{duration}.m4a", "video": f"{media_dir}/video_{duration}.mp4"}
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    try:
+        ffmpeg.input(f"sine=frequency=440:sample_rate=48000:duration={duration}", format="lavfi").output(
+            paths["audio"], acodec="aac", audio_bitrate="128k", vn=None
+        ).overwrite_output().run(quiet=True)
+        ffmpeg.input(f"testsrc2=size=1280x720:rate=30:duration={duration}", format="lavfi").output(
+            paths["video"], vcodec="libx264", preset="ultrafast", g=60, pix_fmt="yuv420p", an=None
+        ).overwrite_output().run(quiet=True)
+    except (FileNotFoundError, ffmpeg.Error):
+        for kind, path in paths.items():
+            with open(path, "wb") as f:
+                f.write(os.urandom(FALLBACK_BITRATES[kind] // 8 * duration))
+    return paths
+
+
+def get_stream_entry(base_url: str, video_id: str, kind: str, path: str, duration: int) -> dict:
+    content_length = os.path.getsize(path)
+    entry = {
+        "url": f"{base_url}/media/{video_id}/{kind}",
+        "bitrate": content_length * 8 // max(duration, 1),
+        "initStart": 0,
+        "initEnd": 0,
+        "indexStart": 0,
+        "indexEnd": 0,
+        "contentLength": content_length,
+        "audioTrackId": None,
+        "audioTrackName": None,
+        "audioTrackLocale": None,
+        "itag": 140 if kind == "audio" else 136,
+    }
+    if kind == "audio":
+        return {
+            **entry,
+            "format": "M4A",
+            "quality": "128 kbps",
+            "mimeType": "audio/mp4",
+            "codec": "mp4a.40.2",
+            "videoOnly": False,
+            "width": 0,
+            "height": 0,
+            "fps": 0,
+        }
+    return {
+        **entry,
+        "format": "MPEG_4",
+        "quality": "720p",
+        "mimeType": "video/mp4",
+        "codec": "avc1.64001f",
+        "videoOnly": True,
+        "width": 1280,
+        "height": 720,
+        "fps": 30,
+    }
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header or "")
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        return max(size - int(last), 0), size - 1
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+async def iter_file(path: str, start: int, end: int, bandwidth: int) -> AsyncIterator[bytes]:
+    """
+    Yields bytes start to end of a file, sleeping between chunks to stay under bandwidth bytes per second.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+            if bandwidth:
+                await asyncio.sleep(len(chunk) / bandwidth)
+
+
+def create_app(test_settings: TestSettings, media_dir: str) -> FastAPI:
+    """
+    Builds a stand-in for a Piped instance: /healthcheck, /streams, /playlists and /nextpage/playlists, plus a /media
+    route serving the stream URLs it hands out. Every video ID resolves to the same generated media.
+
+    Video IDs starting with test_settings.invalid_video_id get Piped's error response, and any request fails with a
+    503 with probability fake_piped_failure_rate, or with a 429 once more than fake_piped_requests_per_second arrive
+    in a second. app.state.bytes_sent counts the media bytes served and app.state.throttled the requests throttled.
+    """
+    app = FastAPI(title="fake-piped")
+    app.state.bytes_sent = 0
+    app.state.throttled = 0
+    # Start of the current one second window and the requests seen in it
+    window = [0.0, 0]
+    base_url = f"http://{test_settings.fake_piped_host}:{test_settings.fake_piped_port}"
+    duration = test_settings.fake_piped_media_duration
+    media_paths = generate_media(media_dir, duration)
+
+    async def count_bytes(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            app.state.bytes_sent += len(chunk)
+            yield chunk
+
+    async def delay() -> None:
+        if test_settings.fake_piped_requests_per_second:
+            now = time.monotonic()
+            if now - window[0] >= 1:
+                window[:] = [now, 0]
+            window[1] += 1
+            if window[1] > test_settings.fake_piped_requests_per_second:
+                app.state.throttled += 1
+                raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": "1"})
+        if test_settings.fake_piped_latency:
+            await asyncio.sleep(test_settings.fake_piped_latency)
+        if random.random() < test_settings.fake_piped_failure_rate:
+            raise HTTPException(status_code=503, detail="Injected failure")
+
+    def get_playlist_page(playlist_id: str, page: int) -> dict:
+        first = page * test_settings.fake_piped_page_size
+        last = min(first + test_settings.fake_piped_page_size, test_settings.fake_piped_playlist_size)
+        return {
+            "name": f"Benchmark playlist {playlist_id}",
+            "relatedStreams": [
+                {"url": f"/watch?v={playlist_id}-{index}", "duration": duration} for index in range(first, last)
+            ],
+            "nextpage": str(page + 1) if last < test_settings.fake_piped_playlist_size else None,
+        }
+
+    @app.get("/healthcheck")
+    async def healthcheck():
+        await delay()
+        return Response("OK")
+
+    @app.get("/streams/{video_id}")
+    async def streams(video_id: str):
+        await delay()
+        if video_id.startswith(test_settings.invalid_video_id):
+            return {"error": "Video unavailable", "message": "This video is unavailable"}
+        return {
+            "title": f"Benchmark video {video_id}",
+            "description": "",
+            "duration": duration,
+            "audioStreams": [get_stream_entry(base_url, video_id, "audio", media_paths["audio"], duration)],
+            "videoStreams": [get_stream_entry(base_url, video_id, "video", media_paths["video"], duration)],
+        }
+
+    @app.get("/playlists/{playlist_id}")
+    async def playlist(playlist_id: str):
+        await delay()
+        return get_playlist_page(playlist_id, 0)
+
+    @app.get("/nextpage/playlists/{playlist_id}")
+    async def playlist_nextpage(playlist_id: str, nextpage: str):
+        await delay()
+        return get_playlist_page(playlist_id, int(nextpage))
+
+    @app.api_route("/media/{video_id}/{kind}", methods=["GET", "HEAD"])
+    async def media(request: Request, video_id: str, kind: str):
+        if kind not in media_paths:
+            raise HTTPException(status_code=404, detail="Unknown stream")
+        await delay()
+        path = media_paths[kind]
+        size = os.path.getsize(path)
+        byte_range = parse_range(request.headers.get("range"), size) if test_settings.fake_piped_range_support else None
+
+        headers = {"Accept-Ranges": "bytes" if test_settings.fake_piped_range_support else "none"}
+        start, end, status_code = 0, size - 1, 200
+        if byte_range is not None:
+            start, end = byte_range
+            if start >= size:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            status_code = 206
+        headers["Content-Length"] = str(end - start + 1)
+
+        if request.method == "HEAD":
+            return Response(status_code=status_code, headers=headers)
+        return StreamingResponse(
+            count_bytes(iter_file(path, start, end, test_settings.fake_piped_bandwidth)),
+            status_code=status_code,
+            headers=headers,
+            media_type="video/mp4" if kind == "video" else "audio/mp4",
+        )
+
+    return app
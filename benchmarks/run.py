@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional
+
+import httpx
+import uvicorn
+from celery.utils.nodenames import host_format
+
+from app.config import TestSettings
+from benchmarks.fake_piped import create_app
+
+# Task states that end a job
+READY_STATES = {"SUCCESS", "FAILURE", "REVOKED"}
+
+
+class Scenario(NamedTuple):
+    """
+    A kind of download job. Celery scenarios are submitted with use_celery and waited on through /tasks/status.
+    """
+
+    endpoint: str
+    id_param: str
+    params: dict
+    celery: bool
+
+
+SCENARIOS = {
+    "inline_av": Scenario("/download", "video_id", {"use_celery": False}, False),
+    "inline_mux": Scenario("/download", "video_id", {"use_celery": False, "stream_mux": True}, False),
+    "inline_audio": Scenario("/download-audio", "video_id", {"use_celery": False}, False),
+    "inline_playlist": Scenario("/download-playlist", "playlist_id", {"use_celery": False}, False),
+    "celery_av": Scenario("/download", "video_id", {"use_celery": True}, True),
+    "celery_audio": Scenario("/download-audio", "video_id", {"use_celery": True}, True),
+    "celery_playlist": Scenario("/download-playlist", "playlist_id", {"use_celery": True}, True),
+}
+
+
+def get_bench_environment(test_settings: TestSettings, download_path: str, max_concurrency: int) -> Dict[str, str]:
+    """
+    Settings for the API and the workers under test. Every request goes to the fake Piped server, metadata is never
+    served from a previous run's cache, and metric samples are written straight away so each run's stage timings can
+    be read back.
+    """
+    return {
+        "DEFAULT_PROXY": f"http://{test_settings.fake_piped_host}:{test_settings.fake_piped_port}",
+        "DOWNLOAD_PATH": download_path,
+        "CATALOG_PATH": f"{download_path}/catalog.sqlite3",
+        "PROXY_REGISTRY_ENABLED": "false",
+        "METADATA_CACHE_ENABLED": "false",
+        "METRICS_FLUSH_INTERVAL": "0",
+        "INLINE_DOWNLOAD_CONCURRENCY": str(max_concurrency),
+    }
+
+
+def start_fake_piped(test_settings: TestSettings, media_dir: str):
+    app = create_app(test_settings, media_dir)
+    server = uvicorn.Server(
+        uvicorn.Config(app, host=test_settings.fake_piped_host, port=test_settings.fake_piped_port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("The fake Piped server failed to start")
+        time.sleep(0.05)
+    return app, server, thread
+
+
+def start_workers(concurrency: int, env: Dict[str, str]) -> subprocess.Popen:
+    """
+    Starts a Celery worker with the given number of threads on every queue and waits until it answers a ping.
+    """
+    from app.tasks import celery_app, settings
+
+    node_name = f"bench-{concurrency}-{uuid.uuid4().hex[:6]}@%h"
+    worker = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "celery",
+            "-A",
+            "app.tasks.celery_app",
+            "worker",
+            "-Q",
+            f"{settings.celery_io_queue},{settings.celery_cpu_queue},{celery_app.conf.task_default_queue}",
+            "-P",
+            "threads",
+            "-c",
+            str(concurrency),
+            "-n",
+            node_name,
+            "-l",
+            "warning",
+            "--without-gossip",
+            "--without-mingle",
+        ],
+        env={**os.environ, **env},
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if worker.poll() is not None:
+            raise RuntimeError(f"The Celery worker exited with code {worker.returncode}")
+        if celery_app.control.ping(destination=[host_format(node_name)], timeout=1):
+            return worker
+    stop_workers(worker)
+    raise RuntimeError("The Celery worker did not start within 60 seconds")
+
+
+def stop_workers(worker: subprocess.Popen) -> None:
+    worker.terminate()
+    try:
+        worker.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        worker.kill()
+
+
+async def wait_for_tasks(client: httpx.AsyncClient, task_ids: List[str], poll_interval: float) -> Dict[str, dict]:
+    statuses = {}
+    while True:
+        response = await client.post("/tasks/status", json={"task_ids": task_ids})
+        statuses = response.json()["response"]["info"]
+        if all(status["state"] in READY_STATES for status in statuses.values()):
+            return statuses
+        await asyncio.sleep(poll_interval)
+
+
+async def run_job(client: httpx.AsyncClient, scenario: Scenario, job_id: str, poll_interval: float) -> Optional[str]:
+    """
+    Runs one download job to completion. Returns None if it succeeded, otherwise the error.
+    """
+    response = await client.post(scenario.endpoint, params={scenario.id_param: job_id, **scenario.params})
+    if response.status_code != 200:
+        return f"HTTP {response.status_code}: {response.text[:200]}"
+    body = response.json()["response"]
+    if body["status"] != "ok":
+        return body.get("error", "unknown error")
+    if not scenario.celery:
+        return None
+
+    statuses = await wait_for_tasks(client, [body["info"]], poll_interval)
+    if scenario.id_param == "playlist_id":
+        # The ingestion task's result lists the download task of every video in the playlist
+        ingest_result = statuses[body["info"]]["result"]
+        if statuses[body["info"]]["state"] != "SUCCESS" or ingest_result["status"] != "ok":
+            return str(ingest_result)
+        statuses = await wait_for_tasks(client, ingest_result["info"], poll_interval)
+
+    failed = [status for status in statuses.values() if status["state"] != "SUCCESS"]
+    if failed:
+        return str(failed[0]["result"])[:200]
+    return None
+
+
+def get_stage_durations() -> Dict[str, Dict[str, float]]:
+    """
+    Returns the count and sum of every stage's duration recorded so far, from the shared metrics store.
+    """
+    from app.metrics import STAGE_DURATION, metrics
+
+    metrics.flush()
+    stages = {}
+    for field, value in metrics.collect().get(STAGE_DURATION, {}).items():
+        labels, _, suffix = field.rpartition("|")
+        if suffix in ("count", "sum"):
+            stage = labels.split('"')[1]
+            stages.setdefault(stage, {"count": 0, "sum": 0.0})[suffix] = value
+    return stages
+
+
+def get_stage_deltas(before: dict, after: dict) -> Dict[str, dict]:
+    deltas = {}
+    for stage, totals in after.items():
+        count = totals["count"] - before.get(stage, {}).get("count", 0)
+        if count > 0:
+            total = totals["sum"] - before.get(stage, {}).get("sum", 0)
+            deltas[stage] = {"count": int(count), "mean_seconds": round(total / count, 4)}
+    return deltas
+
+
+def get_percentile(samples: List[float], percentile: float) -> float:
+    if len(samples) < 2:
+        return samples[0] if samples else 0.0
+    return statistics.quantiles(samples, n=100, method="inclusive")[int(percentile) - 1]
+
+
+async def run_level(
+    client: httpx.AsyncClient,
+    fake_piped_app,
+    name: str,
+    concurrency: int,
+    jobs: int,
+    run_id: str,
+    poll_interval: float,
+) -> dict:
+    """
+    Runs jobs jobs of a scenario, concurrency at a time, and measures their throughput and latency.
+    """
+    scenario = SCENARIOS[name]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def timed_job(index: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            error = await run_job(client, scenario, f"bench-{run_id}-{name}-{concurrency}-{index}", poll_interval)
+            latencies.append(time.perf_counter() - started)
+            if error is not None:
+                errors.append(error)
+
+    stages_before = await asyncio.to_thread(get_stage_durations)
+    bytes_before = fake_piped_app.state.bytes_sent
+    throttled_before = fake_piped_app.state.throttled
+    started = time.perf_counter()
+    await asyncio.gather(*(timed_job(index) for index in range(jobs)))
+    wall_seconds = time.perf_counter() - started
+    # Workers flush their samples from a background thread as they record them
+    await asyncio.sleep(1)
+    stages_after = await asyncio.to_thread(get_stage_durations)
+    transferred = fake_piped_app.state.bytes_sent - bytes_before
+
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "jobs": jobs,
+        "succeeded": jobs - len(errors),
+        "failed": len(errors),
+        "errors": sorted(set(errors))[:5],
+        "wall_seconds": round(wall_seconds, 3),
+        "jobs_per_second": round(jobs / wall_seconds, 4),
+        "bytes": transferred,
+        "throughput_bytes_per_second": round(transferred / wall_seconds),
+        "throttled_requests": fake_piped_app.state.throttled - throttled_before,
+        "latency_seconds": {
+            "p50": round(get_percentile(latencies, 50), 4),
+            "p95": round(get_percentile(latencies, 95), 4),
+            "max": round(max(latencies), 4),
+        },
+        "stages": get_stage_deltas(stages_before, stages_after),
+    }
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """
+    Returns a description of every scenario and concurrency whose job rate fell, or whose p95 latency rose, by more
+    than tolerance relative to the baseline run.
+    """
+    baseline_levels = {(level["scenario"], level["concurrency"]): level for level in baseline["results"]}
+    regressions = []
+    for level in current["results"]:
+        previous = baseline_levels.get((level["scenario"], level["concurrency"]))
+        if previous is None or "error" in level or "error" in previous:
+            continue
+        label = f"{level['scenario']} x{level['concurrency']}"
+        if level["jobs_per_second"] < previous["jobs_per_second"] * (1 - tolerance):
+            regressions.append(f"{label}: {previous['jobs_per_second']} -> {level['jobs_per_second']} jobs/s")
+        if level["latency_seconds"]["p95"] > previous["latency_seconds"]["p95"] * (1 + tolerance):
+            regressions.append(
+                f"{label}: p95 {previous['latency_seconds']['p95']} -> {level['latency_seconds']['p95']} s"
+            )
+    return regressions
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmarks(args: argparse.Namespace, test_settings: TestSettings, env: Dict[str, str]) -> dict:
+    # The API reads its settings when imported, so it is imported once the environment points it at the fake server
+    os.environ.update(env)
+    from server.main import vidyodl_app
+
+    work_dir = env["DOWNLOAD_PATH"]
+    fake_piped_app, server, thread = start_fake_piped(test_settings, f"{work_dir}/media")
+    started_at = datetime.now(timezone.utc)
+    run_id = uuid.uuid4().hex[:8]
+    results = []
+
+    transport = httpx.ASGITransport(app=vidyodl_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://vidyodl", timeout=None) as client:
+        for name in args.scenarios:
+            for concurrency in args.concurrency:
+                print(f"{name} x{concurrency}: {args.jobs} jobs", flush=True)
+                worker = None
+                try:
+                    if SCENARIOS[name].celery:
+                        worker = await asyncio.to_thread(start_workers, concurrency, env)
+                    result = await run_level(
+                        client, fake_piped_app, name, concurrency, args.jobs, run_id, args.poll_interval
+                    )
+                except Exception as e:
+                    result = {"scenario": name, "concurrency": concurrency, "error": str(e)}
+                finally:
+                    if worker is not None:
+                        await asyncio.to_thread(stop_workers, worker)
+                print(f"  {json.dumps(result)}", flush=True)
+                results.append(result)
+
+    server.should_exit = True
+    thread.join(timeout=10)
+
+    return {
+        "run_id": run_id,
+        "started_at": started_at.isoformat(),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "fake_piped": test_settings.model_dump(include={name for name in TestSettings.model_fields if "piped" in name}),
+        "results": results,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the download paths end to end against a local stand-in Piped server. The fake "
+        "server's latency, bandwidth, failures and media are set by the FAKE_PIPED_* settings (see TestSettings). "
+        "Celery scenarios start their own worker for each concurrency level and need the configured Redis."
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: value.split(","),
+        default=["inline_av", "inline_audio", "inline_playlist"],
+        help=f"Comma-separated scenarios to run, from {', '.join(SCENARIOS)}",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 2, 4],
+        help="Comma-separated concurrency levels: simultaneous requests, and worker threads for Celery scenarios",
+    )
+    parser.add_argument("--jobs", type=int, default=8, help="Jobs per scenario and concurrency level")
+    parser.add_argument("--poll-interval", type=float, default=0.25, help="Seconds between task status polls")
+    parser.add_argument("--output", help="Results file. Defaults to a timestamped file in benchmark_results_path.")
+    parser.add_argument("--compare", help="Results file of an earlier run to check this one against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="Relative slowdown against --compare counted as a regression"
+    )
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    test_settings = TestSettings()
+
+    with tempfile.TemporaryDirectory(prefix="vidyodl-bench-") as work_dir:
+        # The download directories the images create
+        for directory in ("audio", "video", "completed"):
+            os.makedirs(f"{work_dir}/{directory}")
+        env = get_bench_environment(test_settings, work_dir, max(args.concurrency))
+        report = asyncio.run(run_benchmarks(args, test_settings, env))
+
+    started_at = datetime.fromisoformat(report["started_at"]).strftime("%Y%m%dT%H%M%S")
+    output = args.output or f"{test_settings.benchmark_results_path}/{started_at}-{report['run_id']}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), report, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
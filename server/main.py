@@ -1,20 +1,63 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from threading import Event
+from typing import List, Optional, Tuple
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
 from app import config, download_utils, models
+from app.cache import metadata_cache
+from app.dash_clip import is_clip
+from app.dedup import (
+    claim_job,
+    get_job_format,
+    get_job_output_name,
+    mark_completed,
+    prepare_job,
+    release_job,
+)
 from app.download_utils import (
-    download_audio_from_piped,
-    download_av_from_piped,
-    get_youtube_video_list_from_playlist,
+    async_download_audio_from_piped,
+    async_download_av_from_piped,
+    async_tee_av_from_piped,
+    mux_av_from_piped,
 )
+from app.events import EventFilter, event_broker, get_state_events, iter_sse
+from app.file_serving import CONTENT_TYPES, build_file_response, get_served_entry
 from app.helper_classes import Status
+from app.http_client import aclose_http_clients
+from app.metrics import format_labels, metrics
+from app.PipedPlaylist import PipedPlaylist
 from app.proxy_functions import (
-    FASTEST_PROXY,
-    UP_PROXIES,
+    get_current_proxy,
     get_proxies_from_file,
     set_fastest_proxy,
     set_proxies_async,
 )
-from app.tasks import download_piped_audio_task, download_piped_video_task
+from app.proxy_registry import proxy_registry
+from app.scheduler import fair_scheduler
+from app.storage import disk_reservations, get_free_bytes, get_reservation_size
+from app.stream_policy import IncompatibleEncoderException, StreamPolicy, check_encoders
+from app.tasks import (
+    get_disk_copies,
+    get_queue_depths,
+    get_task_statuses,
+    ingest_playlist_task,
+    submit_downloads,
+    uses_stream_mux,
+)
+from app.transcode import get_transcode_key
 
 description = """
 Host your own video downloading API using Piped!
@@ -22,14 +65,186 @@ Host your own video downloading API using Piped!
 
 settings = config.Settings()
 
-app_kwargs = dict(title="vidyodl", description=description, version=settings.app_version)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await event_broker.close()
+    await aclose_http_clients()
+    metrics.flush()
+
+
+app_kwargs = dict(title="vidyodl", description=description, version=settings.app_version, lifespan=lifespan)
 
 vidyodl_app = FastAPI(**app_kwargs)
 
+# Limits how many use_celery=False downloads run inside the API process at once
+inline_download_semaphore = asyncio.Semaphore(settings.inline_download_concurrency)
+
 # TODO: Add retry for non-celery downloads
 # TODO: Change Config to ConfigDict (Pydantic)
 
 
+def get_client_key(http_request: Request) -> str:
+    """
+    Key that queued downloads are shared fairly across: the X-Client-Id header, or else the caller's address.
+    """
+    client_id = http_request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    return http_request.client.host if http_request.client is not None else "default"
+
+
+def get_stream_policy(
+    max_height: Optional[int] = None,
+    max_fps: Optional[int] = None,
+    max_size: Optional[int] = None,
+    video_codecs: Optional[str] = None,
+    audio_codecs: Optional[str] = None,
+) -> StreamPolicy:
+    """
+    Stream policy query parameters shared by the download endpoints. Codec preferences are comma-separated.
+    """
+    return StreamPolicy(
+        max_height=max_height,
+        max_fps=max_fps,
+        max_size=max_size,
+        video_codecs=video_codecs.split(",") if video_codecs else [],
+        audio_codecs=audio_codecs.split(",") if audio_codecs else [],
+    )
+
+
+def get_clip(
+    start: Optional[float] = Query(None, ge=0), end: Optional[float] = Query(None, gt=0)
+) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Clip query parameters shared by the download endpoints, in seconds from the start of the video.
+    """
+    if start is not None and end is not None and end <= start:
+        raise HTTPException(status_code=422, detail="end must be after start")
+    return start, end
+
+
+def check_output_encoders(format_out: str, vcodec_out: str, acodec_out: str) -> None:
+    """
+    Answers 422 when the output container can't hold what the requested encoders write.
+    """
+    try:
+        check_encoders(format_out, vcodec_out, acodec_out)
+    except IncompatibleEncoderException as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def reserve_inline_space(mode: str, payload: dict, kinds: Tuple[str, ...], copies: int) -> str:
+    """
+    Reserves disk space for a download run by the API itself and returns the reservation's ID, to release once it
+    finishes. Answers 507 when the disk has no room for it, even after evicting idle outputs.
+    """
+    reservation_id = str(uuid.uuid4())
+    if not settings.disk_admission_enabled:
+        return reservation_id
+    size = await asyncio.to_thread(get_reservation_size, mode, payload, kinds, copies)
+    if not await asyncio.to_thread(disk_reservations.reserve, reservation_id, "inline", size):
+        raise HTTPException(status_code=507, detail=f"Not enough disk space for a {size} byte download")
+    return reservation_id
+
+
+async def claim_inline_job(video_id: str, mode: str, format_out: str) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Deduplicates a download run by the API itself, as queued ones are. Returns the response to answer with when the
+    output already exists or the same download is running, or else the claimed task ID, to release once the download
+    ends. The task ID is None when deduplication is off.
+    """
+    if not settings.dedup_enabled:
+        return None, None
+    response, task_id = await asyncio.to_thread(prepare_job, video_id, mode, format_out, lambda task_id: task_id)
+    if task_id is None:
+        return response, None
+    return None, task_id
+
+
+def release_inline_job(
+    video_id: str, mode: str, format_out: str, task_id: Optional[str], reservation_id: Optional[str]
+) -> None:
+    if task_id is not None:
+        release_job(video_id, mode, format_out, task_id)
+    if reservation_id is not None:
+        disk_reservations.release(reservation_id)
+
+
+async def run_inline_av_download(
+    payload: dict, policy: StreamPolicy, clip: Tuple[Optional[float], Optional[float]] = (None, None)
+) -> dict:
+    """
+    Downloads and combines a video in the API itself, unless its output already exists or the same download is
+    running. Raises HTTPException if the download fails or the disk has no room for it.
+    """
+    video_id, format_out = payload["video_id"], payload.get("format_out", "mp4")
+    vcodec_out, acodec_out = payload.get("vcodec_out", "copy"), payload.get("acodec_out", "copy")
+    job_format = get_job_format("av", payload)
+    duplicate_response, task_id = await claim_inline_job(video_id, "av", job_format)
+    if duplicate_response is not None:
+        return duplicate_response
+
+    reservation_id = None
+    try:
+        reservation_id = await reserve_inline_space("av", payload, ("audio", "video"), get_disk_copies(payload))
+        if uses_stream_mux(payload):
+            async with inline_download_semaphore:
+                result = await asyncio.to_thread(mux_av_from_piped, video_id, format_out, policy)
+            details, info = result.get("details"), result.get("info")
+        else:
+            async with inline_download_semaphore:
+                download_result = await async_download_av_from_piped(
+                    video_id, format_out, policy, *clip, get_transcode_key(vcodec_out, acodec_out)
+                )
+                result = await download_utils.async_combine_audio_video(
+                    download_result["audio_path"],
+                    download_result["video_path"],
+                    get_job_output_name(payload),
+                    format_out,
+                    vcodec_out,
+                    acodec_out,
+                )
+            details, info = download_result["details"], settings.download_path
+        # Recorded before the claim is released, so a request coming in between finds the output
+        if result["status"] == Status.OK:
+            await asyncio.to_thread(mark_completed, video_id, "av", job_format, result["info"], details)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error caught while downloading video: {str(e)}")
+    finally:
+        await asyncio.to_thread(release_inline_job, video_id, "av", job_format, task_id, reservation_id)
+    if result["status"] == Status.ERROR:
+        raise HTTPException(status_code=500, detail=f"Error caught while downloading video: {result['error']}")
+    return {"status": Status.OK, "info": info}
+
+
+def build_payload(
+    policy: StreamPolicy,
+    clip: Tuple[Optional[float], Optional[float]] = (None, None),
+    vcodec_out: str = "copy",
+    acodec_out: str = "copy",
+    **fields,
+) -> dict:
+    """
+    Builds a task payload, which only carries the stream policy when it isn't the default, the clip's times when
+    only part of the video is downloaded and the encoders of streams that aren't copied.
+    """
+    payload = dict(fields)
+    payload.update(
+        {key: value for key, value in (("vcodec_out", vcodec_out), ("acodec_out", acodec_out)) if value != "copy"}
+    )
+    policy_values = policy.model_dump(exclude_defaults=True)
+    if policy_values:
+        payload["policy"] = policy_values
+    if is_clip(*clip):
+        start, end = clip
+        payload.update({key: value for key, value in (("start", start), ("end", end)) if value is not None})
+    return payload
+
+
 @vidyodl_app.get("/health")
 async def health_check():
     return {"status": Status.OK, "app": "vidyodl", "version": settings.app_version}
@@ -41,22 +256,93 @@ async def get_proxies():
         proxy_list = get_proxies_from_file()
         await set_proxies_async(proxy_list)
         set_fastest_proxy()
-        return {"status": Status.OK, "proxies": UP_PROXIES}
+        # The shared registry, not this process's view, is what every worker picks proxies from
+        return {"status": Status.OK, "proxies": await asyncio.to_thread(proxy_registry.list_proxies)}
     except Exception as e:
         return {"status": Status.ERROR, "error": str(e)}
 
 
 @vidyodl_app.get("/list-proxies")
 async def list_proxies():
+    """
+    Lists the proxies that are up in the shared registry, best first, with their stats.
+    """
+    registry = await asyncio.to_thread(proxy_registry.list_proxies)
+    current_proxy = await asyncio.to_thread(get_current_proxy)
     return {
         "status": Status.OK,
-        "up_proxies": UP_PROXIES,
-        "fastest_proxy": FASTEST_PROXY.url,
+        "up_proxies": [proxy["url"] for proxy in registry],
+        "fastest_proxy": registry[0]["url"] if registry else None,
+        "current_proxy": current_proxy.url,
+        "registry": registry,
     }
 
 
+@vidyodl_app.get("/metadata-cache")
+async def metadata_cache_stats():
+    return {"status": Status.OK, "enabled": settings.metadata_cache_enabled, "stats": metadata_cache.stats}
+
+
+def get_gauges() -> dict:
+    """
+    Current queue depths and disk space, which are read when scraped rather than recorded. Missing when the broker is
+    unreachable.
+    """
+    gauges = {}
+    try:
+        queue_depths = get_queue_depths()
+        gauges["vidyodl_queue_depth"] = (
+            "Messages waiting in each Celery queue",
+            {format_labels({"queue": queue}): depth for queue, depth in queue_depths.items()},
+        )
+    except Exception:
+        pass
+    try:
+        pending = fair_scheduler.get_pending()
+        gauges["vidyodl_scheduler_pending_jobs"] = (
+            "Jobs waiting in the fair scheduler before entering Celery",
+            {"": sum(pending.values())},
+        )
+    except Exception:
+        pass
+    try:
+        gauges["vidyodl_disk_free_bytes"] = (
+            "Free bytes on the download volume above the configured minimum",
+            {"": get_free_bytes()},
+        )
+        gauges["vidyodl_disk_reserved_bytes"] = (
+            "Bytes reserved by running downloads",
+            {"": disk_reservations.get_reserved()},
+        )
+    except Exception:
+        pass
+    return gauges
+
+
+@vidyodl_app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Stage latencies, proxy throughput, transfer bytes, cache and dedup hit rates and queue depths of every API and
+    worker process, in the Prometheus text format.
+    """
+    gauges = await asyncio.to_thread(get_gauges)
+    body = await asyncio.to_thread(metrics.render, gauges)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
 @vidyodl_app.post("/download", response_model=models.downloadResponseModel)
-async def download_from_video_id(video_id: str, use_celery: bool = True) -> models.downloadResponseModel:
+async def download_from_video_id(
+    http_request: Request,
+    video_id: str,
+    use_celery: bool = True,
+    stream_mux: bool = False,
+    priority: models.PriorityHint = "normal",
+    format_out: models.OutputFormat = "mp4",
+    vcodec_out: models.VideoEncoder = "copy",
+    acodec_out: models.AudioEncoder = "copy",
+    policy: StreamPolicy = Depends(get_stream_policy),
+    clip: Tuple[Optional[float], Optional[float]] = Depends(get_clip),
+) -> models.downloadResponseModel:
     """
     Downloads a video from Piped.
 
@@ -64,95 +350,380 @@ async def download_from_video_id(video_id: str, use_celery: bool = True) -> mode
 
     - **video_id**: The ID of the video to download.
     - **use_celery**: Whether to use Celery or not. (default: True)
+    - **stream_mux**: Mux the audio and video streams as they download instead of writing them to disk first.
+    (default: False)
+    - **priority**: 'high', 'normal' or 'low'. Queued downloads run in priority order, cheaper ones first within a
+    priority, and are shared fairly between clients, identified by the X-Client-Id header or their address.
+    (default: normal)
+    - **format_out**: Output container, 'mp4', 'webm' or 'mkv'. Only streams that can be copied into it are picked.
+    (default: mp4)
+    - **vcodec_out**, **acodec_out**: ffmpeg encoders to transcode the video and audio with, or 'copy' to keep them.
+    Video transcodes are split at keyframes and the segments encoded in parallel, and queued ones report the segments
+    done as task progress. Transcodes are never stream muxed. Encoders that write a codec the container can't hold are
+    answered with 422. (default: copy)
+    - **max_height**, **max_fps**, **max_size**: Highest resolution, frame rate and estimated size in bytes to fetch.
+    - **video_codecs**, **audio_codecs**: Comma-separated preferred codecs, best first, such as 'avc1,vp9' or 'opus'.
+    - **start**, **end**: Only download the clip between these times, in seconds. Just the stream fragments covering
+    the clip are fetched. Clips are never stream muxed.
 
     Returns a dict with a the status of the call mapped to 'status' and a mapping of 'info' to either list of task IDs if using Celery
     or a string with the download path if not using Celery.
 
+    Duplicate requests are not downloaded twice, with or without Celery. If the same download is already queued or
+    running, 'info' is that task's ID and 'duplicate' is set; if it already finished, 'info' is the output path and
+    'completed' is set.
+
     If an error occurs, 'status' will map to error, and instead of 'info' there will be an 'error' key mapping to the error message.
 
     It is recommneded to use Celery for downloading long videos, as it allows for asynchronous downloading.
-    Otherwise the API will block until the playlist is downloaded.
+    Otherwise the request will not return until the download is finished.
     """
+    check_output_encoders(format_out, vcodec_out, acodec_out)
+    payload = build_payload(
+        policy, clip, vcodec_out, acodec_out, video_id=video_id, stream_mux=stream_mux, format_out=format_out
+    )
     if use_celery:
         try:
-            celery_download_task = download_piped_video_task.delay({"video_id": video_id})
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error caught while downloading video: {str(e)}")
-        return {"response": {"status": Status.OK, "info": celery_download_task.id}}
-    else:
-        try:
-            download_result = download_av_from_piped(video_id)
-            download_utils.combine_audio_video(
-                download_result["audio_path"], download_result["video_path"], download_result["title"]
+            (submit_response,) = await asyncio.to_thread(
+                submit_downloads, "av", [payload], get_client_key(http_request), priority
             )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error caught while downloading video: {str(e)}")
-        return {"response": {"status": Status.OK, "info": settings.download_path}}
+        return {"response": submit_response}
+    else:
+        return {"response": await run_inline_av_download(payload, policy, clip)}
 
 
 @vidyodl_app.post("/download-audio", response_model=models.downloadResponseModel)
-async def download_audio_from_video_id(video_id: str, use_celery: bool = True) -> models.downloadResponseModel:
+async def download_audio_from_video_id(
+    http_request: Request,
+    video_id: str,
+    use_celery: bool = True,
+    priority: models.PriorityHint = "normal",
+    policy: StreamPolicy = Depends(get_stream_policy),
+    clip: Tuple[Optional[float], Optional[float]] = Depends(get_clip),
+) -> models.downloadResponseModel:
     """
     Downloads the audio stream of a video from Piped.
 
     - **video_id**: The ID of the video to download.
     - **use_celery**: Whether to use Celery or not. (default: True)
+    - **priority**: 'high', 'normal' or 'low', as for /download. (default: normal)
+    - **audio_codecs**: Comma-separated preferred codecs, best first, as for /download.
+    - **start**, **end**: Only download the clip between these times, in seconds, as for /download.
 
     Returns a dict with a the status of the call mapped to 'status' and a mapping of 'info' to either list of task IDs if using Celery
     or a string with the download path if not using Celery.
 
+    Duplicate requests are not downloaded twice, with or without Celery. If the same download is already queued or
+    running, 'info' is that task's ID and 'duplicate' is set; if it already finished, 'info' is the output path and
+    'completed' is set.
+
     If an error occurs, 'status' will map to error, and instead of 'info' there will be an 'error' key mapping to the error message.
 
     It is recommneded to use Celery for downloading long videos, as it allows for asynchronous downloading.
-    Otherwise the API will block until the playlist is downloaded.
+    Otherwise the request will not return until the download is finished.
     """
+    payload = build_payload(policy, clip, video_id=video_id)
     if use_celery:
         try:
-            payload = {"video_id": video_id}
-            celery_download_task = download_piped_audio_task.delay(payload)
+            (submit_response,) = await asyncio.to_thread(
+                submit_downloads, "audio", [payload], get_client_key(http_request), priority
+            )
         except Exception as e:
             return {"response": {"status": Status.ERROR, "error": str(e)}}
-        return {"response": {"status": Status.OK, "info": celery_download_task.id}}
+        return {"response": submit_response}
     else:
+        job_format = get_job_format("audio", payload)
+        duplicate_response, task_id = await claim_inline_job(video_id, "audio", job_format)
+        if duplicate_response is not None:
+            return {"response": duplicate_response}
+        reservation_id = None
         try:
-            audio_path, title = download_audio_from_piped(video_id)
+            reservation_id = await reserve_inline_space("audio", payload, ("audio",), 1)
+            async with inline_download_semaphore:
+                download_result = await async_download_audio_from_piped(video_id, policy, *clip)
+            await asyncio.to_thread(
+                mark_completed,
+                video_id,
+                "audio",
+                job_format,
+                download_result["audio_path"],
+                download_result["details"],
+            )
+        except HTTPException:
+            raise
         except Exception as e:
             return {"response": {"status": Status.ERROR, "error": str(e)}}
-        return {"response": {"status": Status.OK, "info": f"{audio_path}"}}
+        finally:
+            await asyncio.to_thread(release_inline_job, video_id, "audio", job_format, task_id, reservation_id)
+        return {"response": {"status": Status.OK, "info": f"{download_result['audio_path']}"}}
 
 
 @vidyodl_app.post("/download-playlist", response_model=models.downloadResponseModel)
-async def download_from_playlist_id(playlist_id: str, use_celery: bool = True) -> models.downloadResponseModel:
+async def download_from_playlist_id(
+    http_request: Request,
+    playlist_id: str,
+    use_celery: bool = True,
+    priority: models.PriorityHint = "normal",
+    format_out: models.OutputFormat = "mp4",
+    vcodec_out: models.VideoEncoder = "copy",
+    acodec_out: models.AudioEncoder = "copy",
+    policy: StreamPolicy = Depends(get_stream_policy),
+) -> models.downloadResponseModel:
     """
     Downloads a YouTube playlist from Piped.
 
     - **playlist_id**: The ID of the playlist to download.
     - **use_celery**: Whether to use Celery or not. (default: True)
+    - **priority**: 'high', 'normal' or 'low', as for /download. (default: normal)
+    - **format_out**, **vcodec_out**, **acodec_out** and the stream policy parameters apply to every video, as for
+    /download. They are only used with Celery.
 
-    Returns a dict with a the status of the call mapped to 'status' and a mapping of 'info' to either list of task IDs if using Celery
-    or a string with the download path if not using Celery.
+    Returns a dict with a the status of the call mapped to 'status' and a mapping of 'info' to either the ID of the playlist
+    ingestion task if using Celery or a string with the download path if not using Celery.
+
+    The ingestion task returns right away and enqueues the videos page by page. Its progress and result list the task IDs
+    of every video enqueued so far. Without Celery, videos that are already downloaded or being downloaded are skipped.
 
     If an error occurs, 'status' will map to error, and instead of 'info' there will be an 'error' key mapping to the error message.
 
     It is recommneded to use Celery for downloading playlists, as it allows for asynchronous downloading.
-    Otherwise the API will block until the playlist is downloaded.
+    Otherwise the request will not return until the download is finished.
     """
-    task_list = []
-
+    check_output_encoders(format_out, vcodec_out, acodec_out)
     if use_celery:
         try:
-            for youtube_obj in get_youtube_video_list_from_playlist(playlist_id):
-                celery_download_task = download_piped_video_task.delay({"video_id": youtube_obj.video_id})
-                task_list.append(celery_download_task.id)
+            ingest_payload = build_payload(
+                policy,
+                vcodec_out=vcodec_out,
+                acodec_out=acodec_out,
+                playlist_id=playlist_id,
+                format_out=format_out,
+                client=get_client_key(http_request),
+                priority=priority,
+            )
+            ingest_task = ingest_playlist_task.delay(ingest_payload)
         except Exception as e:
             return {"response": {"status": Status.ERROR, "error": str(e)}}
 
-        return {"response": {"status": Status.OK, "info": task_list}}
+        return {"response": {"status": Status.OK, "info": ingest_task.id}}
 
     else:
         try:
-            download_utils.download_youtube_playlist(playlist_id)
+            async for video_ids in PipedPlaylist(playlist_id).async_iter_video_ids():
+                for video_id in video_ids:
+                    await run_inline_av_download(build_payload(StreamPolicy(), video_id=video_id), StreamPolicy())
+        except HTTPException as e:
+            return {"response": {"status": Status.ERROR, "error": e.detail}}
         except Exception as e:
             return {"response": {"status": Status.ERROR, "error": str(e)}}
 
         return {"response": {"status": Status.OK, "info": f"{settings.download_path}"}}
+
+
+@vidyodl_app.post("/download-batch", response_model=models.downloadResponseModel)
+async def download_batch(
+    http_request: Request, request: models.batchDownloadRequestModel
+) -> models.downloadResponseModel:
+    """
+    Queues downloads for many videos at once through Celery.
+
+    - **video_ids**: The IDs of the videos to download.
+    - **mode**: 'av' to download and combine audio and video, 'audio' for the audio stream only. (default: av)
+    - **stream_mux**: Mux the audio and video streams as they download, only used in 'av' mode. (default: False)
+    - **priority**: 'high', 'normal' or 'low', as for /download. (default: normal)
+    - **format_out**: Output container, only used in 'av' mode, as for /download. (default: mp4)
+    - **vcodec_out**, **acodec_out**: Encoders, only used in 'av' mode, as for /download. (default: copy)
+    - **policy**: Stream policy with max_height, max_fps, max_size, video_codecs and audio_codecs, as for /download.
+
+    Returns a dict with the status of the call mapped to 'status' and a mapping of 'info' to one result per video ID, in
+    the same order. Each result is shaped like the response of /download. 'group' is the ID the batch's events can be
+    followed by on /events.
+    """
+    if request.mode == "audio":
+        payloads = [build_payload(request.policy, video_id=video_id) for video_id in request.video_ids]
+    else:
+        payloads = [
+            build_payload(
+                request.policy,
+                vcodec_out=request.vcodec_out,
+                acodec_out=request.acodec_out,
+                video_id=video_id,
+                stream_mux=request.stream_mux,
+                format_out=request.format_out,
+            )
+            for video_id in request.video_ids
+        ]
+
+    try:
+        group = str(uuid.uuid4())
+        submit_responses = await asyncio.to_thread(
+            submit_downloads, request.mode, payloads, get_client_key(http_request), request.priority, group
+        )
+    except Exception as e:
+        return {"response": {"status": Status.ERROR, "error": str(e)}}
+    return {"response": {"status": Status.OK, "info": submit_responses, "group": group}}
+
+
+@vidyodl_app.post("/tasks/status", response_model=models.downloadResponseModel)
+async def tasks_status(request: models.taskStatusRequestModel) -> models.downloadResponseModel:
+    """
+    Looks up the state of many Celery tasks at once.
+
+    - **task_ids**: The task IDs returned by the download endpoints.
+
+    Returns a dict with the status of the call mapped to 'status' and a mapping of 'info' to a dict of task ID to its
+    'state' and 'result'. Tasks the result backend doesn't know about yet are reported as PENDING.
+    """
+    try:
+        statuses = await asyncio.to_thread(get_task_statuses, request.task_ids)
+    except Exception as e:
+        return {"response": {"status": Status.ERROR, "error": str(e)}}
+    return {"response": {"status": Status.OK, "info": statuses}}
+
+
+def get_event_filter(
+    task_id: List[str] = Query([]), group: List[str] = Query([]), client: List[str] = Query([])
+) -> EventFilter:
+    """
+    Event filter query parameters shared by the event streams. Each can be repeated.
+    """
+    return EventFilter(frozenset(task_id), frozenset(group), frozenset(client))
+
+
+async def get_initial_events(event_filter: EventFilter) -> list:
+    if not event_filter.task_ids:
+        return []
+    try:
+        statuses = await asyncio.to_thread(get_task_statuses, list(event_filter.task_ids))
+    except Exception:
+        return []
+    return get_state_events(statuses)
+
+
+@vidyodl_app.get("/events")
+async def events_stream(event_filter: EventFilter = Depends(get_event_filter)):
+    """
+    Streams job events as Server-Sent Events, so clients learn when their downloads progress and finish without
+    polling /tasks/status.
+
+    - **task_id**: Only events of these tasks.
+    - **group**: Only events of the videos of these batches or playlists: the 'group' of a /download-batch response,
+    or the ingestion task ID of a /download-playlist request.
+    - **client**: Only events of downloads submitted by these clients, by X-Client-Id header or address.
+
+    Events matching any of the filters are sent, or every event if none is given. Each event is named after its
+    'event' field: 'progress', 'success' or 'failure' of a task, with its 'task_id', 'video_id', 'client' and 'group'.
+    When subscribing to tasks, their current state is sent first as 'state' events. A 'dropped' event says how many
+    events were dropped because the client read too slowly, and 'reconnected' that events may have been missed.
+    """
+    subscription = await event_broker.subscribe(event_filter)
+    initial_events = await get_initial_events(event_filter)
+    return StreamingResponse(
+        iter_sse(event_broker, subscription, initial_events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@vidyodl_app.websocket("/events/ws")
+async def events_websocket(websocket: WebSocket, event_filter: EventFilter = Depends(get_event_filter)):
+    """
+    The events of /events, with the same filters, as JSON messages over a WebSocket.
+    """
+    await websocket.accept()
+    subscription = await event_broker.subscribe(event_filter)
+    try:
+        for message in await get_initial_events(event_filter):
+            await websocket.send_json(message)
+        while True:
+            message = await subscription.get(settings.events_heartbeat_interval)
+            await websocket.send_json(message if message is not None else {"event": "keepalive"})
+    except (WebSocketDisconnect, RuntimeError, OSError):
+        # The client went away, which may only show when sending to it
+        pass
+    finally:
+        event_broker.unsubscribe(subscription)
+
+
+def finish_tee(video_id: str, format_out: str, task_id: Optional[str], reservation_id: str, result: dict) -> None:
+    if result["status"] == Status.OK:
+        mark_completed(video_id, "av", format_out, result["info"], result["details"])
+    release_inline_job(video_id, "av", format_out, task_id, reservation_id)
+
+
+@vidyodl_app.api_route("/files/{video_id}", methods=["GET", "HEAD"])
+async def get_file(
+    http_request: Request,
+    video_id: str,
+    mode: models.DownloadMode = "av",
+    format_out: Optional[str] = None,
+    tee: bool = False,
+):
+    """
+    Serves the completed output of a video.
+
+    - **video_id**: The ID of the video.
+    - **mode**: 'av' or 'audio', the kind of download to serve. (default: av)
+    - **format_out**: Output format as recorded in the catalog, such as 'mp4', or 'native' for audio. Outputs of a
+    stream policy, transcode or clip have their key appended, as in 'mp4+<policy>' or 'mp4@30-60'. (default: the newest
+    output of the mode)
+    - **tee**: If the video hasn't been downloaded, download it in one pass and stream it to the client as it is
+    written. Only plain audio and video downloads into 'mp4', 'webm' or 'mkv' can be teed. (default: False)
+
+    Completed files support Range and If-Range for resumable fetches, and carry an ETag, the SHA-256 of the file when
+    the catalog has it, and Last-Modified for conditional requests. Returns 404 if there is no completed output, 409
+    with the running task's ID if a tee is asked for while the same download is already running, and 507 if the disk
+    has no room for a tee.
+    """
+    entry = await asyncio.to_thread(get_served_entry, video_id, mode, format_out)
+    if entry is not None:
+        return await asyncio.to_thread(build_file_response, entry, http_request.headers)
+
+    format_out = format_out or "mp4"
+    if not tee or mode != "av" or f".{format_out}" not in CONTENT_TYPES or http_request.method == "HEAD":
+        raise HTTPException(status_code=404, detail=f"No completed output for {video_id}")
+
+    task_id = None
+    if settings.dedup_enabled:
+        task_id, claimed = await asyncio.to_thread(claim_job, video_id, "av", format_out)
+        if not claimed:
+            raise HTTPException(status_code=409, detail=f"Download already running as task {task_id}")
+    # The slot is held until the tee ends, after the response, like the other inline downloads hold theirs
+    await inline_download_semaphore.acquire()
+    try:
+        reservation_id = await reserve_inline_space(
+            "av", {"video_id": video_id, "format_out": format_out}, ("audio", "video"), 1
+        )
+    except HTTPException:
+        inline_download_semaphore.release()
+        if task_id is not None:
+            await asyncio.to_thread(release_job, video_id, "av", format_out, task_id)
+        raise
+
+    finished = Event()
+
+    def on_finish(result: dict) -> None:
+        finished.set()
+        finish_tee(video_id, format_out, task_id, reservation_id, result)
+
+    try:
+        body = await async_tee_av_from_piped(video_id, format_out, on_finish)
+    except Exception as e:
+        inline_download_semaphore.release()
+        if task_id is not None:
+            await asyncio.to_thread(release_job, video_id, "av", format_out, task_id)
+        await asyncio.to_thread(disk_reservations.release, reservation_id)
+        raise HTTPException(status_code=500, detail=f"Error caught while downloading video: {str(e)}")
+
+    async def end_tee() -> None:
+        # Runs after the response even if the client went away, so the tee is always wound up and its slot freed
+        try:
+            await body.aclose()
+            if not finished.is_set():
+                await asyncio.to_thread(on_finish, {"status": Status.ERROR, "error": "Tee never started"})
+        finally:
+            inline_download_semaphore.release()
+
+    return StreamingResponse(body, media_type=CONTENT_TYPES[f".{format_out}"], background=BackgroundTask(end_tee))
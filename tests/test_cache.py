@@ -0,0 +1,38 @@
+import time
+
+from app.cache import EXPIRY_MARGIN, LRUCacheTier, MetadataCache, get_ttl_from_properties, settings
+
+
+def stream(expire=None):
+    query = f"?itag=140&expire={expire}" if expire is not None else "?itag=140"
+    return {"url": f"https://proxy.example/videoplayback{query}"}
+
+
+def test_ttl_ends_before_the_earliest_expiry():
+    now = int(time.time())
+    properties = {
+        "audioStreams": [stream(now + 7200)],
+        "videoStreams": [stream(now + 3600), stream(now + 10800)],
+    }
+    ttl = get_ttl_from_properties(properties)
+    assert 3600 - EXPIRY_MARGIN - 2 <= ttl <= 3600 - EXPIRY_MARGIN
+
+
+def test_ttl_defaults_without_expiry():
+    properties = {"audioStreams": [stream()], "videoStreams": [stream("soon")]}
+    assert get_ttl_from_properties(properties) == settings.metadata_cache_default_ttl
+    assert get_ttl_from_properties({}) == settings.metadata_cache_default_ttl
+
+
+def test_delete_drops_the_entry_from_every_tier():
+    first, second = LRUCacheTier(10), LRUCacheTier(10)
+    cache = MetadataCache([first, second])
+    properties = {"audioStreams": [stream(int(time.time()) + 3600)]}
+    cache.set("abc", properties)
+    cache.set("def", properties)
+
+    cache.delete("abc")
+    cache.delete("missing")
+    assert first.get("abc") is None and second.get("abc") is None
+    assert cache.get("abc") is None
+    assert cache.get("def") == properties
@@ -0,0 +1,107 @@
+import struct
+
+import pytest
+
+from app.dash_clip import (
+    CUE_CLUSTER_POSITION_ID,
+    CUE_POINT_ID,
+    CUE_TIME_ID,
+    CUE_TRACK_POSITIONS_ID,
+    CUES_ID,
+    Fragment,
+    UnsupportedIndexException,
+    parse_cues,
+    parse_sidx,
+    select_fragments,
+)
+
+
+def build_sidx(timescale, earliest_time, first_offset, references, version=0):
+    """
+    Builds an ISO BMFF sidx box from (size, duration) references.
+    """
+    body = struct.pack(">B3xII", version, 1, timescale)
+    body += struct.pack(">II" if version == 0 else ">QQ", earliest_time, first_offset)
+    body += struct.pack(">HH", 0, len(references))
+    for size, duration in references:
+        body += struct.pack(">III", size, duration, 0)
+    return struct.pack(">I4s", len(body) + 8, b"sidx") + body
+
+
+def build_element(element_id, data):
+    """
+    Builds an EBML element with a one byte size.
+    """
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + bytes([0x80 | len(data)]) + data
+
+
+def build_cues(cues):
+    """
+    Builds a WebM Cues element from (time, cluster position) cue points.
+    """
+    cue_points = b"".join(
+        build_element(
+            CUE_POINT_ID,
+            build_element(CUE_TIME_ID, time.to_bytes(2, "big"))
+            + build_element(
+                CUE_TRACK_POSITIONS_ID, build_element(CUE_CLUSTER_POSITION_ID, position.to_bytes(4, "big"))
+            ),
+        )
+        for time, position in cues
+    )
+    return build_element(CUES_ID, cue_points)
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_parse_sidx(version):
+    data = build_sidx(1000, 500, 10, [(100, 2000), (200, 2000), (50, 1000)], version)
+    assert parse_sidx(data, 1000) == [
+        Fragment(0.5, 1010, 1109),
+        Fragment(2.5, 1110, 1309),
+        Fragment(4.5, 1310, 1359),
+    ]
+
+
+def test_parse_sidx_rejects_other_boxes():
+    data = build_sidx(1000, 0, 0, [(100, 1000)]).replace(b"sidx", b"moof")
+    with pytest.raises(UnsupportedIndexException):
+        parse_sidx(data, 0)
+
+
+def test_parse_sidx_rejects_hierarchical_indexes():
+    data = build_sidx(1000, 0, 0, [(0x80000000 | 100, 1000)])
+    with pytest.raises(UnsupportedIndexException):
+        parse_sidx(data, 0)
+
+
+def test_parse_cues():
+    # Cue points out of file order are sorted by position, and the last fragment runs to the end of the file
+    data = build_cues([(0, 100), (4000, 900), (2000, 500)])
+    assert parse_cues(data, 48, 1_000_000) == [
+        Fragment(0.0, 148, 547),
+        Fragment(2.0, 548, 947),
+        Fragment(4.0, 948, None),
+    ]
+
+
+def test_parse_cues_rejects_other_elements():
+    with pytest.raises(UnsupportedIndexException):
+        parse_cues(build_element(CUE_POINT_ID, b""), 0, 1_000_000)
+
+
+FRAGMENTS = [Fragment(float(time), time * 100, time * 100 + 99) for time in range(0, 10, 2)]
+
+
+@pytest.mark.parametrize(
+    "start, end, expected_times",
+    [
+        (0, None, [0, 2, 4, 6, 8]),
+        (3, 5, [2, 4]),
+        (4, 6, [4]),
+        (4, 4.5, [4]),
+        (9, None, [8]),
+        (20, 30, [8]),
+    ],
+)
+def test_select_fragments(start, end, expected_times):
+    assert [fragment.start_time for fragment in select_fragments(FRAGMENTS, start, end)] == expected_times
@@ -0,0 +1,52 @@
+import pytest
+
+from app.file_serving import RangeNotSatisfiableException, is_range_current, parse_range
+
+ETAG = '"0123456789abcdef"'
+# Sun, 06 Nov 1994 08:49:37 GMT
+MTIME = 784111777.25
+
+
+@pytest.mark.parametrize(
+    "range_header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=500-5000", (500, 999)),
+        (" bytes=1-1 ", (1, 1)),
+    ],
+)
+def test_parse_range(range_header, expected):
+    assert parse_range(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize("range_header", [None, "", "bytes=-", "bytes=0-1,5-6", "items=0-1", "bytes=10-5"])
+def test_parse_range_ignores_unsupported_ranges(range_header):
+    assert parse_range(range_header, 1000) is None
+
+
+@pytest.mark.parametrize("range_header", ["bytes=1000-", "bytes=2000-3000", "bytes=-0"])
+def test_parse_range_rejects_unsatisfiable_ranges(range_header):
+    with pytest.raises(RangeNotSatisfiableException):
+        parse_range(range_header, 1000)
+
+
+def test_is_range_current_without_if_range():
+    assert is_range_current(None, ETAG, MTIME)
+
+
+def test_is_range_current_by_etag():
+    assert is_range_current(ETAG, ETAG, MTIME)
+    assert not is_range_current('"stale"', ETAG, MTIME)
+
+
+def test_is_range_current_needs_a_strong_etag():
+    assert not is_range_current(f"W/{ETAG}", f"W/{ETAG}", MTIME)
+
+
+def test_is_range_current_by_date():
+    assert is_range_current("Sun, 06 Nov 1994 08:49:37 GMT", ETAG, MTIME)
+    assert not is_range_current("Sun, 06 Nov 1994 08:49:38 GMT", ETAG, MTIME)
+    assert not is_range_current("not a date", ETAG, MTIME)
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from app.range_download import Checkpoint, split_into_segments
+
+
+@pytest.fixture
+def part_fd(tmp_path):
+    fd = os.open(tmp_path / "stream.part", os.O_RDWR | os.O_CREAT)
+    yield fd
+    os.close(fd)
+
+
+def test_split_into_segments():
+    assert split_into_segments(250, 100) == [(0, 99), (100, 199), (200, 249)]
+    assert split_into_segments(0, 100) == []
+
+
+def test_checkpoint_resumes_completed_segments(tmp_path, part_fd):
+    path = str(tmp_path / "stream.part.json")
+    checkpoint = Checkpoint(path, 251, 300, 100)
+    checkpoint.reset()
+    checkpoint.mark_completed(part_fd, (0, 99))
+    checkpoint.mark_completed(part_fd, (200, 299))
+
+    resumed = Checkpoint(path, 251, 300, 100)
+    assert resumed.load()
+    assert resumed.completed == {(0, 99), (200, 299)}
+
+
+@pytest.mark.parametrize("itag, content_length, segment_size", [(140, 300, 100), (251, 400, 100), (251, 300, 50)])
+def test_checkpoint_of_another_stream_is_not_loaded(tmp_path, part_fd, itag, content_length, segment_size):
+    path = str(tmp_path / "stream.part.json")
+    checkpoint = Checkpoint(path, 251, 300, 100)
+    checkpoint.mark_completed(part_fd, (0, 99))
+
+    other = Checkpoint(path, itag, content_length, segment_size)
+    assert not other.load()
+    assert other.completed == set()
+
+
+def test_missing_or_removed_checkpoint_is_not_loaded(tmp_path, part_fd):
+    path = str(tmp_path / "stream.part.json")
+    assert not Checkpoint(path, 251, 300, 100).load()
+
+    checkpoint = Checkpoint(path, 251, 300, 100)
+    checkpoint.mark_completed(part_fd, (0, 99))
+    checkpoint.remove()
+    checkpoint.remove()
+    assert not Checkpoint(path, 251, 300, 100).load()
+
+
+def test_corrupt_checkpoint_is_not_loaded(tmp_path):
+    path = tmp_path / "stream.part.json"
+    path.write_text("{not json")
+    assert not Checkpoint(str(path), 251, 300, 100).load()
@@ -0,0 +1,91 @@
+import fakeredis
+import pytest
+
+from app import scheduler
+from app.scheduler import FairScheduler
+
+QUANTUM = 100
+
+
+@pytest.fixture
+def fair_scheduler(monkeypatch):
+    redis_client = fakeredis.FakeRedis()
+    monkeypatch.setattr(scheduler, "get_redis", lambda db: redis_client)
+    monkeypatch.setattr(scheduler.settings, "scheduler_quantum", QUANTUM)
+    return FairScheduler(0)
+
+
+def push_jobs(fair_scheduler, client, costs):
+    fair_scheduler.push(client, [({"job": f"{client}{i}"}, cost) for i, cost in enumerate(costs)])
+
+
+def dispatch(fair_scheduler, budget, byte_budget=None):
+    sent = []
+    fair_scheduler.dispatch(
+        budget, lambda signatures: sent.extend(signature["job"] for signature in signatures), byte_budget
+    )
+    return sent
+
+
+def test_clients_share_releases(fair_scheduler):
+    push_jobs(fair_scheduler, "a", [QUANTUM] * 5)
+    push_jobs(fair_scheduler, "b", [QUANTUM] * 2)
+
+    # One job per client and turn, however many the first client queued
+    assert sorted(dispatch(fair_scheduler, 4)) == ["a0", "a1", "b0", "b1"]
+    assert fair_scheduler.get_pending() == {"a": 3}
+    assert dispatch(fair_scheduler, 10) == ["a2", "a3", "a4"]
+    assert fair_scheduler.get_pending() == {}
+
+
+def test_cheap_jobs_get_more_releases_per_turn(fair_scheduler):
+    push_jobs(fair_scheduler, "a", [QUANTUM // 4] * 8)
+    push_jobs(fair_scheduler, "b", [QUANTUM] * 8)
+
+    sent = dispatch(fair_scheduler, 5)
+    assert sent.count("a0") + sent.count("a1") + sent.count("a2") + sent.count("a3") == 4
+    assert sent.count("b0") == 1
+
+
+def test_large_job_waits_for_its_deficit(fair_scheduler):
+    push_jobs(fair_scheduler, "a", [QUANTUM * 3])
+    push_jobs(fair_scheduler, "b", [QUANTUM] * 5)
+
+    # The large job is released on its client's third turn, after a job of the other client on each turn in between
+    assert dispatch(fair_scheduler, 3) == ["b0", "b1", "a0"]
+    assert fair_scheduler.get_pending() == {"b": 3}
+
+
+def test_byte_budget_holds_jobs_back(fair_scheduler):
+    push_jobs(fair_scheduler, "a", [QUANTUM] * 3)
+
+    assert dispatch(fair_scheduler, 10, byte_budget=QUANTUM * 2) == ["a0", "a1"]
+    assert dispatch(fair_scheduler, 10, byte_budget=0) == []
+    assert fair_scheduler.get_pending() == {"a": 1}
+
+
+def test_byte_budget_does_not_pile_up_deficits(fair_scheduler):
+    push_jobs(fair_scheduler, "a", [QUANTUM] * 3)
+    push_jobs(fair_scheduler, "b", [QUANTUM] * 3)
+
+    assert dispatch(fair_scheduler, 10, byte_budget=QUANTUM // 2) == []
+    assert fair_scheduler.get_pending() == {"a": 3, "b": 3}
+    redis_client = scheduler.get_redis(0)
+    assert float(redis_client.hget(fair_scheduler.deficits_key, "a") or 0) == 0
+    assert float(redis_client.hget(fair_scheduler.deficits_key, "b") or 0) == 0
+
+    # Once the disk has room, the clients are served in turn again instead of one of them bursting
+    assert sorted(dispatch(fair_scheduler, 2)) == ["a0", "b0"]
+    assert fair_scheduler.get_pending() == {"a": 2, "b": 2}
+
+
+def test_failed_send_puts_jobs_back_in_order(fair_scheduler):
+    push_jobs(fair_scheduler, "a", [QUANTUM] * 3)
+
+    def fail(signatures):
+        raise RuntimeError("broker down")
+
+    with pytest.raises(RuntimeError):
+        fair_scheduler.dispatch(2, fail)
+    assert fair_scheduler.get_pending() == {"a": 3}
+    assert dispatch(fair_scheduler, 10) == ["a0", "a1", "a2"]
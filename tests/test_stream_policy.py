@@ -0,0 +1,83 @@
+import pytest
+
+from app.Stream import Stream
+from app.stream_policy import NoCompatibleStreamsException, StreamPolicy, select_streams
+
+
+def build_stream(itag, codec, bitrate, height=None, fps=None, content_length=None, video_only=True):
+    return Stream(
+        {
+            "url": f"https://proxy.example/videoplayback?itag={itag}",
+            "format": "WEBM" if codec in ("opus", "vp9") else "MPEG_4",
+            "quality": f"{height}p" if height else f"{bitrate // 1000} kbps",
+            "mimeType": "",
+            "codec": codec,
+            "audioTrackId": None,
+            "audioTrackName": None,
+            "audioTrackLocale": None,
+            "videoOnly": video_only,
+            "itag": itag,
+            "bitrate": bitrate,
+            "initStart": 0,
+            "initEnd": 0,
+            "indexStart": 0,
+            "indexEnd": 0,
+            "width": None,
+            "height": height,
+            "fps": fps,
+            "contentLength": content_length,
+        }
+    )
+
+
+AUDIO_STREAMS = [
+    build_stream(140, "mp4a.40.2", 130_000),
+    build_stream(139, "mp4a.40.5", 50_000),
+    build_stream(251, "opus", 160_000),
+]
+
+VIDEO_STREAMS = [
+    build_stream(137, "avc1.640028", 4_000_000, 1080, 30, 40_000_000),
+    build_stream(248, "vp9", 3_000_000, 1080, 30, 30_000_000),
+    build_stream(299, "avc1.64002a", 6_000_000, 1080, 60, 60_000_000),
+    build_stream(136, "avc1.4d401f", 2_000_000, 720, 30, 20_000_000),
+    build_stream(135, "avc1.4d401e", 1_000_000, 480, 30, 10_000_000),
+    build_stream(18, "avc1.42001E", 500_000, 360, 30, 5_000_000, video_only=False),
+]
+
+
+def select_itags(policy=None, format_out="mp4", duration=100):
+    policy = policy or StreamPolicy()
+    audio_stream, video_stream = select_streams(AUDIO_STREAMS, VIDEO_STREAMS, policy, format_out, duration)
+    return audio_stream.itag, video_stream.itag
+
+
+def test_best_streams_that_fit_the_container():
+    # The tallest, then highest frame rate, video stream and the highest bitrate audio stream mp4 can hold
+    assert select_itags() == (140, 299)
+    assert select_itags(format_out="webm") == (251, 248)
+    assert select_itags(format_out="mkv") == (251, 299)
+
+
+def test_max_height_and_max_fps():
+    assert select_itags(StreamPolicy(max_height=720)) == (140, 136)
+    # Between streams of the same height and frame rate, the smaller one
+    assert select_itags(StreamPolicy(max_fps=30)) == (140, 248)
+    # Without a stream at or below max_height, the shortest one is used
+    assert select_itags(StreamPolicy(max_height=240)) == (140, 135)
+
+
+def test_codec_preferences():
+    assert select_itags(StreamPolicy(video_codecs=["vp9"], audio_codecs=["opus"]), format_out="mkv") == (251, 248)
+
+
+def test_max_size_steps_down_until_the_pair_fits():
+    # The audio stream is 1.6 MB over 100 seconds
+    assert select_itags(StreamPolicy(max_size=25_000_000), format_out="mkv") == (251, 136)
+    # Nothing fits, so the smallest video stream is used
+    assert select_itags(StreamPolicy(max_size=1_000), format_out="mkv") == (251, 135)
+
+
+def test_no_stream_fits_the_container():
+    with pytest.raises(NoCompatibleStreamsException):
+        select_streams(AUDIO_STREAMS[:2], VIDEO_STREAMS, StreamPolicy(), "webm")